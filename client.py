@@ -17,24 +17,1427 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import socket
+import collections, fcntl, fnmatch, json, os, select, socket, stat, struct, threading, time, zlib
 import styx
 
 class ClientError(Exception):
     pass
 
+class NotFoundError(ClientError):
+
+    """Raised when a path that is walked does not exist on the server."""
+    
+    pass
+
+class FlushedError(ClientError):
+
+    """Raised by Client.send when the request was abandoned because another
+    thread called Client.flush."""
+    
+    pass
+
+# The errors that servers send when a walk finds nothing.
+NOT_FOUND_ERRORS = set(["Not found.", "file does not exist"])
+
+class BlockCache:
+
+    """Holds blocks of file data read by a client in least recently used
+    order, discarding the oldest blocks when their total size exceeds the
+    budget. Blocks are keyed by the path and version of the file's qid, the
+    block size and the offset of the block in the file.
+    
+    Each file has a validator: the qid returned when it was last opened and,
+    for servers that do not change the version of a qid when a file changes,
+    its modification time and length. When a file is opened with a different
+    validator, its blocks are discarded. Data is only checked when a file is
+    opened, so changes made by other clients while it is open are not seen,
+    and changes that leave the length of a file unchanged within the
+    resolution of its modification time are missed on such servers.
+    """
+    
+    def __init__(self, budget):
+    
+        self.budget = budget
+        self.size = 0
+        self.blocks = collections.OrderedDict()
+        
+        # Validators for qid paths, and the keys of the blocks cached for
+        # each of them.
+        self.validators = {}
+        self.keys = {}
+        
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+    
+    def validate(self, qpath, validator):
+    
+        """Records the validator for the file with the given qid path,
+        discarding its blocks if they were read from a different version of
+        the file. Returns True if the blocks are still valid."""
+        
+        self.lock.acquire()
+        try:
+            if self.validators.get(qpath) == validator:
+                return True
+            
+            self._discard(qpath)
+            self.validators[qpath] = validator
+            return False
+        finally:
+            self.lock.release()
+    
+    def discard(self, qpath):
+    
+        self.lock.acquire()
+        try:
+            self._discard(qpath)
+            self.validators.pop(qpath, None)
+        finally:
+            self.lock.release()
+    
+    def _discard(self, qpath):
+    
+        for key in self.keys.pop(qpath, ()):
+            self.size -= len(self.blocks.pop(key))
+    
+    def get(self, key):
+    
+        self.lock.acquire()
+        try:
+            value = self.blocks.pop(key, None)
+            if value == None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.blocks[key] = value
+            return value
+        finally:
+            self.lock.release()
+    
+    def put(self, key, value):
+    
+        self.lock.acquire()
+        try:
+            old = self.blocks.pop(key, None)
+            if old != None:
+                self.size -= len(old)
+            
+            self.blocks[key] = value
+            self.size += len(value)
+            self.keys.setdefault(key[0], set()).add(key)
+            
+            while self.size > self.budget and self.blocks:
+                k, v = self.blocks.popitem(last=False)
+                self.size -= len(v)
+                self.evictions += 1
+                
+                keys = self.keys[k[0]]
+                keys.discard(k)
+                if not keys:
+                    del self.keys[k[0]]
+        finally:
+            self.lock.release()
+    
+    def counters(self):
+    
+        """Returns a dictionary containing the numbers of hits, misses and
+        evictions, and the number of bytes held."""
+        
+        return {u"hits": self.hits, u"misses": self.misses,
+                u"evictions": self.evictions, u"size": self.size}
+
+
+class DiskCache:
+
+    """Holds blocks of file data in files beneath a directory so that they
+    can be used by later processes, validating them in the same way as a
+    BlockCache. Several processes can use the same directory at once.
+    
+    The blocks for each file are kept in a subdirectory named after its qid
+    path, along with a file containing its validator and a token that is
+    changed when the validator changes, so that blocks written by processes
+    that opened an older version of the file are never read. The least
+    recently used blocks are removed when their total size exceeds the
+    budget, which is checked when this process adds blocks.
+    """
+    
+    def __init__(self, directory, budget):
+    
+        self.directory = directory
+        self.budget = budget
+        
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        
+        self.lock_path = os.path.join(directory, "lock")
+        self.lock = threading.Lock()
+        self.lock_file = None
+        
+        # The tokens of the validators of files opened by this process.
+        self.tokens = {}
+        
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.size = self._usage()[0]
+        
+        if self.size > self.budget:
+            self._lock()
+            try:
+                self._evict()
+            finally:
+                self._unlock()
+    
+    def _lock(self):
+    
+        # Exclude other threads and then other processes.
+        self.lock.acquire()
+        self.lock_file = open(self.lock_path, "a")
+        fcntl.flock(self.lock_file, fcntl.LOCK_EX)
+    
+    def _unlock(self):
+    
+        self.lock_file.close()
+        self.lock_file = None
+        self.lock.release()
+    
+    def _dir(self, qpath):
+    
+        return os.path.join(self.directory, "%016x" % qpath)
+    
+    def _block_path(self, key):
+    
+        token = self.tokens.get(key[0])
+        if token == None:
+            return None
+        
+        return os.path.join(self._dir(key[0]), "%s.%x.%x.%x" % ((token,) + key[1:]))
+    
+    def validate(self, qpath, validator):
+    
+        text = json.dumps(validator)
+        path = os.path.join(self._dir(qpath), "validator")
+        
+        self._lock()
+        try:
+            try:
+                f = open(path)
+                token, old_text = f.read().split("\n", 1)
+                f.close()
+            except (IOError, ValueError):
+                token = old_text = None
+            
+            if old_text == text:
+                self.tokens[qpath] = token
+                return True
+            
+            # Another process may still be writing a block for the old
+            # version, leaving the directory in place.
+            self._discard(qpath)
+            self.tokens.pop(qpath, None)
+            
+            token = "%016x" % int.from_bytes(os.urandom(8), "little")
+            try:
+                os.makedirs(self._dir(qpath), exist_ok=True)
+                self._write(path, (token + "\n" + text).encode("utf8"))
+            except (IOError, OSError):
+                # Without a token the file's blocks are neither read nor
+                # written.
+                return False
+            
+            self.tokens[qpath] = token
+            return False
+        finally:
+            self._unlock()
+    
+    def discard(self, qpath):
+    
+        self._lock()
+        try:
+            self._discard(qpath)
+            self.tokens.pop(qpath, None)
+        finally:
+            self._unlock()
+    
+    def _discard(self, qpath):
+    
+        d = self._dir(qpath)
+        
+        try:
+            names = os.listdir(d)
+        except OSError:
+            return
+        
+        for name in names:
+            path = os.path.join(d, name)
+            try:
+                size = os.path.getsize(path)
+                os.remove(path)
+            except OSError:
+                continue
+            
+            # Temporary files are not included in the total, and are removed
+            # along with the blocks in case they were left by processes that
+            # exited while writing them.
+            if name != "validator" and not name.endswith(".tmp"):
+                self.size -= size
+        
+        try:
+            os.rmdir(d)
+        except OSError:
+            pass
+    
+    def get(self, key):
+    
+        path = self._block_path(key)
+        if path == None:
+            self.misses += 1
+            return None
+        
+        try:
+            f = open(path, "rb")
+            value = f.read()
+            f.close()
+            # Record the use of the block for eviction.
+            os.utime(path)
+        except (IOError, OSError):
+            self.misses += 1
+            return None
+        
+        self.hits += 1
+        return value
+    
+    def put(self, key, value):
+    
+        path = self._block_path(key)
+        if path == None:
+            return
+        
+        try:
+            self._write(path, value)
+        except (IOError, OSError):
+            return
+        
+        self.size += len(value)
+        
+        if self.size > self.budget:
+            self._lock()
+            try:
+                self._evict()
+            finally:
+                self._unlock()
+    
+    def _write(self, path, data):
+    
+        # Write to a temporary file and rename it so that other processes
+        # never see a partly written file.
+        temp_path = "%s.%i.%i.tmp" % (path, os.getpid(), threading.get_ident())
+        try:
+            f = open(temp_path, "wb")
+            f.write(data)
+            f.close()
+            os.rename(temp_path, path)
+        except (IOError, OSError):
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+            raise
+    
+    def _usage(self):
+    
+        # Returns the total size of the blocks held by all processes and a
+        # list of (modification time, size, path) tuples for them.
+        total = 0
+        blocks = []
+        
+        for d in os.listdir(self.directory):
+            d = os.path.join(self.directory, d)
+            if not os.path.isdir(d):
+                continue
+            
+            for name in os.listdir(d):
+                if name == "validator" or name.endswith(".tmp"):
+                    continue
+                path = os.path.join(d, name)
+                try:
+                    s = os.stat(path)
+                except OSError:
+                    continue
+                total += s.st_size
+                blocks.append((s.st_mtime, s.st_size, path))
+        
+        return total, blocks
+    
+    def _evict(self):
+    
+        # Remove the oldest blocks until the total size is below nine tenths
+        # of the budget, so that eviction is not needed for every new block.
+        total, blocks = self._usage()
+        blocks.sort()
+        target = self.budget * 9 // 10
+        
+        for mtime, size, path in blocks:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            self.evictions += 1
+        
+        self.size = total
+    
+    def counters(self):
+    
+        """Returns a dictionary containing the numbers of hits, misses and
+        evictions made by this process, and the number of bytes held."""
+        
+        return {u"hits": self.hits, u"misses": self.misses,
+                u"evictions": self.evictions, u"size": self.size}
+
+
+class MetadataCache:
+
+    """Holds stat information and directory listings for paths, relative to
+    the root of a server, for ttl seconds. At most max_entries of each are
+    kept, with the least recently used ones discarded first. The stat
+    information for a path that is not held can be found in the listing of
+    its parent directory.
+    """
+    
+    def __init__(self, ttl = 5.0, max_entries = 10000):
+    
+        self.ttl = ttl
+        self.max_entries = max_entries
+        
+        # (expiry time, value) pairs for paths.
+        self.stats = collections.OrderedDict()
+        self.listings = collections.OrderedDict()
+        
+        self.hits = {u"stat": 0, u"listing": 0}
+        self.misses = {u"stat": 0, u"listing": 0}
+        self.lock = threading.Lock()
+    
+    def stat(self, path):
+    
+        """Returns the Stat object for the path, or None if it is not held."""
+        
+        self.lock.acquire()
+        try:
+            s = self._get(self.stats, path)
+            
+            if s == None and path:
+                # Look for the entry in the parent directory's listing.
+                parent, name = split_path(path)
+                listing = self._get(self.listings, parent)
+                if listing != None:
+                    view = listing.find(name)
+                    if view != None:
+                        s = view.decode()
+                        self._put(self.stats, path, s)
+            
+            if s == None:
+                self.misses[u"stat"] += 1
+            else:
+                self.hits[u"stat"] += 1
+            return s
+        finally:
+            self.lock.release()
+    
+    def listing(self, path):
+    
+        """Returns the StatList for the directory with the given path, or
+        None if it is not held."""
+        
+        self.lock.acquire()
+        try:
+            listing = self._get(self.listings, path)
+            if listing == None:
+                self.misses[u"listing"] += 1
+            else:
+                self.hits[u"listing"] += 1
+            return listing
+        finally:
+            self.lock.release()
+    
+    def put_stat(self, path, s):
+    
+        self.lock.acquire()
+        try:
+            self._put(self.stats, path, s)
+        finally:
+            self.lock.release()
+    
+    def put_listing(self, path, listing):
+    
+        self.lock.acquire()
+        try:
+            self._put(self.listings, path, listing)
+        finally:
+            self.lock.release()
+    
+    def invalidate(self, path = None):
+    
+        """Discards the information held for the path, everything beneath
+        it, and the listing of its parent directory. If the path is None,
+        everything is discarded."""
+        
+        self.lock.acquire()
+        try:
+            if path == None:
+                self.stats.clear()
+                self.listings.clear()
+                return
+            
+            prefix = path + u"/"
+            for entries in self.stats, self.listings:
+                for key in [k for k in entries if k == path or k.startswith(prefix) or not path]:
+                    del entries[key]
+            
+            if path:
+                self.listings.pop(split_path(path)[0], None)
+        finally:
+            self.lock.release()
+    
+    def counters(self):
+    
+        """Returns a dictionary containing the numbers of hits and misses for
+        stat information and listings, and the number of entries held."""
+        
+        return {u"stat_hits": self.hits[u"stat"],
+                u"stat_misses": self.misses[u"stat"],
+                u"listing_hits": self.hits[u"listing"],
+                u"listing_misses": self.misses[u"listing"],
+                u"entries": len(self.stats) + len(self.listings)}
+    
+    def _get(self, entries, path):
+    
+        entry = entries.pop(path, None)
+        if entry == None:
+            return None
+        
+        if entry[0] <= time.time():
+            return None
+        
+        entries[path] = entry
+        return entry[1]
+    
+    def _put(self, entries, path, value):
+    
+        entries.pop(path, None)
+        entries[path] = (time.time() + self.ttl, value)
+        
+        while len(entries) > self.max_entries:
+            entries.popitem(last=False)
+
+
+def split_path(path):
+
+    """Returns the parent directory and name of a normalised path."""
+    
+    i = path.rfind(u"/")
+    if i == -1:
+        return u"", path
+    return path[:i], path[i + 1:]
+
+
+class RequestPipeline:
+
+    """Sends requests over the connections of several clients without waiting
+    for the replies to earlier ones. Each request is sent with an object
+    describing the work it is part of, and each reply is passed to handle()
+    with that object. Subclasses call step() while requests are in flight.
+    
+    The clients must be connected to the same server and must not be used
+    for anything else while requests are in flight.
+    """
+    
+    def __init__(self, clients):
+    
+        self.clients = clients
+        self.receivers = [styx.BufferedReceiver(c.socket) for c in clients]
+        self.senders = [styx.QueuedSender(c.socket) for c in clients]
+        
+        # Requests in flight on each connection, and tags that can be reused.
+        self.requests = [{} for c in clients]
+        self.free_tags = [[] for c in clients]
+        self.next_tags = [3 for c in clients]
+    
+    def send(self, i, msg, job):
+    
+        tags = self.free_tags[i]
+        if tags:
+            msg.tag = tags.pop()
+        else:
+            msg.tag = self.next_tags[i]
+            self.next_tags[i] += 1
+        
+        self.requests[i][msg.tag] = job
+        msg.encode(self.senders[i])
+    
+    def walk(self, i, job, fid):
+    
+        # Walk from the fid to the path of the job, in several steps if the
+        # path is longer than the number of elements allowed in one walk.
+        pieces = job.path[job.walked:job.walked + Client.MAXWELEM]
+        job.walked += len(pieces)
+        job.count = len(pieces)
+        
+        self.send(i, styx.Twalk(fid=fid, newfid=job.fid, wname=pieces), job)
+    
+    def step(self):
+    
+        """Sends the requests that have been queued, waits for replies and
+        handles them."""
+        
+        for sender in self.senders:
+            sender.flush()
+        
+        ready = [i for i, r in enumerate(self.receivers) if r.ready()]
+        
+        if not ready:
+            sockets = [c.socket for i, c in enumerate(self.clients)
+                       if self.requests[i]]
+            if not sockets:
+                return
+            readable = select.select(sockets, [], [])[0]
+            ready = [i for i, c in enumerate(self.clients)
+                     if c.socket in readable]
+        
+        for i in ready:
+            while True:
+                reply = styx.decode(stream=self.receivers[i])
+                job = self.requests[i].pop(reply.tag)
+                self.free_tags[i].append(reply.tag)
+                self.handle(i, reply, job)
+                
+                if not self.receivers[i].ready():
+                    break
+    
+    def handle(self, i, reply, job):
+        pass
+
+
+class DirectoryListing:
+
+    """Describes the progress of a TreeWalker in listing one directory."""
+    
+    __slots__ = ("elements", "path", "fid", "walked", "count", "offset",
+                 "leftover", "state")
+    
+    def __init__(self, elements, path, fid):
+    
+        self.elements = elements
+        self.path = path
+        self.fid = fid
+        self.walked = 0
+        self.count = 0
+        self.offset = 0
+        self.leftover = b""
+        self.state = "walk"
+
+
+class TreeWalker(RequestPipeline):
+
+    """Lists the directories beneath a path, using each of the clients
+    given to list up to outstanding directories at once. The entries of each
+    directory are produced as each read returns, without waiting for the
+    whole directory to be read. Directories are listed in depth-first order,
+    so the directories waiting to be listed are those found alongside the
+    ones on the current path.
+    """
+    
+    def __init__(self, clients, elements, prefix, outstanding = 16,
+                 onerror = None):
+    
+        RequestPipeline.__init__(self, clients)
+        
+        self.elements = elements
+        self.prefix = prefix
+        self.outstanding = outstanding
+        self.onerror = onerror
+        
+        # The directories waiting to be listed, as lists of path elements
+        # relative to the starting directory.
+        self.pending = [[]]
+        self.results = []
+        self.stopping = False
+        self.active = 0
+        self.listing = [0 for c in clients]
+    
+    def run(self):
+    
+        """Yields (path, Stat) tuples for the entries beneath the starting
+        directory as they are received."""
+        
+        try:
+            while self.pending or self.active:
+                self.fill()
+                self.step()
+                results = self.results
+                self.results = []
+                for result in results:
+                    yield result
+        finally:
+            # If the caller stops early, wait for the replies to the requests
+            # already sent and clunk the fids in use.
+            self.stopping = True
+            while self.active:
+                self.step()
+            self.results = []
+    
+    def fill(self):
+    
+        for i in range(len(self.clients)):
+            while self.pending and self.listing[i] < self.outstanding:
+                self.start(i, self.pending.pop())
+    
+    def start(self, i, elements):
+    
+        client = self.clients[i]
+        listing = DirectoryListing(elements, self.elements + elements,
+                                   client._next_fid(client.root_fid))
+        self.listing[i] += 1
+        self.active += 1
+        
+        self.walk(i, listing, client.root_fid)
+    
+    def handle(self, i, reply, listing):
+    
+        if isinstance(reply, styx.Rerror) or \
+           (listing.state == "walk" and reply.nwqid < listing.count):
+        
+            if listing.state != "clunk" and self.onerror != None:
+                if isinstance(reply, styx.Rerror):
+                    message = reply.ename
+                else:
+                    message = "No such file or directory."
+                self.onerror(self.join(listing.elements), message)
+            
+            if listing.state == "walk" and listing.walked == listing.count:
+                # The first walk failed, so the fid was not used by the server.
+                self.finish(i, listing)
+            else:
+                self.clunk(i, listing)
+        
+        elif listing.state == "walk":
+            if listing.walked < len(listing.path):
+                self.walk(i, listing, listing.fid)
+            else:
+                listing.state = "open"
+                self.send(i, styx.Topen(fid=listing.fid, mode=0), listing)
+        
+        elif listing.state in ("open", "read"):
+            if listing.state == "read":
+                if not reply.data or self.stopping:
+                    self.clunk(i, listing)
+                    return
+                
+                listing.offset += len(reply.data)
+                self.entries(listing, listing.leftover + reply.data)
+            
+            listing.state = "read"
+            self.send(i, styx.Tread(fid=listing.fid, offset=listing.offset,
+                                    count=self.clients[i].msize - 24), listing)
+        
+        else:
+            self.finish(i, listing)
+    
+    def entries(self, listing, data):
+    
+        # Servers should only return whole entries, but some do not, so
+        # keep any incomplete entry for the next read.
+        end = 0
+        while end + 2 <= len(data):
+            size = struct.unpack_from("<H", data, end)[0]
+            if end + 2 + size > len(data):
+                break
+            end += 2 + size
+        
+        listing.leftover = data[end:]
+        
+        path = self.join(listing.elements)
+        if path:
+            path += u"/"
+        
+        append = self.results.append
+        
+        for s in styx.decode_stats(data[:end]).decode():
+        
+            # Names that refer to other directories are not used, so that
+            # they cannot be listed again or copied outside a local tree.
+            if s.name in (u"", u".", u"..") or u"/" in s.name or \
+               os.sep in s.name or u"\0" in s.name:
+                if self.onerror != None:
+                    self.onerror(path + s.name, "Invalid name in directory listing.")
+                continue
+            
+            append((path + s.name, s))
+            
+            if s.mode & styx.Stat.DMDIR:
+                self.pending.append(listing.elements + [s.name])
+    
+    def clunk(self, i, listing):
+    
+        listing.state = "clunk"
+        self.send(i, styx.Tclunk(fid=listing.fid), listing)
+    
+    def finish(self, i, listing):
+    
+        self.clients[i].fids.discard(listing.fid)
+        self.listing[i] -= 1
+        self.active -= 1
+    
+    def join(self, elements):
+    
+        return u"/".join([self.prefix] + elements if self.prefix else elements)
+
+
+class Upload:
+
+    """Describes the progress of a TreeUploader in copying one file or
+    directory."""
+    
+    __slots__ = ("elements", "local_path", "is_dir", "perm", "path", "fid",
+                 "walked", "count", "state", "file", "offset", "writes",
+                 "error")
+    
+    def __init__(self, elements, local_path, is_dir, perm, path):
+    
+        self.elements = elements
+        self.local_path = local_path
+        self.is_dir = is_dir
+        self.perm = perm
+        self.path = path
+        self.fid = None
+        self.walked = 0
+        self.count = 0
+        self.state = "walk"
+        self.file = None
+        self.offset = 0
+        self.writes = 0
+        self.error = None
+
+
+class TreeUploader(RequestPipeline):
+
+    """Copies the contents of a local directory to a directory on a server,
+    creating it if necessary, with up to max_files files and directories
+    being copied at once and up to max_bytes of written data waiting for
+    replies. The contents of each directory are copied after the directory
+    has been created. Files are read in pieces as they are written, and
+    existing files are truncated and replaced.
+    """
+    
+    def __init__(self, clients, local_dir, elements, prefix, max_files = 32,
+                 max_bytes = 4 * 1024 * 1024, progress = None, onerror = None):
+    
+        RequestPipeline.__init__(self, clients)
+        
+        self.local_dir = local_dir
+        self.elements = elements
+        self.prefix = prefix
+        self.max_files = max_files
+        self.max_bytes = max_bytes
+        self.progress = progress
+        self.onerror = onerror
+        
+        # Find the files and directories to copy beforehand so that progress
+        # can be reported against the totals.
+        self.contents = {}
+        self.skipped = []
+        self.files = 0
+        self.total_bytes = 0
+        
+        for root, dirs, files in os.walk(local_dir):
+            rel = os.path.relpath(root, local_dir)
+            if rel == os.curdir:
+                rel = ()
+            else:
+                rel = tuple(rel.split(os.sep))
+            
+            contents = self.contents[rel] = []
+            
+            for name in sorted(dirs) + sorted(files):
+                local_path = os.path.join(root, name)
+                try:
+                    s = os.stat(local_path)
+                except OSError:
+                    continue
+                
+                is_dir = stat.S_ISDIR(s.st_mode)
+                if not is_dir and not stat.S_ISREG(s.st_mode):
+                    self.skipped.append(list(rel + (name,)))
+                    continue
+                
+                contents.append((rel + (name,), local_path, is_dir, s.st_mode & 0o777))
+                if not is_dir:
+                    self.files += 1
+                    self.total_bytes += s.st_size
+        
+        self.pending = []
+        self.uploading = [0 for c in clients]
+        self.writing = []
+        self.active = 0
+        self.bytes_in_flight = 0
+        
+        self.result = {u"files": 0, u"directories": 0, u"bytes": 0,
+                       u"errors": []}
+    
+    def run(self):
+    
+        """Copies the files and directories, returning a dictionary containing
+        the numbers of files and directories copied, the number of bytes
+        written and a list of (path, message) tuples describing errors."""
+        
+        for elements in self.skipped:
+            self.error(elements, "Not a regular file.")
+        
+        if self.elements:
+            # Create the destination directory if it does not already exist.
+            mode = os.stat(self.local_dir).st_mode & 0o777
+            self.pending.append(((), self.local_dir, True, mode))
+        else:
+            self.pending += self.contents.get((), [])
+        
+        while self.pending or self.active:
+            self.fill()
+            self.step()
+        
+        return self.result
+    
+    def fill(self):
+    
+        # Start copying files and directories, in the order they were found,
+        # on the connections with the fewest in progress.
+        while self.pending and self.active < self.max_files:
+            i = self.uploading.index(min(self.uploading))
+            self.start(i, self.pending.pop(0))
+        
+        # Send more data for files being written, if the limit allows.
+        for i, upload in self.writing[:]:
+            self.write_more(i, upload)
+    
+    def start(self, i, entry):
+    
+        rel, local_path, is_dir, perm = entry
+        elements = self.elements + list(rel)
+        upload = Upload(list(rel), local_path, is_dir, perm, elements[:-1])
+        
+        if not is_dir:
+            try:
+                upload.file = open(local_path, "rb")
+            except IOError as e:
+                self.error(upload.elements, str(e))
+                self.report(upload)
+                return
+        
+        client = self.clients[i]
+        upload.fid = client._next_fid(client.root_fid)
+        self.uploading[i] += 1
+        self.active += 1
+        
+        self.walk(i, upload, client.root_fid)
+    
+    def handle(self, i, reply, job):
+    
+        if type(job) == tuple:
+            upload, size = job
+            self.written(i, reply, upload, size)
+            return
+        
+        upload = job
+        name = self.name(upload)
+        
+        if upload.state == "walk":
+            if isinstance(reply, styx.Rerror) or reply.nwqid < upload.count:
+                if upload.walked == upload.count:
+                    upload.error = "Cannot find the directory to create it in."
+                    self.finish(i, upload)
+                else:
+                    self.clunk(i, upload, "Cannot find the directory to create it in.")
+            elif upload.walked < len(upload.path):
+                self.walk(i, upload, upload.fid)
+            else:
+                if upload.is_dir:
+                    perm = styx.Stat.DMDIR | upload.perm
+                    mode = styx.File.OREAD
+                else:
+                    perm = upload.perm
+                    mode = styx.File.OWRITE
+                
+                upload.state = "create"
+                self.send(i, styx.Tcreate(fid=upload.fid, name=name, perm=perm,
+                                          mode=mode), upload)
+        
+        elif upload.state == "create":
+            if isinstance(reply, styx.Rerror):
+                # The file or directory may already exist, in which case it
+                # is used instead.
+                upload.state = "existing"
+                upload.error = reply.ename
+                self.send(i, styx.Twalk(fid=upload.fid, newfid=upload.fid,
+                                        wname=[name]), upload)
+            elif upload.is_dir:
+                self.clunk(i, upload)
+            else:
+                self.start_writing(i, upload)
+        
+        elif upload.state == "existing":
+            if isinstance(reply, styx.Rerror) or reply.nwqid < 1:
+                self.clunk(i, upload, upload.error)
+            elif upload.is_dir:
+                upload.error = None
+                self.clunk(i, upload)
+            else:
+                upload.error = None
+                upload.state = "open"
+                self.send(i, styx.Topen(fid=upload.fid, mode=styx.File.OWRITE | 0x10),
+                          upload)
+        
+        elif upload.state == "open":
+            if isinstance(reply, styx.Rerror):
+                self.clunk(i, upload, reply.ename)
+            else:
+                self.start_writing(i, upload)
+        
+        else:
+            self.finish(i, upload)
+    
+    def start_writing(self, i, upload):
+    
+        upload.state = "write"
+        self.writing.append((i, upload))
+        self.write_more(i, upload)
+    
+    def write_more(self, i, upload):
+    
+        chunk = self.clients[i].msize - 24
+        
+        while upload.file != None and upload.error == None:
+        
+            # Always allow one write to be in flight so that files are copied
+            # even if the limit is smaller than the size of a message.
+            if self.bytes_in_flight + chunk > self.max_bytes and self.bytes_in_flight:
+                return
+            
+            try:
+                data = upload.file.read(chunk)
+            except IOError as e:
+                data = b""
+                upload.error = str(e)
+            
+            if not data:
+                upload.file.close()
+                upload.file = None
+                self.writing.remove((i, upload))
+                break
+            
+            self.send(i, styx.Twrite(fid=upload.fid, offset=upload.offset,
+                                     data=data), (upload, len(data)))
+            upload.offset += len(data)
+            upload.writes += 1
+            self.bytes_in_flight += len(data)
+        
+        if upload.file == None and upload.writes == 0:
+            self.clunk(i, upload)
+    
+    def written(self, i, reply, upload, size):
+    
+        upload.writes -= 1
+        self.bytes_in_flight -= size
+        
+        if isinstance(reply, styx.Rerror):
+            error = reply.ename
+        elif reply.count < size:
+            error = "Short write."
+        else:
+            error = None
+            self.result[u"bytes"] += size
+        
+        if error != None and upload.error == None:
+            upload.error = error
+            if upload.file != None:
+                upload.file.close()
+                upload.file = None
+                self.writing.remove((i, upload))
+        
+        if upload.file == None and upload.writes == 0:
+            self.clunk(i, upload)
+        else:
+            self.write_more(i, upload)
+    
+    def clunk(self, i, upload, error = None):
+    
+        if error != None:
+            upload.error = error
+        
+        upload.state = "clunk"
+        self.send(i, styx.Tclunk(fid=upload.fid), upload)
+    
+    def finish(self, i, upload):
+    
+        self.clients[i].fids.discard(upload.fid)
+        self.uploading[i] -= 1
+        self.active -= 1
+        
+        if upload.error != None:
+            self.error(upload.elements, upload.error)
+            if upload.file != None:
+                upload.file.close()
+                upload.file = None
+            if not upload.is_dir:
+                self.report(upload)
+            return
+        
+        if upload.is_dir:
+            self.result[u"directories"] += 1
+            # The contents of the directory can now be copied, before those
+            # of other directories so that the number of entries waiting to
+            # be copied stays small.
+            self.pending[:0] = self.contents.get(tuple(upload.elements), [])
+        else:
+            self.result[u"files"] += 1
+            self.report(upload)
+    
+    def error(self, elements, message):
+    
+        path = self.join(elements)
+        self.result[u"errors"].append((path, message))
+        
+        if self.onerror != None:
+            self.onerror(path, message)
+    
+    def report(self, upload):
+    
+        if self.progress != None:
+            self.progress(self.join(upload.elements),
+                          self.result[u"files"] + len(self.result[u"errors"]),
+                          self.files, self.result[u"bytes"], self.total_bytes)
+    
+    def name(self, upload):
+    
+        if upload.elements:
+            return upload.elements[-1]
+        return self.elements[-1]
+    
+    def join(self, elements):
+    
+        return u"/".join([self.prefix] + elements if self.prefix else elements)
+
+
+# Manifests record, for each path, the mode, modification time, qid version,
+# length and qid path of the file or directory.
+MANIFEST_MAGIC = b"STYXSYNC1\n"
+MANIFEST_ENTRY = struct.Struct("<IIIQQ")
+
+def load_manifest(path):
+
+    """Returns a dictionary mapping paths to (mode, mtime, qid version, length,
+    qid path) tuples read from the manifest file with the given path, or an
+    empty dictionary if the file cannot be read."""
+    
+    try:
+        f = open(path, "rb")
+        data = f.read()
+        f.close()
+    except IOError:
+        return {}
+    
+    if not data.startswith(MANIFEST_MAGIC):
+        return {}
+    
+    try:
+        offset = len(MANIFEST_MAGIC)
+        size = struct.unpack_from("<I", data, offset)[0]
+        offset += 4
+        entries = zlib.decompress(data[offset:offset + size])
+        paths = zlib.decompress(data[offset + size:]).decode("utf8")
+    except (struct.error, zlib.error, UnicodeDecodeError):
+        return {}
+    
+    if not paths:
+        return {}
+    
+    return dict(zip(paths.split(u"\0"), MANIFEST_ENTRY.iter_unpack(entries)))
+
+
+def save_manifest(path, manifest):
+
+    """Writes the manifest to a file with the given path, replacing any
+    existing file in one step."""
+    
+    paths = list(manifest.keys())
+    entries = b"".join([MANIFEST_ENTRY.pack(*manifest[p]) for p in paths])
+    entries = zlib.compress(entries, 1)
+    
+    temp_path = "%s.%i.tmp" % (path, os.getpid())
+    f = open(temp_path, "wb")
+    f.write(MANIFEST_MAGIC)
+    f.write(struct.pack("<I", len(entries)))
+    f.write(entries)
+    f.write(zlib.compress(u"\0".join(paths).encode("utf8"), 1))
+    f.close()
+    os.rename(temp_path, path)
+
+
+class Download:
+
+    """Describes the progress of a TreeDownloader in fetching one file."""
+    
+    __slots__ = ("rel", "stat", "path", "local_path", "temp_path", "fd", "fid",
+                 "walked", "count", "state", "offset", "reads", "written", "eof",
+                 "error")
+    
+    def __init__(self, rel, stat, path, local_path):
+    
+        self.rel = rel
+        self.stat = stat
+        self.path = path
+        self.local_path = local_path
+        self.temp_path = None
+        self.fd = None
+        self.fid = None
+        self.walked = 0
+        self.count = 0
+        self.state = "walk"
+        self.offset = 0
+        self.reads = 0
+        self.written = 0
+        self.eof = False
+        self.error = None
+
+
+class TreeDownloader(RequestPipeline):
+
+    """Fetches files from a server into local files, with up to max_files
+    files being fetched at once and up to max_bytes of data requested but not
+    yet received. Each file is written to a temporary file in the same local
+    directory, which is renamed to replace the file once it is complete.
+    """
+    
+    def __init__(self, clients, downloads, max_files = 32,
+                 max_bytes = 4 * 1024 * 1024, fetched = None, onerror = None):
+    
+        RequestPipeline.__init__(self, clients)
+        
+        self.pending = downloads
+        self.pending.reverse()
+        self.max_files = max_files
+        self.max_bytes = max_bytes
+        self.fetched = fetched
+        self.onerror = onerror
+        
+        self.downloading = [0 for c in clients]
+        self.reading = []
+        self.active = 0
+        self.bytes_in_flight = 0
+        self.bytes = 0
+    
+    def run(self):
+    
+        while self.pending or self.active:
+            self.fill()
+            self.step()
+    
+    def fill(self):
+    
+        while self.pending and self.active < self.max_files:
+            i = self.downloading.index(min(self.downloading))
+            self.start(i, self.pending.pop())
+        
+        for i, download in self.reading[:]:
+            self.read_more(i, download)
+    
+    def start(self, i, download):
+    
+        directory, name = os.path.split(download.local_path)
+        download.temp_path = os.path.join(directory, ".%s.%i.tmp" % (name, os.getpid()))
+        
+        try:
+            download.fd = os.open(download.temp_path,
+                                  os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                                  download.stat.mode & 0o777)
+        except OSError as e:
+            self.error(download, str(e))
+            return
+        
+        client = self.clients[i]
+        download.fid = client._next_fid(client.root_fid)
+        self.downloading[i] += 1
+        self.active += 1
+        
+        self.walk(i, download, client.root_fid)
+    
+    def handle(self, i, reply, job):
+    
+        if type(job) == tuple:
+            download, offset, count = job
+            self.received(i, reply, download, offset, count)
+            return
+        
+        download = job
+        
+        if download.state == "walk":
+            if isinstance(reply, styx.Rerror) or reply.nwqid < download.count:
+                if download.walked == download.count:
+                    download.error = "No such file or directory."
+                    self.finish(i, download)
+                else:
+                    self.clunk(i, download, "No such file or directory.")
+            elif download.walked < len(download.path):
+                self.walk(i, download, download.fid)
+            else:
+                download.state = "open"
+                self.send(i, styx.Topen(fid=download.fid, mode=styx.File.OREAD),
+                          download)
+        
+        elif download.state == "open":
+            if isinstance(reply, styx.Rerror):
+                self.clunk(i, download, reply.ename)
+            else:
+                download.state = "read"
+                self.reading.append((i, download))
+                self.read_more(i, download)
+        
+        else:
+            self.finish(i, download)
+    
+    def read_more(self, i, download):
+    
+        chunk = self.clients[i].msize - 24
+        
+        while not download.eof and download.error == None:
+        
+            if self.bytes_in_flight + chunk > self.max_bytes and self.bytes_in_flight:
+                return
+            
+            # Only read beyond the expected length of the file to find its
+            # end, one piece at a time.
+            if download.offset >= download.stat.length and download.reads:
+                return
+            
+            self.read(i, download, download.offset, chunk)
+            download.offset += chunk
+    
+    def read(self, i, download, offset, count):
+    
+        self.send(i, styx.Tread(fid=download.fid, offset=offset, count=count),
+                  (download, offset, count))
+        download.reads += 1
+        self.bytes_in_flight += count
+    
+    def received(self, i, reply, download, offset, count):
+    
+        download.reads -= 1
+        self.bytes_in_flight -= count
+        
+        if isinstance(reply, styx.Rerror):
+            if download.error == None:
+                download.error = reply.ename
+        elif download.error == None:
+            length = len(reply.data)
+            try:
+                os.pwrite(download.fd, reply.data, offset)
+                self.bytes += length
+                download.written += length
+            except OSError as e:
+                download.error = str(e)
+            
+            if length < count:
+                if length > 0 and offset + length < download.stat.length:
+                    # Servers may return less data than requested before the
+                    # end of the file, so read the rest of the piece.
+                    self.read(i, download, offset + length, count - length)
+                else:
+                    download.eof = True
+        
+        if download.eof or download.error != None:
+            if download.reads == 0:
+                self.reading.remove((i, download))
+                self.clunk(i, download)
+        else:
+            self.read_more(i, download)
+    
+    def clunk(self, i, download, error = None):
+    
+        if error != None:
+            download.error = error
+        
+        download.state = "clunk"
+        self.send(i, styx.Tclunk(fid=download.fid), download)
+    
+    def finish(self, i, download):
+    
+        self.clients[i].fids.discard(download.fid)
+        self.downloading[i] -= 1
+        self.active -= 1
+        
+        if download.error == None and download.written < download.stat.length:
+            # The file was shortened while it was being read, so the copy
+            # does not match the stat information that would be recorded.
+            download.error = "Read %i of %i bytes." % (download.written,
+                                                      download.stat.length)
+        
+        if download.error == None:
+            try:
+                os.close(download.fd)
+                download.fd = None
+                mtime = download.stat.mtime
+                os.utime(download.temp_path, (mtime, mtime))
+                os.rename(download.temp_path, download.local_path)
+            except OSError as e:
+                download.error = str(e)
+        
+        if download.error != None:
+            self.error(download, download.error)
+        elif self.fetched != None:
+            self.fetched(download.rel, download.stat)
+    
+    def error(self, download, message):
+    
+        if download.fd != None:
+            os.close(download.fd)
+            download.fd = None
+        
+        try:
+            os.remove(download.temp_path)
+        except OSError:
+            pass
+        
+        if self.onerror != None:
+            self.onerror(download.rel, message)
+
+
 class Client:
 
     MSIZE = 16384
     MAXWELEM = 16
     
-    def __init__(self, host = None, port = None, uname = None, aname = None):
+    # The tag used for flush requests, which is not used for anything else.
+    FLUSH_TAG = 0xfffe
+    
+    def __init__(self, host = None, port = None, uname = None, aname = None,
+                       nodelay = True):
     
         self.reset()
         
         self.uname = uname
         self.aname = aname
         
+        # The block and metadata caches are only used if enable_cache() and
+        # enable_metadata_cache() are called.
+        self.cache = None
+        self.metadata = None
+        
+        # Disable Nagle's algorithm so that small requests are sent at once,
+        # unless nodelay is False.
+        self.nodelay = nodelay
+        
         if host != None and port != None:
             self.connect(host, port, uname, aname)
     
@@ -50,21 +1453,107 @@ class Client:
         # consider to be the current directory.
         self.root_fid = 0
         self.current_fid = None
+        self.current_path = []
         
         # Keep a collection of replies in case they arrive in an order we don't
         # expect.
         self.replies = {}
+        
+        # The tag of the request waiting for a reply and the tag of a request
+        # that is being flushed, if any. Callers that share a client between
+        # threads can set the owner to identify the requests that they send,
+        # so that only those are flushed on their behalf.
+        self.lock = threading.Lock()
+        self.in_flight = None
+        self.in_flight_owner = None
+        self.flushed = None
+        self.owner = None
+        
+        # The cache keys, without offsets, of fids opened for reading files
+        # whose data can be cached.
+        self.cached_fids = {}
+    
+    def enable_cache(self, budget = 64 * 1024 * 1024, directory = None):
+    
+        """Keeps blocks of data read from files in memory, up to the budget in
+        bytes, so that files that have not changed since they were last read
+        can be read again without fetching their contents from the server.
+        If a directory is given, the blocks are kept in files beneath it
+        instead, and are available to later processes."""
+        
+        if directory == None:
+            self.cache = BlockCache(budget)
+        else:
+            self.cache = DiskCache(directory, budget)
+    
+    def enable_metadata_cache(self, ttl = 5.0, max_entries = 10000):
+    
+        """Keeps stat information and directory listings for ttl seconds so
+        that stat() and ls() can often be answered without contacting the
+        server. Changes made by this client through its create, mkdir,
+        remove and wstat methods discard the information they affect; use
+        invalidate() after changing files in other ways."""
+        
+        self.metadata = MetadataCache(ttl, max_entries)
+    
+    def invalidate(self, path = None):
+    
+        """Discards cached information about the path and anything beneath
+        it, or about everything if the path is None."""
+        
+        if self.metadata != None:
+            if path == None:
+                self.metadata.invalidate()
+            else:
+                self.metadata.invalidate(self._normalise(path))
+    
+    def _normalise(self, path):
+    
+        # Return the path relative to the root of the server, resolving it
+        # relative to the current directory in the same way as _walk().
+        elements = self.current_path[:]
+        
+        for e in path.split(u"/"):
+            if e == u"..":
+                elements = elements[:-1]
+            elif e and e != u".":
+                elements.append(e)
+        
+        return u"/".join(elements)
     
     def connect(self, host, port, uname, aname):
     
         try:
             s = socket.socket()
             s.connect((host, port))
+            styx.set_tcp_options(s, nodelay=self.nodelay)
         except socket.error:
             raise ClientError("Failed to connect to %s:%i." % (host, port))
         
         self.host = host
         self.port = port
+        self.connect_socket(s, uname, aname)
+    
+    def connect_unix(self, path, uname, aname):
+    
+        """Connects to a server listening on a Unix domain socket with the
+        given path. Paths that begin with "@" are in the abstract namespace."""
+        
+        try:
+            s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            s.connect(styx.unix_address(path))
+        except socket.error:
+            raise ClientError("Failed to connect to %s." % path)
+        
+        self.host = path
+        self.port = None
+        self.connect_socket(s, uname, aname)
+    
+    def connect_socket(self, s, uname, aname):
+    
+        """Uses a socket that is already connected to a server, such as one
+        returned by StyxServer.connect_pair()."""
+        
         self.socket = s
         
         # Negotiate a version and maximum message size.
@@ -78,6 +1567,7 @@ class Client:
         reply = self.send(styx.Tattach(tag=1, fid=0, afid=0, uname=uname, aname=aname))
         
         self.root_fid = self.current_fid = 0
+        self.current_path = []
         self.fids = set([self.root_fid])
     
     def disconnect(self):
@@ -90,30 +1580,82 @@ class Client:
     
     def send(self, msg):
     
-        msg.encode(self.socket)
-        
         tag = msg.tag
         
+        self.lock.acquire()
+        try:
+            msg.encode(self.socket)
+            self.in_flight = tag
+            self.in_flight_owner = self.owner
+        finally:
+            self.lock.release()
+        
         while tag not in self.replies:
         
             reply = styx.decode(sock=self.socket)
+            
             if reply.tag == tag:
                 break
+            elif reply.tag == Client.FLUSH_TAG:
+                # If the request was flushed before a reply was sent then no
+                # reply will arrive. Otherwise, the flush arrived too late and
+                # can be ignored.
+                self.lock.acquire()
+                flushed = self.flushed == tag
+                self.flushed = None
+                if flushed:
+                    self.in_flight = None
+                self.lock.release()
+                
+                if flushed:
+                    raise FlushedError("Request flushed.")
             else:
-                self.replies[tag] = reply
+                self.replies[reply.tag] = reply
         else:
             reply = self.replies[tag]
             del self.replies[tag]
         
+        self.lock.acquire()
+        self.in_flight = None
+        if self.flushed == tag:
+            # The reply arrived before the flush took effect, so the reply to
+            # the flush needs to be ignored when it arrives.
+            self.flushed = -1
+        self.lock.release()
+        
         if isinstance(reply, styx.Rerror):
             raise ClientError(reply.ename)
         
         return reply
     
+    def flush(self, owner = None):
+    
+        """Asks the server to abandon the request that is currently waiting for
+        a reply, if there is one. This is intended to be called from a thread
+        other than the one waiting in send(), which raises a FlushedError if
+        the request is abandoned. If an owner is given, the request is only
+        flushed if it was sent while the client's owner attribute was set to
+        that object. Returns True if a flush request was sent."""
+        
+        self.lock.acquire()
+        try:
+            if self.in_flight == None or self.flushed != None:
+                return False
+            
+            if owner != None and self.in_flight_owner is not owner:
+                return False
+            
+            self.flushed = self.in_flight
+            styx.Tflush(tag=Client.FLUSH_TAG, oldtag=self.in_flight).encode(self.socket)
+            return True
+        finally:
+            self.lock.release()
+    
     def _clunk(self, fid):
     
         self.send(styx.Tclunk(tag=2, fid=fid))
         self.fids.remove(fid)
+        self.cached_fids.pop(fid, None)
     
     def _clunk_old(self, fid):
     
@@ -128,7 +1670,9 @@ class Client:
     
     def _walk(self, path):
     
-        elements = path.split("/")
+        # Ignore empty path elements. An empty path results in a walk with no
+        # elements, which clones the current fid.
+        elements = [e for e in path.split("/") if e]
         fid = self.current_fid
         
         while True:
@@ -140,11 +1684,19 @@ class Client:
             # Use one of the allocated fids for the end point of the walk.
             newfid = self._next_fid(fid)
             
-            reply = self.send(styx.Twalk(tag=2, fid=fid, newfid=newfid,
-                                         wname=pieces))
+            try:
+                reply = self.send(styx.Twalk(tag=2, fid=fid, newfid=newfid,
+                                             wname=pieces))
+            except ClientError as e:
+                # The new fid is not used if the walk fails.
+                self.fids.discard(newfid)
+                if str(e) in NOT_FOUND_ERRORS:
+                    raise NotFoundError("No such file or directory: %s" % \
+                        "/".join(pieces[:1]))
+                raise
             
             if reply.nwqid < len(pieces):
-                raise ClientError("No such file or directory: %s" % \
+                raise NotFoundError("No such file or directory: %s" % \
                     "/".join(pieces[:reply.nwqid]))
             
             # Clunk the old fid if it is an intermediate fid used to walk part
@@ -176,8 +1728,286 @@ class Client:
         self.fids.add(next_fid)
         return next_fid
     
+    def stat(self, path):
+    
+        """Returns the Stat object for the file or directory with the given
+        path."""
+        
+        if self.metadata != None:
+            key = self._normalise(path)
+            s = self.metadata.stat(key)
+            if s != None:
+                return s
+        
+        fid = self._walk(path)
+        try:
+            s = self._stat(fid)
+        finally:
+            self._clunk_old(fid)
+        
+        if self.metadata != None:
+            self.metadata.put_stat(key, s)
+        
+        return s
+    
+    def walk_tree(self, path = "", outstanding = 16, clients = (),
+                        onerror = None):
+    
+        """Yields (path, Stat) tuples for every file and directory beneath
+        the given path, listing up to outstanding directories at once. Other
+        clients connected to the same server can be given to spread the work
+        over several connections. If onerror is given, it is called with the
+        path and error message for each directory that cannot be listed."""
+        
+        elements = [e for e in self._normalise(path).split(u"/") if e]
+        prefix = u"/".join([e for e in path.split(u"/") if e])
+        
+        walker = TreeWalker([self] + list(clients), elements, prefix,
+                            outstanding, onerror)
+        return walker.run()
+    
+    def find(self, path = "", name = None, kind = None, predicate = None,
+                   **options):
+    
+        """Yields the paths beneath the given path whose names match the
+        shell-style pattern in name, that are files if kind is "f" or
+        directories if it is "d", and for which predicate(path, stat) returns
+        True. Criteria that are None are ignored. Other options are passed to
+        walk_tree()."""
+        
+        for p, s in self.walk_tree(path, **options):
+        
+            if name != None and not fnmatch.fnmatchcase(s.name, name):
+                continue
+            if kind != None and (kind == "d") != bool(s.mode & styx.Stat.DMDIR):
+                continue
+            if predicate != None and not predicate(p, s):
+                continue
+            
+            yield p
+    
+    def du(self, path = "", **options):
+    
+        """Returns a dictionary mapping the given path and each directory
+        beneath it to the total length of the files they contain. Options are
+        passed to walk_tree()."""
+        
+        top = u"/".join([e for e in path.split(u"/") if e])
+        totals = {top: 0}
+        
+        for p, s in self.walk_tree(path, **options):
+        
+            if s.mode & styx.Stat.DMDIR:
+                totals.setdefault(p, 0)
+                continue
+            
+            # Add the length of the file to each directory above it.
+            d = p
+            while d != top:
+                d = split_path(d)[0]
+                totals[d] = totals.get(d, 0) + s.length
+        
+        return totals
+    
+    def put_tree(self, local_dir, remote_dir, max_files = 32,
+                       max_bytes = 4 * 1024 * 1024, clients = (),
+                       progress = None, onerror = None):
+    
+        """Copies the contents of a local directory to the directory with the
+        given path on the server, creating it if necessary and replacing
+        existing files. Up to max_files files and directories are copied at
+        once, with no more than max_bytes of data waiting to be acknowledged.
+        Other clients connected to the same server can be given to spread the
+        work over several connections.
+        
+        If given, progress is called after each file is copied with its path,
+        the number of files copied so far and in total, and the number of
+        bytes written so far and in total. onerror is called with the path
+        and error message for each file or directory that cannot be copied.
+        Returns a dictionary containing the numbers of files and directories
+        copied, the number of bytes written and a list of errors."""
+        
+        elements = [e for e in self._normalise(remote_dir).split(u"/") if e]
+        prefix = u"/".join([e for e in remote_dir.split(u"/") if e])
+        
+        clients = [self] + list(clients)
+        uploader = TreeUploader(clients, local_dir, elements, prefix,
+                                max_files, max_bytes, progress, onerror)
+        try:
+            return uploader.run()
+        finally:
+            for c in clients:
+                c.invalidate(remote_dir)
+    
+    def sync(self, remote_dir, local_dir, delete = False, manifest = None,
+                   max_files = 32, max_bytes = 4 * 1024 * 1024, clients = (),
+                   onerror = None):
+    
+        """Makes the local directory a copy of the directory with the given
+        path on the server, fetching only the files that are new or have
+        changed since the last sync. A manifest in the local directory, or in
+        the file given, records the length, modification time and qid of each
+        file copied. Files are written to temporary files that replace the
+        local files when complete. If delete is True, files and directories
+        that were copied before but are no longer on the server are removed;
+        this is not done if any directory on the server could not be listed.
+        
+        Other options are used in the same way as by put_tree(). Returns a
+        dictionary containing the numbers of files fetched, unchanged and
+        deleted, the number of bytes fetched and a list of errors."""
+        
+        if manifest == None:
+            manifest = os.path.join(local_dir, ".styxsync")
+        
+        if not os.path.isdir(local_dir):
+            os.makedirs(local_dir)
+        
+        root = os.path.realpath(local_dir)
+        
+        def local(rel):
+            # Returns the local path for a path relative to the local
+            # directory if it is beneath it, after following any symbolic
+            # links in the directories leading to it.
+            local_path = os.path.join(local_dir, rel.replace(u"/", os.sep))
+            parent = os.path.realpath(os.path.dirname(local_path))
+            if parent == root or parent.startswith(root + os.sep):
+                return local_path
+            return None
+        
+        old = load_manifest(manifest)
+        new = {}
+        result = {u"fetched": 0, u"unchanged": 0, u"deleted": 0, u"bytes": 0,
+                  u"errors": []}
+        
+        def error(path, message):
+            result[u"errors"].append((path, message))
+            if onerror != None:
+                onerror(path, message)
+        
+        elements = [e for e in self._normalise(remote_dir).split(u"/") if e]
+        prefix = u"/".join([e for e in remote_dir.split(u"/") if e])
+        start = len(prefix) + 1 if prefix else 0
+        manifest_name = os.path.basename(manifest)
+        downloads = []
+        
+        for path, s in self.walk_tree(remote_dir, max_files, clients, error):
+        
+            rel = path[start:]
+            if rel == manifest_name:
+                continue
+            
+            entry = (s.mode, s.mtime, s.qid[1], s.length, s.qid[2])
+            local_path = local(rel)
+            
+            if local_path == None:
+                error(rel, "Path is outside the local directory.")
+                continue
+            
+            if s.mode & styx.Stat.DMDIR:
+                if not os.path.isdir(local_path):
+                    try:
+                        os.makedirs(local_path)
+                    except OSError as e:
+                        error(rel, str(e))
+                        continue
+                new[rel] = entry
+                continue
+            
+            if old.get(rel) == entry:
+                try:
+                    if os.stat(local_path).st_size == s.length:
+                        new[rel] = entry
+                        result[u"unchanged"] += 1
+                        continue
+                except OSError:
+                    pass
+            
+            downloads.append(Download(rel, s, elements + rel.split(u"/"),
+                                      local_path))
+        
+        walked = not result[u"errors"]
+        
+        def fetched(rel, s):
+            new[rel] = (s.mode, s.mtime, s.qid[1], s.length, s.qid[2])
+            result[u"fetched"] += 1
+        
+        downloader = TreeDownloader([self] + list(clients), downloads,
+                                    max_files, max_bytes, fetched, error)
+        try:
+            downloader.run()
+        finally:
+            result[u"bytes"] = downloader.bytes
+            
+            # Files that could not be fetched keep their old entries, so that
+            # they are not deleted and are fetched again next time.
+            for download in downloads:
+                if download.rel not in new and download.rel in old:
+                    new[download.rel] = old[download.rel]
+            
+            if not walked or not delete:
+                # Keep the entries for files that may not have been seen, or
+                # that are kept locally, so that they can be deleted later.
+                for rel, entry in old.items():
+                    new.setdefault(rel, entry)
+            
+            save_manifest(manifest, new)
+        
+        if delete and walked:
+            kept = False
+            
+            # Remove files before the directories containing them.
+            for rel in sorted(set(old) - set(new), reverse=True):
+                local_path = local(rel)
+                if local_path == None:
+                    error(rel, "Path is outside the local directory.")
+                    continue
+                try:
+                    if old[rel][0] & styx.Stat.DMDIR:
+                        os.rmdir(local_path)
+                    else:
+                        os.remove(local_path)
+                    result[u"deleted"] += 1
+                except OSError as e:
+                    error(rel, str(e))
+                    new[rel] = old[rel]
+                    kept = True
+            
+            if kept:
+                save_manifest(manifest, new)
+        
+        return result
+    
     def ls(self, path = "", details = False):
     
+        info = None
+        
+        if self.metadata != None:
+            info = self._cached_ls(path)
+        
+        if info == None:
+            info = self._ls(path)
+        
+        if details and isinstance(info, styx.StatList):
+            info = info.decode()
+        elif not details:
+            info = map(lambda x: (x.name, x.uid, x.gid, x.mode), info)
+        
+        return info
+    
+    def _cached_ls(self, path):
+    
+        key = self._normalise(path)
+        s = self.metadata.stat(key)
+        
+        if s == None:
+            return None
+        elif not s.mode & styx.Stat.DMDIR:
+            return [s]
+        else:
+            return self.metadata.listing(key)
+    
+    def _ls(self, path):
+    
         newfid = self._walk(path)
         
         # Determine whether the object is a file or directory.
@@ -186,7 +2016,7 @@ class Client:
         if s.mode & styx.Stat.DMDIR:
             self.send(styx.Topen(tag=2, fid=newfid, mode=0))
             
-            data = ""
+            data = b""
             amount = self.msize - 24
             
             while True:
@@ -198,7 +2028,7 @@ class Client:
                 if len(reply.data) == 0:
                     break
             
-            info = styx.Stat().decode(data=data)
+            info = styx.decode_stats(data)
         else:
             # If it is a file then just return the existing information.
             info = [s]
@@ -206,8 +2036,11 @@ class Client:
         # Release the fid for the file so that it can be reused.
         self._clunk_old(newfid)
         
-        if not details:
-            info = map(lambda x: (x.name, x.uid, x.gid, x.mode), info)
+        if self.metadata != None:
+            key = self._normalise(path)
+            self.metadata.put_stat(key, s)
+            if s.mode & styx.Stat.DMDIR:
+                self.metadata.put_listing(key, info)
         
         return info
     
@@ -217,6 +2050,9 @@ class Client:
         
         self._clunk_old(self.current_fid)
         self.current_fid = newfid
+        self.current_path = self._normalise(path).split(u"/")
+        if self.current_path == [u""]:
+            self.current_path = []
     
     def mkdir(self, path, perm):
     
@@ -226,8 +2062,8 @@ class Client:
         # directory because the fid will be reused for the new directory.
         
         if len(pieces) > 1:
-            fid = self._walk("/".join(path[:-1]))
-            name = path[-1]
+            fid = self._walk("/".join(pieces[:-1]))
+            name = pieces[-1]
         else:
             # Walk to the current directory.
             fid = self._walk("")
@@ -238,6 +2074,7 @@ class Client:
         
         # Release the fid so that it can be reused.
         self._clunk_old(fid)
+        self.invalidate(path)
     
     def create(self, path, perm, mode):
     
@@ -247,8 +2084,8 @@ class Client:
         # directory because the fid will be reused for the new file.
         
         if len(pieces) > 1:
-            fid = self._walk("/".join(path[:-1]))
-            name = path[-1]
+            fid = self._walk("/".join(pieces[:-1]))
+            name = pieces[-1]
         else:
             # Walk to the current directory.
             fid = self._walk("")
@@ -258,6 +2095,33 @@ class Client:
         
         # Release the fid so that it can be reused.
         self._clunk_old(fid)
+        self.invalidate(path)
+    
+    def remove(self, path):
+    
+        fid = self._walk(path)
+        
+        # The fid is clunked by the server even if the file cannot be removed.
+        try:
+            self.send(styx.Tremove(tag=2, fid=fid))
+        finally:
+            self.fids.remove(fid)
+            self.cached_fids.pop(fid, None)
+            self.invalidate(path)
+    
+    def wstat(self, path, stat):
+    
+        """Changes the stat information of the file or directory with the
+        given path. Fields of the Stat object that are not to be changed
+        should contain the "don't touch" values described in stat(5)."""
+        
+        fid = self._walk(path)
+        
+        try:
+            self.send(styx.Twstat(tag=2, fid=fid, stat=stat))
+        finally:
+            self._clunk_old(fid)
+            self.invalidate(path)
     
     def open(self, path, mode):
     
@@ -265,10 +2129,92 @@ class Client:
         
         reply = self.send(styx.Topen(tag=2, fid=fid, mode=mode))
         
+        if self.cache != None:
+            self._validate(fid, mode, reply.qid)
+        
         return styx.File(fid, mode, self)
     
+    def _validate(self, fid, mode, qid):
+    
+        qtype, version, qpath = qid
+        
+        if qtype & 0x80:
+            return
+        
+        if mode & 0x13 != styx.File.OREAD:
+            # Files opened for writing or truncation are not read from the
+            # cache, and their cached blocks may become out of date.
+            self.cache.discard(qpath)
+            return
+        
+        if version == 0:
+            # The server may not change qid versions, so also check the
+            # modification time and length of the file.
+            s = self._stat(fid)
+            validator = (qid, s.mtime, s.length)
+        else:
+            validator = (qid,)
+        
+        self.cache.validate(qpath, validator)
+        self.cached_fids[fid] = (qpath, version)
+    
     def read(self, fid, offset, count):
     
+        key = self.cached_fids.get(fid)
+        if key != None:
+            return self._read_cached(fid, key, offset, count)
+        
         reply = self.send(styx.Tread(tag=2, fid=fid, offset=offset, count=count))
         
         return reply.data
+    
+    def write(self, fid, offset, data):
+    
+        """Writes the data to the file opened with the given fid, in pieces no
+        larger than the maximum message size, returning the number of bytes
+        written."""
+        
+        amount = self.msize - 24
+        written = 0
+        
+        while written < len(data):
+            piece = data[written:written + amount]
+            reply = self.send(styx.Twrite(tag=2, fid=fid, offset=offset + written,
+                                          data=piece))
+            written += reply.count
+            if reply.count < len(piece):
+                break
+        
+        return written
+    
+    def _read_cached(self, fid, key, offset, count):
+    
+        qpath, version = key
+        block_size = self.msize - 24
+        pieces = []
+        position = offset
+        end = offset + count
+        
+        # Assemble the data from the blocks that cover the range requested.
+        while position < end:
+        
+            block_offset = position - (position % block_size)
+            key = (qpath, version, block_size, block_offset)
+            block = self.cache.get(key)
+            
+            if block == None:
+                reply = self.send(styx.Tread(tag=2, fid=fid, offset=block_offset,
+                                             count=block_size))
+                block = reply.data
+                self.cache.put(key, block)
+            
+            start = position - block_offset
+            piece = block[start:start + end - position]
+            pieces.append(piece)
+            position += len(piece)
+            
+            # Stop at the end of the file.
+            if len(block) < block_size or not piece:
+                break
+        
+        return b"".join(pieces)
@@ -0,0 +1,299 @@
+#!/usr/bin/env python
+
+# codecbench.py - Measures the speed of encoding and decoding Styx messages.
+#
+# Copyright (C) 2018 David Boddie <david@boddie.org.uk>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import argparse, json, platform, sys, time, tracemalloc
+import styx
+
+class Sink:
+
+    """Collects the data sent by encode methods instead of sending it."""
+    
+    def __init__(self):
+        self.data = b""
+    
+    def sendall(self, data):
+        self.data = data
+
+
+def make_stat(i = 0):
+
+    return styx.Stat(0, 0, (0, 0, 1000 + i), 0o644, 1500000000, 1500000000,
+                     4096 + i, u"file%06i.txt" % i, u"inferno", u"inferno", u"")
+
+
+def sample_messages():
+
+    """Returns a list of (name, message) pairs with one message for each class
+    in styx.MessageTypes, plus messages carrying data of various sizes."""
+    
+    qid = (0, 1, 12345)
+    stat = make_stat()
+    
+    messages = [
+        ("Tversion", styx.Tversion(1, 8216, u"9P2000")),
+        ("Rversion", styx.Rversion(1, 8216, u"9P2000")),
+        ("Tattach", styx.Tattach(1, 0, 0xffffffff, u"inferno", u"")),
+        ("Rattach", styx.Rattach(1, qid)),
+        ("Rerror", styx.Rerror(1, u"Not found.")),
+        ("Tflush", styx.Tflush(1, 2)),
+        ("Rflush", styx.Rflush(1)),
+        ("Twalk", styx.Twalk(1, 0, 1, [u"usr", u"inferno", u"lib", u"file.txt"])),
+        ("Rwalk", styx.Rwalk(1, [qid, qid, qid, qid])),
+        ("Topen", styx.Topen(1, 1, 0)),
+        ("Ropen", styx.Ropen(1, qid, 8192)),
+        ("Tcreate", styx.Tcreate(1, 1, u"new.txt", 0o644, 1)),
+        ("Rcreate", styx.Rcreate(1, qid, 8192)),
+        ("Tread", styx.Tread(1, 1, 0, 8192)),
+        ("Rread", styx.Rread(1, b"")),
+        ("Twrite", styx.Twrite(1, 1, 0, b"")),
+        ("Rwrite", styx.Rwrite(1, 8192)),
+        ("Tclunk", styx.Tclunk(1, 1)),
+        ("Rclunk", styx.Rclunk(1)),
+        ("Tremove", styx.Tremove(1, 1)),
+        ("Rremove", styx.Rremove(1)),
+        ("Tstat", styx.Tstat(1, 1)),
+        ("Rstat", styx.Rstat(1, stat)),
+        ("Twstat", styx.Twstat(1, 1, stat)),
+        ("Rwstat", styx.Rwstat(1)),
+        ]
+    
+    for size, label in ((8192, "8K"), (65536, "64K"), (1048576, "1M")):
+        data = b"x" * size
+        messages.append(("Rread-" + label, styx.Rread(1, data)))
+        messages.append(("Twrite-" + label, styx.Twrite(1, 1, 0, data)))
+    
+    return messages
+
+
+def measure(function, min_time, repeats):
+
+    """Returns the best time per call in seconds, calling the function enough
+    times that each repeat takes at least min_time seconds."""
+    
+    number = 1
+    
+    while True:
+        started = time.perf_counter()
+        for i in range(number):
+            function()
+        elapsed = time.perf_counter() - started
+        if elapsed >= min_time:
+            break
+        number *= 2
+    
+    best = elapsed / number
+    
+    for r in range(repeats - 1):
+        started = time.perf_counter()
+        for i in range(number):
+            function()
+        best = min(best, (time.perf_counter() - started) / number)
+    
+    return best
+
+
+def run(min_time = 0.2, repeats = 3, stat_counts = (10, 1000, 100000),
+        selected = None):
+
+    results = {}
+    
+    def record(name, kind, seconds, items = 1):
+        entry = results.setdefault(name, {})
+        entry[kind + "_ns"] = seconds * 1e9 / items
+        entry[kind + "_per_s"] = items / seconds
+    
+    for name, msg in sample_messages():
+    
+        if selected and not any(s in name for s in selected):
+            continue
+        
+        sink = Sink()
+        msg.encode(sink)
+        data = sink.data
+        
+        # Check that the message survives the round trip before timing it.
+        decoded = styx.decode(data=data)
+        decoded.encode(sink)
+        if sink.data != data:
+            raise styx.StyxError("Round trip failed for %s." % name)
+        
+        record(name, "encode", measure(lambda: msg.encode(sink), min_time, repeats))
+        record(name, "decode", measure(lambda: styx.decode(data=data), min_time, repeats))
+        results[name]["bytes"] = len(data)
+    
+    for count in stat_counts:
+    
+        name = "Stat-%i" % count
+        if selected and not any(s in name for s in selected):
+            continue
+        
+        stats = [make_stat(i) for i in range(count)]
+        blob = b"".join([s.encode() for s in stats])
+        
+        # Directory blobs are timed per entry.
+        record(name, "encode", measure(lambda: b"".join([s.encode() for s in stats]),
+                                       min_time, repeats), count)
+        record(name, "decode", measure(lambda: styx.Stat().decode(data=blob),
+                                       min_time, repeats), count)
+        results[name]["bytes"] = len(blob)
+        
+        # The bulk encoder, and the lazy decoder used to list the names of
+        # the entries without decoding anything else.
+        name = "StatList-%i" % count
+        if styx.encode_stats(stats) != blob:
+            raise styx.StyxError("Bulk encoding failed for %s." % name)
+        
+        record(name, "encode", measure(lambda: styx.encode_stats(stats),
+                                       min_time, repeats), count)
+        record(name, "decode", measure(lambda: list(styx.decode_stats(blob).names()),
+                                       min_time, repeats), count)
+        results[name]["bytes"] = len(blob)
+    
+    return results
+
+
+def measure_requests(requests, pool_size = None):
+
+    """Decodes Tread requests and encodes Rread replies in the same way as a
+    server, reusing message objects if a pool size is given. Returns the time
+    per request, the average number of bytes allocated at once while handling
+    each request, and the number of bytes still allocated after handling all
+    of them. The memory use is measured with tracemalloc in a separate pass
+    so that tracing does not affect the time."""
+    
+    sink = Sink()
+    styx.Tread(1, 1, 0, 8192).encode(sink)
+    request = sink.data
+    payload = b"x" * 128
+    
+    def handle(pool):
+        msg = styx.decode(data=request, pool=pool)
+        reply = pool.new(styx.Rread, msg.tag, payload)
+        reply.encode(sink)
+        pool.put(msg)
+        pool.put(reply)
+    
+    # A pool of size 0 keeps nothing, so that new objects are allocated for
+    # each request.
+    pool = styx.MessagePool(pool_size or 0)
+    started = time.perf_counter()
+    
+    for i in range(requests):
+        handle(pool)
+    
+    elapsed = time.perf_counter() - started
+    
+    pool = styx.MessagePool(pool_size or 0)
+    peaks = 0
+    
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        for i in range(requests):
+            current = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+            handle(pool)
+            peaks += tracemalloc.get_traced_memory()[1] - current
+        retained = tracemalloc.get_traced_memory()[0] - before
+    finally:
+        tracemalloc.stop()
+    
+    return elapsed / requests, peaks / float(requests), retained
+
+
+def compare(results, baseline, threshold):
+
+    """Returns a list of descriptions of the results that are slower than
+    those in the baseline by more than the threshold, given as a fraction."""
+    
+    regressions = []
+    
+    for name, entry in sorted(results.items()):
+    
+        old = baseline.get(name)
+        if old == None:
+            continue
+        
+        for kind in ("encode_ns", "decode_ns"):
+            if kind in old and entry[kind] > old[kind] * (1 + threshold):
+                regressions.append("%s %s: %.0f ns -> %.0f ns (%+.1f%%)" % (
+                    name, kind[:6], old[kind], entry[kind],
+                    (entry[kind] / old[kind] - 1) * 100))
+    
+    return regressions
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Measure the speed of encoding and decoding Styx messages.")
+    parser.add_argument("--output", help="Write the results to this JSON file.")
+    parser.add_argument("--baseline", help="Compare the results with those in this JSON file.")
+    parser.add_argument("--threshold", type=float, default=0.1,
+                        help="The fraction by which a result can be slower than the baseline (default 0.1).")
+    parser.add_argument("--min-time", type=float, default=0.2,
+                        help="The minimum time in seconds for each measurement (default 0.2).")
+    parser.add_argument("--repeats", type=int, default=3,
+                        help="The number of times to repeat each measurement (default 3).")
+    parser.add_argument("--quick", action="store_true",
+                        help="Leave out the directory with 100000 entries.")
+    parser.add_argument("--requests", type=int, default=0,
+                        help="Also measure the time taken and memory allocated when handling this number of read requests, with and without reusing message objects.")
+    parser.add_argument("names", nargs="*",
+                        help="Only measure the messages whose names contain these strings.")
+    args = parser.parse_args()
+    
+    if args.quick:
+        stat_counts = (10, 1000)
+    else:
+        stat_counts = (10, 1000, 100000)
+    
+    results = run(args.min_time, args.repeats, stat_counts, args.names)
+    
+    for name in sorted(results):
+        entry = results[name]
+        sys.stdout.write("%-14s %9i bytes  encode %12.0f ns %12.0f/s  decode %12.0f ns %12.0f/s\n" % (
+            name, entry["bytes"], entry["encode_ns"], entry["encode_per_s"],
+            entry["decode_ns"], entry["decode_per_s"]))
+    
+    if args.requests > 0:
+        sys.stdout.write("\n%-14s %12s %14s %14s\n" % (
+            "requests", "ns/request", "bytes/request", "bytes retained"))
+        for label, size in (("new objects", None), ("pool of 4", 4)):
+            seconds, allocated, retained = measure_requests(args.requests, size)
+            sys.stdout.write("%-14s %12.0f %14.0f %14i\n" % (
+                label, seconds * 1e9, allocated, retained))
+    
+    if args.output:
+        f = open(args.output, "w")
+        json.dump({"python": platform.python_version(), "results": results},
+                  f, indent=2, sort_keys=True)
+        f.write("\n")
+        f.close()
+    
+    if args.baseline:
+        f = open(args.baseline)
+        baseline = json.load(f)["results"]
+        f.close()
+        
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            sys.stdout.write("\nRegressions of more than %.0f%%:\n" % (args.threshold * 100))
+            for line in regressions:
+                sys.stdout.write("  " + line + "\n")
+            sys.exit(1)
@@ -36,6 +36,25 @@ class DictStore:
         self.opened = {}
         self.root_fid = None
         self.now = int(time.time())
+        
+        # Directory listings, only used after preload() has been called.
+        self.listings = None
+    
+    def preload(self):
+    
+        """Builds the listings for all the directories in the dictionary. This
+        is useful before forking worker processes so that they share the
+        listings instead of building their own."""
+        
+        self.listings = {}
+        
+        def visit(path, obj):
+            self.listings[path] = self.read_dir(path, obj)
+            for key, value in obj.items():
+                if type(value) == dict:
+                    visit((path + u"/" + key).lstrip(u"/"), value)
+        
+        visit(u"", self.d)
     
     def get_root_qid(self, fid, afid, uname, aname):
     
@@ -138,23 +157,31 @@ class DictStore:
         if obj == None:
             return None
         
-        data = b""
-        
         if type(obj) == dict:
         
-            # Iterate over a sorted list of files in the directory, constructing
-            # a byte string of information about them that can be sent in chunks.
-            files = list(obj.keys())
-            files.sort()
-            
-            for file_name in files:
-                qid = self.make_qid(path + u"/" + file_name)
-                data += self._stat(qid, path + u"/" + file_name).encode()
+            if self.listings != None and path in self.listings:
+                data = self.listings[path]
+            else:
+                data = self.read_dir(path, obj)
             
             return data[offset:offset + count]
         else:
             return obj[offset:offset + count].encode("utf8")
     
+    def read_dir(self, path, obj):
+    
+        # Iterate over a sorted list of files in the directory, constructing
+        # a byte string of information about them that can be sent in chunks.
+        files = list(obj.keys())
+        files.sort()
+        
+        stats = []
+        for file_name in files:
+            qid = self.make_qid(path + u"/" + file_name)
+            stats.append(self._stat(qid, path + u"/" + file_name))
+        
+        return styx.encode_stats(stats)
+    
     def write(self, fid, offset, data):
     
         # Indicate failure to write any data.
@@ -183,13 +210,105 @@ class DictStore:
         return obj
 
 
+def benchmark(duration = 3.0, clients = 8, port = 17620):
+
+    """Serves a dictionary using increasing numbers of worker processes and
+    prints the total number of operations per second performed by a number of
+    client processes, each of which repeatedly lists a directory and reads a
+    file."""
+    
+    import client, os, signal
+    
+    dictionary = {u"dir": dict((u"file%i" % i, u"x" * 100) for i in range(100))}
+    
+    for workers in (1, 2, 4, 8):
+    
+        pid = os.fork()
+        if pid == 0:
+            store = DictStore(dictionary)
+            store.preload()
+            styxserver.StyxServer(store).serve_workers("127.0.0.1", port, workers, True)
+            os._exit(0)
+        
+        time.sleep(0.5)
+        
+        # All the clients stop at the same time.
+        end = time.time() + duration
+        
+        pipes = []
+        for i in range(clients):
+            r, w = os.pipe()
+            if os.fork() == 0:
+                os.close(r)
+                c = client.Client("127.0.0.1", port, u"", u"")
+                f = c.open("dir/file0", 0)
+                ops = 0
+                while time.time() < end:
+                    c.ls("dir")
+                    f.read(0, 100)
+                    ops += 2
+                os.write(w, str(ops).encode("ascii"))
+                os._exit(0)
+            os.close(w)
+            pipes.append(r)
+        
+        total = 0
+        for r in pipes:
+            total += int(os.read(r, 32) or 0)
+            os.close(r)
+            os.wait()
+        
+        os.kill(pid, signal.SIGTERM)
+        os.waitpid(pid, 0)
+        
+        print("%i worker(s): %8.0f ops/s" % (workers, total / duration))
+        port += 1
+
+
 if __name__ == "__main__":
 
-    if len(sys.argv) != 2:
-        sys.stderr.write("Usage: %s <port>\n" % sys.argv[0])
+    args = sys.argv[1:]
+    workers = 0
+    recorder = None
+    stats = False
+    spans = None
+    profile = None
+    limits = None
+    
+    if args == ["--benchmark"]:
+        benchmark()
+        sys.exit()
+    
+    while len(args) > 1 and args[0] in ("--workers", "--trace", "--stats",
+                                            "--spans", "--profile", "--limits"):
+        if args[0] == "--stats":
+            stats = True
+            args = args[1:]
+            continue
+        elif args[0] == "--workers":
+            workers = int(args[1])
+        elif args[0] == "--spans":
+            spans = args[1]
+        elif args[0] == "--profile":
+            profile = args[1]
+        elif args[0] == "--limits":
+            limits = args[1]
+        else:
+            import styxtrace
+            recorder = styxtrace.TraceRecorder(args[1])
+        args = args[2:]
+    
+    if len(args) != 1:
+        sys.stderr.write("Usage: %s [--workers <number>] [--trace <file>] [--stats] [--spans <file>] [--profile <file>] [--limits <name>=<value>,...] (<port> | unix:<path>)\n" % sys.argv[0])
+        sys.stderr.write("       %s --benchmark\n" % sys.argv[0])
         sys.exit(1)
     
-    port = int(sys.argv[1])
+    # The port can also be given as unix:<path> to listen on a Unix domain
+    # socket instead.
+    if args[0].startswith("unix:"):
+        host, port = args[0][5:], None
+    else:
+        host, port = b"", int(args[0])
     
     dictionary = {
         u"dir": {
@@ -199,5 +318,40 @@ if __name__ == "__main__":
         }
     
     store = DictStore(dictionary)
-    server = styxserver.StyxServer(store)
-    server.serve(b"", port)
+    server = styxserver.StyxServer(store, recorder)
+    
+    if limits != None:
+        server.parse_limits(limits)
+    
+    if stats:
+        server.enable_metrics()
+    
+    if spans != None:
+        import styxspans
+        collector = styxspans.SpanCollector()
+        exporter = styxspans.ChromeTraceExporter()
+        server.enable_tracing(styxspans.HookList([collector, exporter]))
+    
+    if profile != None:
+        # Profile the server when it receives SIGUSR1 or when "start" is
+        # written to the control file, until the same happens again.
+        import styxprofile
+        styxprofile.ProfilerControl(styxprofile.SamplingProfiler(), profile,
+                                    control=profile + ".control")
+    
+    try:
+        if workers > 0:
+            # Build the listings before forking so that the workers share them.
+            store.preload()
+            server.serve_workers(host, port, workers)
+        elif port == None:
+            server.serve_unix(host)
+        else:
+            server.serve(host, port)
+    finally:
+        if recorder != None:
+            recorder.close()
+        if spans != None:
+            # Write the phases in the Chrome trace format and summarise them.
+            exporter.write(spans)
+            sys.stderr.write(collector.report())
@@ -0,0 +1,736 @@
+#!/usr/bin/env python
+
+# loadgen.py - Generates load for a Styx server and measures its latency.
+#
+# Copyright (C) 2018 David Boddie <david@boddie.org.uk>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import argparse, json, os, queue, random, shutil, signal, socket, sys
+import tempfile, threading, time
+import client, styx, styxserver
+
+OPERATIONS = ("walk", "stat", "ls", "read", "write")
+
+class LoadError(Exception):
+    pass
+
+
+class SyntheticStore:
+
+    """Serves a tree of directories containing files of a fixed size without
+    storing any of them, so that as little time as possible is spent in the
+    store. Data written to the files is discarded.
+    """
+    
+    def __init__(self, dirs, files, size):
+    
+        self.dirs = dirs
+        self.files = files
+        self.data = b"x" * size
+        
+        self.qids = {}
+        self.paths = {}
+        self.opened = {}
+        self.root_fid = None
+        self.now = int(time.time())
+        self.listings = {}
+    
+    def get_root_qid(self, fid, afid, uname, aname):
+    
+        qid = self.make_qid(u"/")
+        self.set_qid_path(fid, qid, u"/")
+        self.root_fid = fid
+        return qid
+    
+    def get_qid_path(self, fid):
+    
+        return self.qids[fid], self.paths[fid]
+    
+    def set_qid_path(self, fid, qid, path):
+    
+        path = path.lstrip(u"/")
+        
+        self.qids[fid] = qid
+        self.paths[fid] = path
+    
+    def make_qid(self, path):
+    
+        indices = self._lookup(path)
+        if indices == None:
+            return None
+        
+        d, f = indices
+        
+        if d == None:
+            return (0x80, 0, 0)
+        elif f == None:
+            return (0x80, 0, d + 1)
+        else:
+            return (0, 0, ((d + 1) << 32) | (f + 1))
+    
+    def free_qid_path(self, fid):
+    
+        del self.qids[fid]
+        del self.paths[fid]
+        
+        if fid in self.opened:
+            del self.opened[fid]
+    
+    def stat(self, fid):
+    
+        return self._stat(self.qids[fid], self.paths[fid])
+    
+    def _stat(self, qid, path):
+    
+        if qid[0] & 0x80:
+            mode = styx.Stat.DMDIR | 0o755
+            size = 0
+        else:
+            mode = 0o644
+            size = len(self.data)
+        
+        return styx.Stat(0, 0, qid, mode, self.now, self.now, size,
+                         path.split(u"/")[-1], u"styx", u"styx", u"")
+    
+    def create(self, fid, name, perm):
+        return False
+    
+    def open(self, fid, mode):
+    
+        self.opened[fid] = mode
+        return True
+    
+    def is_opened(self, fid):
+    
+        return fid in self.opened
+    
+    def read(self, fid, offset, count):
+    
+        path = self.paths[fid]
+        
+        if self.qids[fid][0] & 0x80:
+            data = self.listings.get(path)
+            if data == None:
+                data = self.listings[path] = self._listing(path)
+            return data[offset:offset + count]
+        
+        return self.data[offset:offset + count]
+    
+    def write(self, fid, offset, data):
+    
+        if self.qids[fid][0] & 0x80:
+            return -1
+        
+        return len(data)
+    
+    def remove(self, fid):
+        return u"Cannot remove synthetic files."
+    
+    def wstat(self, fid, st):
+        pass
+    
+    def _lookup(self, path):
+    
+        # Returns the directory and file indices for the path, with None for
+        # those that the path does not include, or None if it is not valid.
+        path = path.lstrip(u"/")
+        if path == u"":
+            return None, None
+        
+        elements = path.split(u"/")
+        if len(elements) > 2:
+            return None
+        
+        indices = []
+        for element, prefix, limit in zip(elements, u"df", (self.dirs, self.files)):
+            if element[:1] != prefix or not element[1:].isdigit():
+                return None
+            i = int(element[1:])
+            if i >= limit:
+                return None
+            indices.append(i)
+        
+        indices.append(None)
+        return indices[0], indices[1]
+    
+    def _listing(self, path):
+    
+        if path == u"":
+            names = [u"d%i" % i for i in range(self.dirs)]
+        else:
+            names = [u"f%i" % i for i in range(self.files)]
+        
+        stats = []
+        for name in names:
+            child = (path + u"/" + name).lstrip(u"/")
+            stats.append(self._stat(self.make_qid(child), child))
+        
+        return styx.encode_stats(stats)
+
+
+class Connection:
+
+    """Sends requests from several threads over a single connection, with up
+    to one request outstanding for each tag, and passes replies back to the
+    threads that are waiting for them."""
+    
+    def __init__(self, host, port, msize):
+    
+        # Use a client to negotiate the version and attach to the root of the
+        # server, which is given fid 0.
+        self.client = client.Client()
+        self.client.msize = msize
+        self.client.connect(host, port, u"", u"")
+        
+        self.socket = self.client.socket
+        self.msize = self.client.msize
+        
+        self.send_lock = threading.Lock()
+        self.waiting = {}
+        
+        self.thread = threading.Thread(target=self.read_replies)
+        self.thread.daemon = True
+        self.thread.start()
+    
+    def call(self, msg, event):
+    
+        # Each tag is used by only one thread, which waits on its own event.
+        slot = self.waiting[msg.tag] = [event, None]
+        event.clear()
+        
+        self.send_lock.acquire()
+        try:
+            msg.encode(self.socket)
+        finally:
+            self.send_lock.release()
+        
+        event.wait()
+        reply = slot[1]
+        
+        if reply == None:
+            raise LoadError("Connection closed.")
+        elif isinstance(reply, styx.Rerror):
+            raise LoadError(reply.ename)
+        
+        return reply
+    
+    def read_replies(self):
+    
+        while True:
+        
+            try:
+                reply = styx.decode(sock=self.socket)
+            except (EOFError, socket.error):
+                break
+            
+            slot = self.waiting.get(reply.tag)
+            if slot != None:
+                slot[1] = reply
+                slot[0].set()
+        
+        # Wake any threads that are still waiting.
+        for slot in list(self.waiting.values()):
+            slot[0].set()
+    
+    def close(self):
+    
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+            self.socket.close()
+        except socket.error:
+            pass
+
+
+class Worker:
+
+    """Performs operations on a connection using its own tag and fids, so
+    that the workers sharing a connection can have requests outstanding at
+    the same time."""
+    
+    def __init__(self, connection, tag, index, options):
+    
+        self.connection = connection
+        self.tag = tag
+        self.options = options
+        self.event = threading.Event()
+        self.random = random.Random(options.seed + index)
+        
+        # Four fids for each worker on the connection, after the root fid.
+        base = 1 + tag * 4
+        self.walk_fid = base
+        self.read_fid = base + 1
+        self.write_fid = base + 2
+        self.dir_fid = base + 3
+        
+        # Open a file for reading and one for writing, if needed.
+        self.path = self._file_path()
+        self._call(styx.Twalk(fid=0, newfid=self.read_fid, wname=self.path))
+        self._call(styx.Topen(fid=self.read_fid, mode=0))
+        
+        if options.weights.get("write"):
+            self._call(styx.Twalk(fid=0, newfid=self.write_fid, wname=self.path))
+            self._call(styx.Topen(fid=self.write_fid, mode=1))
+        
+        self.data = b"w" * options.size
+        self.latencies = dict((op, []) for op in OPERATIONS)
+        self.errors = dict((op, 0) for op in OPERATIONS)
+    
+    def _call(self, msg):
+    
+        msg.tag = self.tag
+        return self.connection.call(msg, self.event)
+    
+    def _file_path(self):
+    
+        return [u"d%i" % self.random.randrange(self.options.dirs),
+                u"f%i" % self.random.randrange(self.options.files)]
+    
+    def choose(self):
+    
+        return weighted_choice(self.random, self.options.weights)
+    
+    def perform(self, op):
+    
+        getattr(self, op)()
+    
+    def walk(self):
+    
+        self._call(styx.Twalk(fid=0, newfid=self.walk_fid, wname=self._file_path()))
+        self._call(styx.Tclunk(fid=self.walk_fid))
+    
+    def stat(self):
+    
+        self._call(styx.Tstat(fid=self.read_fid))
+    
+    def ls(self):
+    
+        wname = [u"d%i" % self.random.randrange(self.options.dirs)]
+        self._call(styx.Twalk(fid=0, newfid=self.dir_fid, wname=wname))
+        try:
+            self._call(styx.Topen(fid=self.dir_fid, mode=0))
+            
+            offset = 0
+            count = self.connection.msize - 24
+            while True:
+                reply = self._call(styx.Tread(fid=self.dir_fid, offset=offset,
+                                              count=count))
+                if not reply.data:
+                    break
+                offset += len(reply.data)
+        finally:
+            self._call(styx.Tclunk(fid=self.dir_fid))
+    
+    def read(self):
+    
+        self._call(styx.Tread(fid=self.read_fid, offset=0, count=self.options.size))
+    
+    def write(self):
+    
+        self._call(styx.Twrite(fid=self.write_fid, offset=0, data=self.data))
+    
+    def record(self, op, scheduled, finished, failed, start, end):
+    
+        # Only operations that were due during the measurement period count.
+        if start <= scheduled < end:
+            if failed:
+                self.errors[op] += 1
+            else:
+                self.latencies[op].append(finished - scheduled)
+    
+    def run_closed(self, start, end):
+    
+        # Start each operation as soon as the previous one has finished.
+        while True:
+        
+            op = self.choose()
+            scheduled = time.perf_counter()
+            if scheduled >= end:
+                break
+            
+            failed = False
+            try:
+                self.perform(op)
+            except LoadError:
+                failed = True
+            
+            self.record(op, scheduled, time.perf_counter(), failed, start, end)
+    
+    def run_open(self, requests, start, end):
+    
+        # Perform operations when they are due, measuring their latency from
+        # the time they were due rather than the time they were started, so
+        # that delays caused by a slow server are included.
+        self.unfinished = 0
+        
+        while True:
+        
+            item = requests.get()
+            if item == None:
+                break
+            
+            scheduled, op = item
+            if time.perf_counter() >= end + self.options.drain:
+                # Give up on operations that are too far behind.
+                self.unfinished += 1
+                continue
+            
+            failed = False
+            try:
+                self.perform(op)
+            except LoadError:
+                failed = True
+            
+            self.record(op, scheduled, time.perf_counter(), failed, start, end)
+
+
+def weighted_choice(rand, weights):
+
+    value = rand.random() * sum(weights.values())
+    
+    for op in OPERATIONS:
+        value -= weights.get(op, 0)
+        if value < 0:
+            return op
+    
+    return op
+
+
+def schedule(requests, options, index, count, begin, start, end):
+
+    """Puts operations into the queue for a connection at the times they are
+    due, with the rate increasing linearly until the start of the measurement
+    period. The scheduler for each connection is offset from the others so
+    that the connections do not send requests at the same moments."""
+    
+    rand = random.Random(options.seed + 0x10000 + index)
+    rate = options.rate / float(count)
+    due = begin + float(index) / options.rate
+    
+    while due < end:
+    
+        now = time.perf_counter()
+        if due > now:
+            time.sleep(due - now)
+        
+        requests.put((due, weighted_choice(rand, options.weights)))
+        
+        if due < start:
+            fraction = max((due - begin) / (start - begin), 0.01)
+        else:
+            fraction = 1.0
+        
+        due += 1.0 / (rate * fraction)
+    
+    for i in range(options.depth):
+        requests.put(None)
+
+
+def make_tree(dirs, files, size):
+
+    return dict((u"d%i" % d, dict((u"f%i" % f, u"x" * size)
+                                  for f in range(files)))
+                for d in range(dirs))
+
+
+def make_store(options):
+
+    """Returns a store of the kind requested in the options, and the name of a
+    temporary directory to remove afterwards, if any."""
+    
+    if options.store == "synthetic":
+        return SyntheticStore(options.dirs, options.files, options.file_size), None
+    
+    tree = make_tree(options.dirs, options.files, options.file_size)
+    
+    if options.store == "dict":
+        import dictserver
+        store = dictserver.DictStore(tree)
+        store.preload()
+        return store, None
+    
+    import localfileserver
+    
+    directory = tempfile.mkdtemp(prefix="loadgen-")
+    
+    for dir_name, files in tree.items():
+        os.mkdir(os.path.join(directory, dir_name))
+        for file_name, contents in files.items():
+            f = open(os.path.join(directory, dir_name, file_name), "w")
+            f.write(contents)
+            f.close()
+    
+    return localfileserver.FileStore(directory), directory
+
+
+def start_server(options):
+
+    """Forks a process that serves the requested store on the loopback
+    interface, returning its process id and port."""
+    
+    store, directory = make_store(options)
+    server = styxserver.StyxServer(store)
+    
+    if options.message_pools > 0:
+        server.enable_message_pools(options.message_pools)
+    
+    if options.server_workers > 0:
+        # Find a free port for the workers to listen on.
+        s = socket.socket()
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+        s.close()
+        s = None
+    else:
+        s = server.listen("127.0.0.1", 0)
+        port = s.getsockname()[1]
+    
+    pid = os.fork()
+    if pid == 0:
+        try:
+            if s == None:
+                server.serve_workers("127.0.0.1", port, options.server_workers, True)
+            else:
+                server.accept(s, True)
+        finally:
+            os._exit(0)
+    
+    if s != None:
+        s.close()
+    
+    return pid, port, directory
+
+
+def connect(port, msize, timeout = 5.0):
+
+    # Wait for the server to start listening.
+    give_up = time.time() + timeout
+    
+    while True:
+        try:
+            return Connection("127.0.0.1", port, msize)
+        except client.ClientError:
+            if time.time() > give_up:
+                raise
+            time.sleep(0.05)
+
+
+def percentile(values, p):
+
+    # The values must be sorted.
+    if not values:
+        return None
+    
+    index = int(round(p / 100.0 * (len(values) - 1)))
+    return values[index]
+
+
+def run(options):
+
+    pid, port, directory = start_server(options)
+    
+    try:
+        msize = max(client.Client.MSIZE, options.size + 24)
+        connections = [connect(port, msize) for i in range(options.connections)]
+        
+        workers = []
+        for c in connections:
+            for i in range(options.depth):
+                workers.append((c, Worker(c, i, len(workers), options)))
+        
+        begin = time.perf_counter() + 0.1
+        start = begin + options.ramp
+        end = start + options.duration
+        threads = []
+        
+        if options.rate > 0:
+            # Open loop: each connection has a scheduler that queues operations
+            # for its workers at a fixed rate.
+            for index, c in enumerate(connections):
+                requests = queue.Queue()
+                threads.append(threading.Thread(target=schedule,
+                    args=(requests, options, index, len(connections), begin, start, end)))
+                for wc, worker in workers:
+                    if wc == c:
+                        threads.append(threading.Thread(target=worker.run_open,
+                                                        args=(requests, start, end)))
+        else:
+            # Closed loop: the connections start one after another during the
+            # ramp period.
+            for index, (c, worker) in enumerate(workers):
+                delay = options.ramp * (index // options.depth) / float(len(connections))
+                threads.append(threading.Thread(target=worker.run_closed,
+                                                args=(start, end)))
+                threads[-1].delay = begin + delay
+        
+        for t in threads:
+            t.daemon = True
+        
+        for t in sorted(threads, key=lambda t: getattr(t, "delay", begin)):
+            now = time.perf_counter()
+            due = getattr(t, "delay", begin)
+            if due > now:
+                time.sleep(due - now)
+            t.start()
+        
+        for t in threads:
+            t.join()
+        
+        for c in connections:
+            c.close()
+    
+    finally:
+        os.kill(pid, signal.SIGTERM)
+        os.waitpid(pid, 0)
+        if directory != None:
+            shutil.rmtree(directory)
+    
+    return summarise(options, [w for c, w in workers])
+
+
+def summarise(options, workers):
+
+    results = {"operations": {}}
+    total = 0
+    
+    for op in OPERATIONS:
+    
+        latencies = []
+        errors = 0
+        for worker in workers:
+            latencies += worker.latencies[op]
+            errors += worker.errors[op]
+        
+        if not latencies and not errors:
+            continue
+        
+        latencies.sort()
+        total += len(latencies)
+        
+        entry = results["operations"][op] = {
+            "count": len(latencies),
+            "errors": errors,
+            "ops_per_s": len(latencies) / options.duration
+            }
+        
+        for name, p in (("p50", 50), ("p90", 90), ("p99", 99), ("p999", 99.9)):
+            entry[name + "_ms"] = percentile(latencies, p) * 1000 if latencies else None
+        
+        if latencies:
+            entry["mean_ms"] = sum(latencies) / len(latencies) * 1000
+            entry["max_ms"] = latencies[-1] * 1000
+        else:
+            entry["mean_ms"] = entry["max_ms"] = None
+    
+    results["count"] = total
+    results["ops_per_s"] = total / options.duration
+    results["unfinished"] = sum(getattr(w, "unfinished", 0) for w in workers)
+    
+    return results
+
+
+def parse_mix(text):
+
+    weights = {}
+    
+    for item in text.split(","):
+        op, sep, weight = item.partition("=")
+        op = op.strip()
+        if op not in OPERATIONS:
+            raise ValueError("Unknown operation '%s'." % op)
+        weights[op] = float(weight or 1)
+    
+    if sum(weights.values()) <= 0:
+        raise ValueError("The mix must contain at least one operation.")
+    
+    return weights
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Start a Styx server on the loopback interface, generate load for it and report the latency of each kind of operation.")
+    parser.add_argument("--store", choices=("synthetic", "dict", "file"), default="synthetic",
+                        help="The kind of store to serve (default synthetic).")
+    parser.add_argument("--server-workers", type=int, default=0,
+                        help="Serve using this number of worker processes (default 0, one process).")
+    parser.add_argument("--message-pools", type=int, default=0,
+                        help="Make the server reuse up to this number of message objects of each type for each connection (default 0, no reuse).")
+    parser.add_argument("--connections", type=int, default=4,
+                        help="The number of client connections (default 4).")
+    parser.add_argument("--depth", type=int, default=1,
+                        help="The number of requests that can be outstanding on each connection (default 1).")
+    parser.add_argument("--mix", default="read=50,stat=20,walk=20,ls=10",
+                        help="Relative weights of the operations performed (default read=50,stat=20,walk=20,ls=10).")
+    parser.add_argument("--duration", type=float, default=10.0,
+                        help="The length of the measurement period in seconds (default 10).")
+    parser.add_argument("--ramp", type=float, default=0.0,
+                        help="The time in seconds over which the load increases before it is measured (default 0).")
+    parser.add_argument("--rate", type=float, default=0.0,
+                        help="Start operations at this total rate per second instead of as soon as the previous ones finish.")
+    parser.add_argument("--drain", type=float, default=5.0,
+                        help="The time in seconds after the end of an open loop run to wait for late operations (default 5).")
+    parser.add_argument("--size", type=int, default=8192,
+                        help="The number of bytes to read or write in each operation (default 8192).")
+    parser.add_argument("--file-size", type=int, default=8192,
+                        help="The size of the files served (default 8192).")
+    parser.add_argument("--dirs", type=int, default=10,
+                        help="The number of directories served (default 10).")
+    parser.add_argument("--files", type=int, default=100,
+                        help="The number of files in each directory (default 100).")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="The seed used to choose operations and files (default 0).")
+    parser.add_argument("--output", help="Write the configuration and results to this JSON file.")
+    options = parser.parse_args()
+    
+    try:
+        options.weights = parse_mix(options.mix)
+    except ValueError as e:
+        parser.error(str(e))
+    
+    if options.store == "dict" and options.weights.get("write"):
+        parser.error("The dict store does not support writing.")
+    if options.connections < 1 or not 1 <= options.depth < client.Client.FLUSH_TAG:
+        parser.error("There must be at least one connection and one request on each.")
+    
+    results = run(options)
+    
+    sys.stdout.write("%-6s %9s %7s %10s %9s %9s %9s %9s %9s\n" % (
+        "op", "count", "errors", "ops/s", "p50 ms", "p90 ms", "p99 ms", "p999 ms", "max ms"))
+    
+    for op in OPERATIONS:
+        entry = results["operations"].get(op)
+        if entry == None:
+            continue
+        
+        values = []
+        for name in ("p50_ms", "p90_ms", "p99_ms", "p999_ms", "max_ms"):
+            if entry[name] == None:
+                values.append("%9s" % "-")
+            else:
+                values.append("%9.3f" % entry[name])
+        
+        sys.stdout.write("%-6s %9i %7i %10.1f %s\n" % (
+            op, entry["count"], entry["errors"], entry["ops_per_s"], " ".join(values)))
+    
+    sys.stdout.write("total  %9i %7s %10.1f\n" % (results["count"], "", results["ops_per_s"]))
+    
+    if results["unfinished"]:
+        sys.stdout.write("%i operations were not performed because the server fell too far behind.\n" % results["unfinished"])
+    
+    if options.output:
+        config = dict(vars(options))
+        f = open(options.output, "w")
+        json.dump({"config": config, "results": results}, f, indent=2, sort_keys=True)
+        f.write("\n")
+        f.close()
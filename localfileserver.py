@@ -17,9 +17,52 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import locale, os, stat, sys
+import locale, os, queue, stat, sys, threading, time
 import styx, styxserver
 
+def advise(fd, offset, length, advice):
+
+    # Not all systems let programs advise the kernel about how they will use
+    # files. On those that do not, only the kernel's own read-ahead is used.
+    if hasattr(os, "posix_fadvise"):
+        os.posix_fadvise(fd, offset, length, getattr(os, advice))
+
+
+class ReadAhead:
+
+    """Records how an open file is being read, so that sequential reads can be
+    detected, and how far ahead of them the kernel has been asked to read."""
+    
+    def __init__(self, fd):
+    
+        self.fd = fd
+        # The offset that the next read will start at if reads are sequential,
+        # and the number of reads in a row that have been sequential.
+        self.next = None
+        self.run = 0
+        # The number of bytes to read ahead of the last read, and the offset
+        # that the kernel has been asked to read up to.
+        self.window = 0
+        self.issued = 0
+        self.random = False
+        # Held while the kernel is being asked to read ahead, so that the
+        # file is not closed at the same time.
+        self.lock = threading.Lock()
+
+
+class WriteBuffer:
+
+    """Holds data written to a file that has not yet been written to it,
+    starting at the given offset."""
+    
+    def __init__(self, path, offset, data):
+    
+        self.path = path
+        self.offset = offset
+        self.data = bytearray(data)
+        self.created = time.time()
+
+
 class FileStore:
 
     """Maintains information about files and directories beneath the specified
@@ -27,14 +70,96 @@ class FileStore:
     identifiers.
     """
     
-    def __init__(self, directory):
+    def __init__(self, directory, read_only = False):
     
         self.dir = os.path.abspath(directory)
+        self.read_only = read_only
         self.qids = {}
         self.paths = {}
         self.opened = {}
         self.root_fid = None
         self.encoding = sys.getfilesystemencoding()
+        
+        # Caches of qids and directory listings, only used after preload()
+        # has been called.
+        self.qid_cache = None
+        self.listings = None
+        
+        # Hits and misses for each of the caches.
+        self.hits = {u"qid": 0, u"listing": 0}
+        self.misses = {u"qid": 0, u"listing": 0}
+        
+        # Information about how each open file is being read, only used after
+        # enable_prefetch() has been called.
+        self.read_ahead = None
+        
+        # Buffers of data written to each fid, only used after
+        # enable_write_back() has been called.
+        self.write_buffers = None
+    
+    def enable_prefetch(self, max_window = 4194304, max_memory = 67108864):
+    
+        """Detects when files are read sequentially and asks the kernel to read
+        the data that will be requested next before it is needed. The amount
+        read ahead of each file doubles with each sequential read up to
+        max_window bytes, and the total for all files is limited to max_memory
+        bytes. Reads at other offsets stop the file from being read ahead.
+        Each open file is kept open until its fid is clunked."""
+        
+        self.read_ahead = {}
+        self.max_window = max_window
+        self.max_memory = max_memory
+        self.prefetch_memory = 0
+        self.prefetch_lock = threading.Lock()
+        
+        # Requests to read ahead are made by a thread so that reads are not
+        # delayed by them. It is started when it is first needed, so that
+        # worker processes each have their own.
+        self.prefetch_queue = None
+        self.prefetch_pid = None
+        
+        self.hits[u"prefetch"] = 0
+        self.misses[u"prefetch"] = 0
+    
+    def enable_write_back(self, max_size = 1048576, max_age = 1.0):
+    
+        """Collects data written to each fid in a buffer, merging writes that
+        are adjacent to or overlap the data already buffered, instead of
+        writing to the file each time. The buffer is written to the file when
+        it holds max_size bytes or is max_age seconds old, when a write is made
+        elsewhere in the file, and before the file or its directory is read,
+        its information is read or changed, or it is removed or clunked.
+        
+        Errors that occur when buffers are written are reported on stderr
+        because the client has already been told that the write succeeded.
+        Buffers are not shared between worker processes, so reads made by
+        other workers may not see the buffered data until it is written.
+        Without write-back, each write is made before it is acknowledged."""
+        
+        self.write_buffers = {}
+        self.max_buffer = max_size
+        self.max_age = max_age
+        self.write_lock = threading.Lock()
+        self.flusher_pid = None
+    
+    def preload(self):
+    
+        """Builds caches of qids and directory listings for the whole tree.
+        This is intended for trees that are only changed through this store
+        in this process, since changes are only removed from its own copy of
+        the caches. Worker processes can share the caches if the store is
+        read-only, so that no worker changes the tree."""
+        
+        self.qid_cache = {}
+        self.listings = {}
+        
+        for dirpath, dirnames, filenames in os.walk(self.dir):
+        
+            path = os.path.relpath(dirpath, self.dir)
+            if path == os.curdir:
+                path = u""
+            
+            self.read_dir(path)
     
     def get_root_qid(self, fid, afid, uname, aname):
     
@@ -58,6 +183,19 @@ class FileStore:
     
         path = path.lstrip(u"/")
         
+        if self.qid_cache != None:
+            qid = self.qid_cache.get(path)
+            if qid == None:
+                self.misses[u"qid"] += 1
+                qid = self.qid_cache[path] = self._make_qid(path)
+            else:
+                self.hits[u"qid"] += 1
+            return qid
+        
+        return self._make_qid(path)
+    
+    def _make_qid(self, path):
+    
         real_path = os.path.join(self.dir, path).encode(self.encoding)
         
         try:
@@ -80,16 +218,32 @@ class FileStore:
     
     def free_qid_path(self, fid):
     
+        if self.write_buffers != None:
+            self._flush_writes(lambda fid_, buf: fid_ == fid)
+        
         del self.qids[fid]
         del self.paths[fid]
         
         if fid in self.opened:
             del self.opened[fid]
+        
+        if self.read_ahead != None:
+            state = self.read_ahead.pop(fid, None)
+            if state != None:
+                self._resize_window(state, 0)
+                state.lock.acquire()
+                os.close(state.fd)
+                state.fd = None
+                state.lock.release()
     
     def stat(self, fid):
     
         qid = self.qids[fid]
         path = self.paths[fid]
+        
+        if self.write_buffers != None:
+            self._flush_writes(lambda fid_, buf: buf.path == path)
+        
         return self._stat(qid, path)
     
     def _stat(self, qid, path):
@@ -118,7 +272,7 @@ class FileStore:
     
     def create(self, fid, name, perm):
     
-        if name in (u".", u".."):
+        if self.read_only or name in (u".", u".."):
             return False
         
         elif fid in self.opened:
@@ -153,6 +307,8 @@ class FileStore:
             except OSError:
                 return False
             
+            self.invalidate(os.path.join(path, name))
+            
             # Update the fid to refer to the new object.
             qid = self.make_qid(path + u"/" + name)
             self.set_qid_path(fid, qid, path + u"/" + name)
@@ -161,6 +317,10 @@ class FileStore:
     
     def open(self, fid, mode):
     
+        # Refuse to open files for writing or truncation if read-only.
+        if self.read_only and (mode & 3 in (1, 2) or mode & 0x10):
+            return False
+        
         if fid in self.opened:
             self.opened[fid] = mode
             if mode & styx.Stat.DMEXCL:
@@ -168,6 +328,25 @@ class FileStore:
         else:
             self.opened[fid] = mode
         
+        if mode & 0x10:
+            # Truncate files opened with OTRUNC.
+            path = self.paths[fid]
+            real_path = os.path.join(self.dir, path).encode(self.encoding)
+            
+            if self.write_buffers != None:
+                self._flush_writes(lambda fid_, buf: buf.path == path)
+            
+            if not os.path.isdir(real_path):
+                try:
+                    f = open(real_path, "r+b")
+                    f.truncate()
+                    f.close()
+                except (IOError, OSError):
+                    del self.opened[fid]
+                    return False
+                
+                self.invalidate(path)
+        
         return True
     
     def is_opened(self, fid):
@@ -180,18 +359,14 @@ class FileStore:
         real_path = os.path.join(self.dir, path)
         data = b""
         
-        if os.path.isdir(real_path):
+        if self.write_buffers != None:
+            # Write any data for the file, or the files in the directory.
+            self._flush_writes(lambda fid_, buf: path in (buf.path, os.path.split(buf.path)[0]))
         
-            # Iterate over a sorted list of files in the directory, constructing
-            # a byte string of information about them that can be sent in chunks.
-            files = os.listdir(real_path)
-            files.sort()
-            
-            for file_name in files:
-                qid = self.make_qid(path + u"/" + file_name)
-                data += self._stat(qid, path + u"/" + file_name).encode()
-            
-            return data[offset:offset + count]
+        if os.path.isdir(real_path):
+            return self.read_dir(path)[offset:offset + count]
+        elif self.read_ahead != None:
+            return self._read_ahead(fid, real_path, offset, count)
         else:
             f = open(real_path, "rb")
             f.seek(offset)
@@ -200,26 +375,254 @@ class FileStore:
             
             return data
     
+    def _read_ahead(self, fid, real_path, offset, count):
+    
+        state = self.read_ahead.get(fid)
+        if state == None:
+            fd = os.open(real_path.encode(self.encoding), os.O_RDONLY)
+            state = self.read_ahead[fid] = ReadAhead(fd)
+        
+        if offset == state.next:
+            state.run += 1
+            if offset + count <= state.issued:
+                self.hits[u"prefetch"] += 1
+            else:
+                self.misses[u"prefetch"] += 1
+        else:
+            state.run = 0
+            state.issued = 0
+            self._resize_window(state, 0)
+            
+            # Tell the kernel not to read ahead of reads at random offsets,
+            # except for the first read.
+            if state.next != None and not state.random:
+                advise(state.fd, 0, 0, "POSIX_FADV_RANDOM")
+                state.random = True
+        
+        data = os.pread(state.fd, count, offset)
+        end = state.next = offset + len(data)
+        
+        if state.run > 0 and len(data) == count:
+            if state.random:
+                advise(state.fd, 0, 0, "POSIX_FADV_NORMAL")
+                state.random = False
+            
+            self._resize_window(state, min(max(state.window * 2, count * 4),
+                                           self.max_window))
+            
+            # Ask for more data to be read once less than half the window is
+            # left, so that the kernel is asked for large pieces at a time.
+            start = max(state.issued, end)
+            stop = end + state.window
+            if stop - start >= state.window // 2 and stop > start:
+                self._prefetch(state, start, stop - start)
+                state.issued = stop
+        
+        return data
+    
+    def _prefetch(self, state, offset, length):
+    
+        if self.prefetch_pid != os.getpid():
+            self.prefetch_pid = os.getpid()
+            self.prefetch_queue = queue.Queue()
+            t = threading.Thread(target=self._prefetch_thread,
+                                 args=(self.prefetch_queue,))
+            t.daemon = True
+            t.start()
+        
+        self.prefetch_queue.put((state, offset, length))
+    
+    def _prefetch_thread(self, requests):
+    
+        while True:
+        
+            state, offset, length = requests.get()
+            
+            state.lock.acquire()
+            try:
+                if state.fd != None:
+                    advise(state.fd, offset, length, "POSIX_FADV_WILLNEED")
+            finally:
+                state.lock.release()
+    
+    def _resize_window(self, state, size):
+    
+        # Only grow the window as far as the memory limit allows.
+        self.prefetch_lock.acquire()
+        try:
+            size = max(min(size, state.window + self.max_memory - self.prefetch_memory), 0)
+            self.prefetch_memory += size - state.window
+            state.window = size
+        finally:
+            self.prefetch_lock.release()
+    
+    def read_dir(self, path):
+    
+        real_path = os.path.join(self.dir, path)
+        
+        # Use the cached listing if the directory has not changed since it
+        # was made.
+        if self.listings != None:
+            mtime = os.stat(real_path).st_mtime
+            cached = self.listings.get(path)
+            if cached != None and cached[0] == mtime:
+                self.hits[u"listing"] += 1
+                return cached[1]
+            self.misses[u"listing"] += 1
+        
+        # Iterate over a sorted list of files in the directory, constructing
+        # a byte string of information about them that can be sent in chunks.
+        files = os.listdir(real_path)
+        files.sort()
+        
+        stats = []
+        
+        for file_name in files:
+            file_path = os.path.join(path, file_name)
+            qid = self.make_qid(file_path)
+            stats.append(self._stat(qid, file_path))
+        
+        data = styx.encode_stats(stats)
+        
+        if self.listings != None:
+            self.listings[path] = (mtime, data)
+        
+        return data
+    
+    def cache_counters(self):
+    
+        """Returns a dictionary mapping the name of each cache to its numbers
+        of hits and misses."""
+        
+        return dict((name, (self.hits[name], self.misses[name])) for name in self.hits)
+    
+    def invalidate(self, path):
+    
+        # Remove cached information about the path, anything beneath it and
+        # the directory containing it.
+        if self.qid_cache != None:
+            for key in list(self.qid_cache):
+                if key == path or key.startswith(path + u"/"):
+                    del self.qid_cache[key]
+        
+        if self.listings != None:
+            self.listings.pop(path, None)
+            self.listings.pop(os.path.split(path)[0], None)
+    
     def write(self, fid, offset, data):
     
+        if self.read_only:
+            return -2
+        
         path = self.paths[fid]
         real_path = os.path.join(self.dir, path)
         
+        if self.write_buffers != None:
+            return self._buffer_write(fid, path, real_path, offset, data)
+        
         if os.path.isdir(real_path):
             return -1
         
-        f = open(real_path, "r+b")
+        self._write_file(path, offset, data)
+        return len(data)
+    
+    def _write_file(self, path, offset, data):
+    
+        f = open(os.path.join(self.dir, path), "r+b")
         f.seek(offset)
         f.write(data)
         f.close()
         
+        # The length of the file in the directory listing may have changed.
+        if self.listings != None:
+            self.listings.pop(os.path.split(path)[0], None)
+    
+    def _buffer_write(self, fid, path, real_path, offset, data):
+    
+        self.write_lock.acquire()
+        try:
+            buf = self.write_buffers.get(fid)
+            
+            if buf != None and buf.offset <= offset <= buf.offset + len(buf.data):
+                # Merge the data with the buffer, extending it if necessary.
+                start = offset - buf.offset
+                buf.data[start:start + len(data)] = data
+            else:
+                # Write the existing buffer, and any for the same file from
+                # other fids, so that writes reach the file in order.
+                for other, buf in list(self.write_buffers.items()):
+                    if other == fid or buf.path == path:
+                        self._write_buffer(self.write_buffers.pop(other))
+                
+                # Only check the type of file when a new buffer is needed.
+                if os.path.isdir(real_path):
+                    return -1
+                
+                buf = self.write_buffers[fid] = WriteBuffer(path, offset, data)
+            
+            if len(buf.data) >= self.max_buffer or \
+               time.time() - buf.created >= self.max_age:
+                self._write_buffer(self.write_buffers.pop(fid))
+        finally:
+            self.write_lock.release()
+        
+        if self.flusher_pid != os.getpid():
+            # Start a thread to write buffers that are not written to for a
+            # while, in this process.
+            self.flusher_pid = os.getpid()
+            t = threading.Thread(target=self._flusher)
+            t.daemon = True
+            t.start()
+        
         return len(data)
     
+    def _write_buffer(self, buf):
+    
+        try:
+            self._write_file(buf.path, buf.offset, bytes(buf.data))
+        except (IOError, OSError) as e:
+            sys.stderr.write("Failed to write %i bytes to %s: %s\n" % (
+                len(buf.data), buf.path, e))
+    
+    def _flush_writes(self, match):
+    
+        # Write the buffers for which match(fid, buffer) returns True.
+        if not self.write_buffers:
+            return
+        
+        self.write_lock.acquire()
+        try:
+            for fid, buf in list(self.write_buffers.items()):
+                if match(fid, buf):
+                    self._write_buffer(self.write_buffers.pop(fid))
+        finally:
+            self.write_lock.release()
+    
+    def _flusher(self):
+    
+        while True:
+            time.sleep(self.max_age / 2)
+            now = time.time()
+            self._flush_writes(lambda fid, buf: now - buf.created >= self.max_age)
+    
+    def flush(self):
+    
+        """Writes all buffered data to the files it was written to."""
+        
+        if self.write_buffers != None:
+            self._flush_writes(lambda fid, buf: True)
+    
     def remove(self, fid):
     
+        if self.read_only:
+            return u"Read-only file system."
+        
         path = self.paths[fid]
         real_path = os.path.join(self.dir, path)
         
+        if self.write_buffers != None:
+            self._flush_writes(lambda fid_, buf: buf.path == path)
+        
         try:
             if os.path.isdir(real_path):
                 os.rmdir(real_path)
@@ -229,11 +632,18 @@ class FileStore:
         except OSError as e:
             return str(e)
         
+        self.invalidate(path)
         return True
     
     def wstat(self, fid, st):
     
+        if self.read_only:
+            raise styxserver.StyxServerError("Read-only file system.")
+        
         path = self.paths[fid]
+        
+        if self.write_buffers != None:
+            self._flush_writes(lambda fid_, buf: buf.path == path)
         real_path = os.path.join(self.dir, path).encode(self.encoding)
         
         pieces = path.split(u"/")
@@ -243,11 +653,14 @@ class FileStore:
         # from the existing path.
         if st.name != u"" and st.name != old_name:
             # Rename the file and use the new path for any further operations.
-            new_path = os.path.join(os.path.split(real_path)[0], st.name).encode(self.encoding)
-            os.rename(real_path, new_path)
-            real_path = new_path
+            new_path = os.path.join(os.path.split(path)[0], st.name)
+            new_real_path = os.path.join(self.dir, new_path).encode(self.encoding)
+            os.rename(real_path, new_real_path)
+            real_path = new_real_path
+            self.invalidate(path)
+            self.invalidate(new_path)
             # Update the path dictionary to contain the new path.
-            self.paths[fid] = pieces + [u"/" + st.name]
+            self.paths[fid] = new_path
         
         s = os.stat(real_path)
         
@@ -268,15 +681,256 @@ class FileStore:
             os.utime(real_path, (atime, mtime))
 
 
+def fork_server(store):
+
+    """Serves the store from a child process on the loopback interface,
+    returning the process id of the child and the port it listens on."""
+    
+    server = styxserver.StyxServer(store)
+    s = server.listen("127.0.0.1", 0)
+    port = s.getsockname()[1]
+    
+    pid = os.fork()
+    if pid == 0:
+        try:
+            server.accept(s)
+        finally:
+            os._exit(0)
+    
+    s.close()
+    return pid, port
+
+
+def benchmark_prefetch(size = 256, reads = 2000, msize = 65536, rounds = 5):
+
+    """Serves a file of the given number of megabytes with and without
+    prefetching, printing how quickly it can be read sequentially and at
+    random offsets after it has been removed from the page cache. The median
+    of several rounds is given for each."""
+    
+    import client, random, shutil, signal, tempfile
+    
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, u"data")
+    
+    try:
+        f = open(path, "wb")
+        for i in range(size):
+            f.write(os.urandom(1048576))
+        f.close()
+        os.system("sync")
+        
+        results = {False: [], True: []}
+        
+        for prefetch in [False, True] * rounds:
+        
+            store = FileStore(directory)
+            if prefetch:
+                store.enable_prefetch()
+            
+            pid, port = fork_server(store)
+            
+            c = client.Client()
+            c.msize = msize
+            c.connect("127.0.0.1", port, u"", u"")
+            chunk = c.msize - 24
+            
+            rates = []
+            
+            for sequential in (True, False):
+            
+                # Remove the file from the page cache.
+                fd = os.open(path, os.O_RDONLY)
+                advise(fd, 0, 0, "POSIX_FADV_DONTNEED")
+                os.close(fd)
+                
+                f = c.open(u"data", 0)
+                blocks = size * 1048576 // chunk
+                
+                if sequential:
+                    offsets = [i * chunk for i in range(blocks)]
+                else:
+                    offsets = [random.randrange(blocks) * chunk for i in range(reads)]
+                
+                started = time.time()
+                for offset in offsets:
+                    f.read(offset, chunk)
+                elapsed = time.time() - started
+                f.close()
+                
+                rates.append(len(offsets) * chunk / elapsed / 1048576)
+            
+            c.disconnect()
+            os.kill(pid, signal.SIGTERM)
+            os.waitpid(pid, 0)
+            
+            results[prefetch].append(rates)
+        
+        for prefetch in (False, True):
+            rates = results[prefetch]
+            sequential = sorted(r[0] for r in rates)[rounds // 2]
+            random_ = sorted(r[1] for r in rates)[rounds // 2]
+            print("prefetch %-3s  sequential %8.1f MB/s  random %8.1f MB/s" % (
+                ["off", "on"][prefetch], sequential, random_))
+    
+    finally:
+        shutil.rmtree(directory)
+
+
+def benchmark_appends(appends = 20000, size = 100):
+
+    """Serves a directory with and without write-back buffering, printing
+    how many small writes to the end of a file a client can make each
+    second."""
+    
+    import client, shutil, signal, tempfile
+    
+    directory = tempfile.mkdtemp()
+    
+    try:
+        for write_back in (False, True):
+        
+            store = FileStore(directory)
+            if write_back:
+                store.enable_write_back()
+            
+            pid, port = fork_server(store)
+            
+            c = client.Client("127.0.0.1", port, u"", u"")
+            name = u"log%i" % write_back
+            c.create(name, 0o644, 1)
+            f = c.open(name, 1)
+            data = b"x" * (size - 1) + b"\n"
+            
+            started = time.time()
+            for i in range(appends):
+                c.send(styx.Twrite(tag=2, fid=f.fid, offset=i * size, data=data))
+            f.close()
+            elapsed = time.time() - started
+            
+            c.disconnect()
+            os.kill(pid, signal.SIGTERM)
+            os.waitpid(pid, 0)
+            
+            length = os.stat(os.path.join(directory, name)).st_size
+            if length != appends * size:
+                raise styxserver.StyxServerError("Expected %i bytes but found %i." % (
+                    appends * size, length))
+            
+            print("write-back %-3s  %8.0f appends/s" % (
+                ["off", "on"][write_back], appends / elapsed))
+    
+    finally:
+        shutil.rmtree(directory)
+
+
 if __name__ == "__main__":
 
-    if len(sys.argv) != 3:
-        sys.stderr.write("Usage: %s <directory> <port>\n" % sys.argv[0])
-        sys.exit(1)
+    args = sys.argv[1:]
+    workers = 0
+    recorder = None
+    stats = False
+    spans = None
+    profile = None
+    prefetch = False
+    write_back = False
+    read_only = False
+    limits = None
+    
+    if args == ["--benchmark"]:
+        benchmark_prefetch()
+        benchmark_appends()
+        sys.exit()
+    
+    while len(args) > 2 and args[0] in ("--workers", "--trace", "--stats",
+                                            "--spans", "--profile", "--prefetch",
+                                            "--write-back", "--read-only",
+                                            "--limits"):
+        if args[0] == "--stats":
+            stats = True
+            args = args[1:]
+            continue
+        elif args[0] == "--prefetch":
+            prefetch = True
+            args = args[1:]
+            continue
+        elif args[0] == "--write-back":
+            write_back = True
+            args = args[1:]
+            continue
+        elif args[0] == "--read-only":
+            read_only = True
+            args = args[1:]
+            continue
+        elif args[0] == "--workers":
+            workers = int(args[1])
+        elif args[0] == "--spans":
+            spans = args[1]
+        elif args[0] == "--profile":
+            profile = args[1]
+        elif args[0] == "--limits":
+            limits = args[1]
+        else:
+            import styxtrace
+            recorder = styxtrace.TraceRecorder(args[1])
+        args = args[2:]
     
-    directory = sys.argv[1]
-    port = int(sys.argv[2])
+    if len(args) != 2:
+        sys.stderr.write("Usage: %s [--workers <number>] [--trace <file>] [--stats] [--spans <file>] [--profile <file>] [--prefetch] [--write-back] [--read-only] [--limits <name>=<value>,...] <directory> (<port> | unix:<path>)\n" % sys.argv[0])
+        sys.stderr.write("       %s --benchmark\n" % sys.argv[0])
+        sys.exit(1)
     
-    store = FileStore(directory)
-    server = styxserver.StyxServer(store)
-    server.serve(b"", port)
+    directory = args[0]
+    # The port can also be given as unix:<path> to listen on a Unix domain
+    # socket instead.
+    if args[1].startswith("unix:"):
+        host, port = args[1][5:], None
+    else:
+        host, port = b"", int(args[1])
+    
+    store = FileStore(directory, read_only)
+    if prefetch:
+        store.enable_prefetch()
+    if write_back:
+        store.enable_write_back()
+    
+    server = styxserver.StyxServer(store, recorder)
+    
+    if limits != None:
+        server.parse_limits(limits)
+    
+    if stats:
+        server.enable_metrics()
+    
+    if spans != None:
+        import styxspans
+        collector = styxspans.SpanCollector()
+        exporter = styxspans.ChromeTraceExporter()
+        server.enable_tracing(styxspans.HookList([collector, exporter]))
+    
+    if profile != None:
+        # Profile the server when it receives SIGUSR1 or when "start" is
+        # written to the control file, until the same happens again.
+        import styxprofile
+        styxprofile.ProfilerControl(styxprofile.SamplingProfiler(), profile,
+                                    control=profile + ".control")
+    
+    try:
+        if workers > 0:
+            # Build the caches before forking so that the workers share them.
+            # Each worker only removes changes from its own copy, so they
+            # are only used if no worker can change the tree.
+            if read_only:
+                store.preload()
+            server.serve_workers(host, port, workers)
+        elif port == None:
+            server.serve_unix(host)
+        else:
+            server.serve(host, port)
+    finally:
+        if recorder != None:
+            recorder.close()
+        if spans != None:
+            # Write the phases in the Chrome trace format and summarise them.
+            exporter.write(spans)
+            sys.stderr.write(collector.report())
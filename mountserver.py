@@ -0,0 +1,451 @@
+#!/usr/bin/env python
+
+# mountserver.py - Serves a namespace made from several other data stores.
+#
+# Copyright (C) 2018 David Boddie <david@boddie.org.uk>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import itertools, sys, threading, time
+import client, styx, styxproxy, styxserver
+
+class MountNode:
+
+    def __init__(self):
+    
+        self.children = {}
+        self.store = None
+
+
+class MountStore:
+
+    """Maintains information about files and directories provided by other
+    data stores, each of which is mounted at a path in the namespace. Requests
+    for a path are passed to the store mounted at the longest prefix of the
+    path, found using a trie of path elements. The paths in qids are combined
+    with the index of the store that provided them so that they are unique.
+    Directories that contain mount points list the mounted directories as well
+    as their own contents.
+    """
+    
+    # The low bits of qid paths are taken from the store and the high bits
+    # hold the index of the store, starting at 1. Index 0 is used for the
+    # directories that only exist to contain mount points.
+    QPATH_BITS = 56
+    QPATH_MASK = (1 << QPATH_BITS) - 1
+    
+    def __init__(self):
+    
+        self.trie = MountNode()
+        self.stores = []
+        
+        self.qids = {}
+        self.paths = {}
+        self.opened = {}
+        self.root_fid = None
+        
+        # The store, path within the store and mount point for each fid.
+        self.mounts = {}
+        
+        # Merged directory listings for fids of opened directories.
+        self.listings = {}
+        
+        # Qid paths for directories containing mount points, and fids used
+        # internally to obtain information from stores.
+        self.synthetic = {}
+        self.temp_fids = itertools.count(0xf0000000)
+        self.lock = threading.Lock()
+        self.now = int(time.time())
+    
+    def mount(self, path, store):
+    
+        """Mounts the given store at the path specified."""
+        
+        if len(self.stores) == (1 << (64 - self.QPATH_BITS)) - 1:
+            raise styxserver.StyxServerError("Too many stores.")
+        
+        node = self.trie
+        
+        for element in self._split(path):
+            node = node.children.setdefault(element, MountNode())
+        
+        self.stores.append(store)
+        node.store = store
+    
+    def mount_remote(self, path, host, port, uname = u"", aname = u"", ttl = 1.0):
+    
+        """Mounts the contents of a remote server at the path specified,
+        accessing it with a client.Client object."""
+        
+        upstream = client.Client(host, port, uname, aname)
+        self.mount(path, styxproxy.ProxyStore(upstream, ttl))
+    
+    def get_root_qid(self, fid, afid, uname, aname):
+    
+        qid = self.make_qid(u"/")
+        self.set_qid_path(fid, qid, u"/")
+        self.root_fid = fid
+        return qid
+    
+    def get_qid_path(self, fid):
+    
+        return self.qids[fid], self.paths[fid]
+    
+    def set_qid_path(self, fid, qid, path):
+    
+        path = path.lstrip(u"/")
+        
+        node, store, mount_path, rel = self._lookup(path)
+        self._release(fid)
+        
+        # Only qids with a store index refer to objects in the store. Others
+        # are for directories that only exist to contain mount points.
+        if store != None and qid[2] >> self.QPATH_BITS != 0:
+            store.set_qid_path(fid, self._store_qid(qid), rel)
+        else:
+            store = None
+        
+        self.mounts[fid] = (store, rel, mount_path)
+        self.qids[fid] = qid
+        self.paths[fid] = path
+    
+    def make_qid(self, path):
+    
+        path = u"/".join(self._split(path))
+        node, store, mount_path, rel = self._lookup(path)
+        
+        if store != None:
+            qid = store.make_qid(rel)
+            if qid != None:
+                return self._qid(store, qid)
+        
+        # Directories leading to mount points exist even if the store that
+        # contains them does not have them.
+        if node != None:
+            return self._synthetic_qid(path)
+        
+        return None
+    
+    def free_qid_path(self, fid):
+    
+        self._release(fid)
+        
+        del self.qids[fid]
+        del self.paths[fid]
+        del self.mounts[fid]
+        
+        if fid in self.opened:
+            del self.opened[fid]
+        
+        self.listings.pop(fid, None)
+    
+    def stat(self, fid):
+    
+        store, rel, mount_path = self.mounts[fid]
+        path = self.paths[fid]
+        
+        if store == None:
+            return self._synthetic_stat(path)
+        
+        s = store.stat(fid)
+        if s == None:
+            return None
+        
+        return self._rewrite_stat(store, s, path)
+    
+    def create(self, fid, name, perm):
+    
+        store, rel, mount_path = self.mounts[fid]
+        
+        if store == None or fid in self.opened:
+            return False
+        
+        path = self.paths[fid]
+        
+        # Objects cannot be created over mount points.
+        node = self._node(path)
+        if node != None and name in node.children:
+            return False
+        
+        qid = store.create(fid, name, perm)
+        if qid == False or qid == None:
+            return False
+        
+        qid = self._qid(store, qid)
+        new_path = self._join(path, name)
+        
+        self.mounts[fid] = (store, self._join(rel, name), mount_path)
+        self.qids[fid] = qid
+        self.paths[fid] = new_path
+        
+        return qid
+    
+    def open(self, fid, mode):
+    
+        store, rel, mount_path = self.mounts[fid]
+        
+        if store == None:
+            # Directories that only exist to hold mount points are read-only.
+            if mode & 3 != 0:
+                return False
+            self.opened[fid] = mode
+            return True
+        
+        if not store.open(fid, mode):
+            return False
+        
+        self.opened[fid] = mode
+        return True
+    
+    def is_opened(self, fid):
+    
+        return fid in self.opened
+    
+    def read(self, fid, offset, count):
+    
+        store, rel, mount_path = self.mounts[fid]
+        
+        if self.qids[fid][0] & 0x80:
+            # Build the listing when the first part of the directory is read.
+            if offset == 0 or fid not in self.listings:
+                self.listings[fid] = self._listing(fid)
+            
+            return self.listings[fid][offset:offset + count]
+        
+        return store.read(fid, offset, count)
+    
+    def write(self, fid, offset, data):
+    
+        store, rel, mount_path = self.mounts[fid]
+        
+        if store == None:
+            return -1
+        
+        return store.write(fid, offset, data)
+    
+    def remove(self, fid):
+    
+        store, rel, mount_path = self.mounts[fid]
+        
+        if store == None or rel == u"" or self._node(self.paths[fid]) != None:
+            return u"Cannot remove a mount point."
+        
+        return store.remove(fid)
+    
+    def wstat(self, fid, st):
+    
+        store, rel, mount_path = self.mounts[fid]
+        
+        if store == None or rel == u"":
+            return
+        
+        store.wstat(fid, st)
+        
+        if st.name != u"" and st.name != rel.split(u"/")[-1]:
+            rel = self._join(rel.rpartition(u"/")[0], st.name)
+            self.mounts[fid] = (store, rel, mount_path)
+            self.paths[fid] = self._join(self.paths[fid].rpartition(u"/")[0], st.name)
+    
+    def cache_counters(self):
+    
+        """Returns the cache hits and misses for the mounted stores that keep
+        count of them, with the names of the caches prefixed by the paths of
+        the mount points."""
+        
+        counters = {}
+        
+        def visit(node, path):
+            if node.store != None and hasattr(node.store, "cache_counters"):
+                for name, value in node.store.cache_counters().items():
+                    counters[self._join(path, name)] = value
+            for element, child in node.children.items():
+                visit(child, self._join(path, element))
+        
+        visit(self.trie, u"")
+        return counters
+    
+    # Helper methods
+    
+    def _split(self, path):
+    
+        return [p for p in path.split(u"/") if p]
+    
+    def _join(self, path, name):
+    
+        if path:
+            return path + u"/" + name
+        else:
+            return name
+    
+    def _lookup(self, path):
+    
+        # Find the node for the path, if there is one, and the store mounted
+        # at the longest prefix of the path.
+        elements = self._split(path)
+        node = self.trie
+        store = node.store
+        depth = 0
+        
+        for i, element in enumerate(elements):
+            node = node.children.get(element)
+            if node == None:
+                break
+            if node.store != None:
+                store = node.store
+                depth = i + 1
+        
+        mount_path = u"/".join(elements[:depth])
+        rel = u"/".join(elements[depth:])
+        
+        return node, store, mount_path, rel
+    
+    def _node(self, path):
+    
+        node = self.trie
+        
+        for element in self._split(path):
+            node = node.children.get(element)
+            if node == None:
+                return None
+        
+        return node
+    
+    def _release(self, fid):
+    
+        # Free the fid in the store that it previously belonged to.
+        if fid in self.mounts:
+            store = self.mounts[fid][0]
+            if store != None:
+                try:
+                    store.free_qid_path(fid)
+                except KeyError:
+                    pass
+    
+    def _index(self, store):
+    
+        return self.stores.index(store) + 1
+    
+    def _qid(self, store, qid):
+    
+        qpath = (self._index(store) << self.QPATH_BITS) | (qid[2] & self.QPATH_MASK)
+        return (qid[0], qid[1], qpath)
+    
+    def _store_qid(self, qid):
+    
+        return (qid[0], qid[1], qid[2] & self.QPATH_MASK)
+    
+    def _synthetic_qid(self, path):
+    
+        self.lock.acquire()
+        try:
+            qpath = self.synthetic.setdefault(path, len(self.synthetic) + 1)
+        finally:
+            self.lock.release()
+        
+        return (0x80, 0, qpath)
+    
+    def _synthetic_stat(self, path):
+    
+        return styx.Stat(0, 0, self._synthetic_qid(path), styx.Stat.DMDIR | 0o555,
+                         self.now, self.now, 0, path.split(u"/")[-1],
+                         u"styx", u"styx", u"")
+    
+    def _rewrite_stat(self, store, s, path):
+    
+        # Return a copy of the stat with a qid that is unique in this store and,
+        # for mount points, the name used in this namespace.
+        return styx.Stat(s.type, s.dev, self._qid(store, s.qid), s.mode,
+                         s.atime, s.mtime, s.length, path.split(u"/")[-1],
+                         s.uid, s.gid, s.muid)
+    
+    def _store_stat(self, store, rel):
+    
+        qid = store.make_qid(rel)
+        if qid == None:
+            return None
+        
+        fid = next(self.temp_fids)
+        store.set_qid_path(fid, qid, rel)
+        try:
+            return store.stat(fid)
+        finally:
+            store.free_qid_path(fid)
+    
+    def _listing(self, fid):
+    
+        store, rel, mount_path = self.mounts[fid]
+        path = self.paths[fid]
+        entries = []
+        names = set()
+        
+        # Mount points in this directory hide any entries with the same names.
+        node = self._node(path)
+        if node != None:
+            for name in sorted(node.children):
+                child_path = self._join(path, name)
+                child_node, child_store, child_mount, child_rel = self._lookup(child_path)
+                
+                s = None
+                if child_store != None:
+                    s = self._store_stat(child_store, child_rel)
+                if s != None:
+                    s = self._rewrite_stat(child_store, s, child_path)
+                else:
+                    s = self._synthetic_stat(child_path)
+                
+                entries.append(s)
+                names.add(name)
+        
+        if store != None:
+            data = b""
+            while True:
+                piece = store.read(fid, len(data), 65536)
+                if not piece:
+                    break
+                data += piece
+            
+            # Only decode the entries that are not hidden by mount points.
+            for view in styx.decode_stats(data):
+                name = view.name
+                if name not in names:
+                    entries.append(self._rewrite_stat(store, view.decode(),
+                                                      self._join(path, name)))
+        
+        entries.sort(key=lambda s: s.name)
+        return styx.encode_stats(entries)
+
+
+if __name__ == "__main__":
+
+    if len(sys.argv) < 3:
+        sys.stderr.write("Usage: %s <port> <mount point>=<directory>|styx://<host>:<port> ...\n" % sys.argv[0])
+        sys.exit(1)
+    
+    import localfileserver
+    
+    port = int(sys.argv[1])
+    store = MountStore()
+    
+    for arg in sys.argv[2:]:
+    
+        mount_point, source = arg.split("=", 1)
+        
+        if source.startswith("styx://"):
+            host, remote_port = source[7:].rsplit(":", 1)
+            store.mount_remote(mount_point, host, int(remote_port))
+        else:
+            store.mount(mount_point, localfileserver.FileStore(source))
+    
+    server = styxserver.StyxServer(store)
+    server.serve(b"", port)
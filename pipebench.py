@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+
+# pipebench.py - Measures the throughput of small requests sent over a single
+#                connection with different numbers of them outstanding.
+#
+# Copyright (C) 2018 David Boddie <david@boddie.org.uk>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import argparse, json, os, signal, sys, time
+import client, loadgen, styx, styxserver
+
+# The ways that the server can send replies, as arguments for the
+# StyxServer.configure_sockets method.
+POLICIES = {
+    "nagle":    {"nodelay": False, "cork": False, "coalesce": False},
+    "nodelay":  {"nodelay": True, "cork": False, "coalesce": False},
+    "cork":     {"nodelay": True, "cork": True, "coalesce": False},
+    "coalesce": {"nodelay": True, "cork": False, "coalesce": True},
+    }
+
+def start_server(policy):
+
+    """Forks a process that serves a synthetic store on the loopback interface
+    using the given policy, returning its process id and port."""
+    
+    server = styxserver.StyxServer(loadgen.SyntheticStore(4, 4, 16))
+    server.configure_sockets(**POLICIES[policy])
+    
+    s = server.listen("127.0.0.1", 0)
+    port = s.getsockname()[1]
+    
+    pid = os.fork()
+    if pid == 0:
+        try:
+            server.accept(s, True)
+        finally:
+            os._exit(0)
+    
+    s.close()
+    return pid, port
+
+
+def run(port, depth, duration):
+
+    """Sends Tstat requests over one connection, keeping the given number of
+    them outstanding for the duration, and returns the number of replies
+    received per second and their mean latency in seconds."""
+    
+    c = client.Client("127.0.0.1", port, u"", u"")
+    sock = c.socket
+    receiver = styx.BufferedReceiver(sock)
+    queue = styx.QueuedSender(sock)
+    
+    # Each request is sent on its own, as a client with several threads
+    # would send them.
+    sent = {}
+    for tag in range(10, 10 + depth):
+        sent[tag] = time.perf_counter()
+        styx.Tstat(tag, 0).encode(sock)
+    
+    count = 0
+    latency = 0.0
+    started = time.perf_counter()
+    finish = started + duration
+    
+    while sent:
+        reply = styx.decode(stream=receiver)
+        now = time.perf_counter()
+        
+        if isinstance(reply, styx.Rerror):
+            raise styx.StyxError(reply.ename)
+        
+        latency += now - sent.pop(reply.tag)
+        count += 1
+        
+        if now < finish:
+            sent[reply.tag] = now
+            styx.Tstat(reply.tag, 0).encode(queue)
+        
+        # Send the requests that replace those that have been answered once
+        # there are no more replies waiting to be read.
+        if not receiver.ready():
+            queue.flush()
+    
+    elapsed = time.perf_counter() - started
+    c.disconnect()
+    
+    return count / elapsed, latency / count
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Measure the throughput of small requests over one connection with different numbers of requests outstanding and different ways of sending replies.")
+    parser.add_argument("--depths", default="1,2,4,8,16,32,64",
+                        help="The numbers of outstanding requests to measure (default 1,2,4,8,16,32,64).")
+    parser.add_argument("--policies", default="nagle,nodelay,cork,coalesce",
+                        help="The policies used by the server to send replies (default nagle,nodelay,cork,coalesce).")
+    parser.add_argument("--duration", type=float, default=2.0,
+                        help="The length of each measurement in seconds (default 2).")
+    parser.add_argument("--output", help="Write the results to this JSON file.")
+    args = parser.parse_args()
+    
+    depths = [int(d) for d in args.depths.split(",")]
+    policies = args.policies.split(",")
+    
+    for policy in policies:
+        if policy not in POLICIES:
+            sys.stderr.write("Unknown policy: %s\n" % policy)
+            sys.exit(1)
+    
+    results = {}
+    
+    for policy in policies:
+        pid, port = start_server(policy)
+        try:
+            time.sleep(0.1)
+            for depth in depths:
+                results.setdefault(policy, {})[depth] = run(port, depth, args.duration)
+        finally:
+            os.kill(pid, signal.SIGKILL)
+            os.waitpid(pid, 0)
+    
+    sys.stdout.write("%-6s" % "depth")
+    for policy in policies:
+        sys.stdout.write(" %12s %9s" % (policy + " op/s", "mean ms"))
+    sys.stdout.write("\n")
+    
+    for depth in depths:
+        sys.stdout.write("%-6i" % depth)
+        for policy in policies:
+            rate, latency = results[policy][depth]
+            sys.stdout.write(" %12.0f %9.3f" % (rate, latency * 1000))
+        sys.stdout.write("\n")
+    
+    if args.output:
+        f = open(args.output, "w")
+        json.dump(dict((policy, dict((str(depth), {"ops_per_s": r[0], "mean_s": r[1]})
+                                     for depth, r in entries.items()))
+                       for policy, entries in results.items()),
+                  f, indent=2, sort_keys=True)
+        f.write("\n")
+        f.close()
@@ -0,0 +1,552 @@
+#!/usr/bin/env python
+
+# replicatedserver.py - Serves the contents of several equivalent data stores,
+#                       hedging reads between them.
+#
+# Copyright (C) 2018 David Boddie <david@boddie.org.uk>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import collections, itertools, sys, threading, time
+from concurrent import futures
+import client, styxproxy, styxserver
+
+class LatencyTracker:
+
+    """Records the most recent latencies for an operation and reports
+    percentiles of them. Latencies can be added and reported by several
+    threads at once."""
+    
+    def __init__(self, window = 1000):
+    
+        self.samples = collections.deque(maxlen=window)
+        self.count = 0
+        self.sorted = None
+        self.lock = threading.Lock()
+    
+    def add(self, latency):
+    
+        self.lock.acquire()
+        try:
+            self.samples.append(latency)
+            self.count += 1
+            self.sorted = None
+        finally:
+            self.lock.release()
+    
+    def percentile(self, p):
+    
+        self.lock.acquire()
+        try:
+            if not self.samples:
+                return None
+            
+            if self.sorted == None:
+                self.sorted = sorted(self.samples)
+            
+            i = min(len(self.sorted) - 1, int(len(self.sorted) * p / 100.0))
+            return self.sorted[i]
+        finally:
+            self.lock.release()
+
+
+class ReplicatedStore:
+
+    """Maintains information about files and directories held by several
+    equivalent data stores. Requests that only read information are sent to
+    one of the stores and, if no reply is received within a delay based on a
+    percentile of recent latencies, to another store as well. The first reply
+    is used and the other request is cancelled. Requests that change the
+    stores are sent to all of them. If the stores disagree about whether a
+    change succeeded, the result from most of them is used and the others are
+    no longer used.
+    
+    Stores are called from worker threads. Each store has a single thread for
+    requests that change it, so that they are performed in order, and a pool
+    of threads for requests that read from it.
+    """
+    
+    def __init__(self, stores, percentile = 95, min_delay = 0.001,
+                 max_delay = 0.5, initial_delay = 0.05, workers = 4,
+                 hedging = True):
+    
+        self.stores = list(stores)
+        self.hedging = hedging
+        self.percentile = percentile
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.initial_delay = initial_delay
+        
+        self.writers = [futures.ThreadPoolExecutor(1) for s in self.stores]
+        self.readers = [futures.ThreadPoolExecutor(workers) for s in self.stores]
+        
+        self.qids = {}
+        self.paths = {}
+        self.opened = {}
+        self.root_fid = None
+        
+        # The stores that have finished setting up each fid, and the
+        # generation of each fid, used to ignore stores that finish after it
+        # changes. Generations are never reused, even when fids are, so that
+        # requests made for an earlier use of a fid are also ignored.
+        self.ready = {}
+        self.generations = {}
+        self.next_generation = itertools.count(1)
+        self.condition = threading.Condition()
+        
+        # Requests in progress for each store, used to choose between them,
+        # and the stores that are no longer used because their contents may
+        # differ from the others.
+        self.in_flight = [0] * len(self.stores)
+        self.next = 0
+        self.diverged = set()
+        self.lock = threading.Lock()
+        
+        # Latencies of individual requests, used to determine when to hedge,
+        # and of complete operations, used for reporting. The counters are
+        # updated with the lock held.
+        self.attempts = collections.defaultdict(LatencyTracker)
+        self.latencies = collections.defaultdict(LatencyTracker)
+        self.hedged = collections.Counter()
+        self.cancelled = collections.Counter()
+        self.wins = [0] * len(self.stores)
+    
+    def get_root_qid(self, fid, afid, uname, aname):
+    
+        qid = self._broadcast("get_root_qid", (fid, afid, uname, aname), fid,
+                              accept=lambda qid: qid != None)
+        self.qids[fid] = qid
+        self.paths[fid] = u""
+        self.root_fid = fid
+        return qid
+    
+    def get_qid_path(self, fid):
+    
+        return self.qids[fid], self.paths[fid]
+    
+    def set_qid_path(self, fid, qid, path):
+    
+        self.qids[fid] = qid
+        self.paths[fid] = path.lstrip(u"/")
+        
+        # The stores are updated in the background. Reads using the fid wait
+        # until at least one store has been updated.
+        self._broadcast("set_qid_path", (fid, qid, path), fid, wait=False)
+    
+    def make_qid(self, path):
+    
+        return self._hedge("walk", range(len(self.stores)), "make_qid", (path,))
+    
+    def free_qid_path(self, fid):
+    
+        del self.qids[fid]
+        del self.paths[fid]
+        
+        if fid in self.opened:
+            del self.opened[fid]
+        
+        self.condition.acquire()
+        self.ready.pop(fid, None)
+        self.generations.pop(fid, None)
+        self.condition.release()
+        
+        self._broadcast("free_qid_path", (fid,), wait=False)
+    
+    def stat(self, fid):
+    
+        return self._hedge("stat", self._ready(fid), "stat", (fid,))
+    
+    def create(self, fid, name, perm):
+    
+        qid = self._broadcast("create", (fid, name, perm), fid, wait_all=True,
+                              accept=lambda qid: qid != False and qid != None)
+        
+        if qid != False and qid != None:
+            self.qids[fid] = qid
+            self.paths[fid] = (self.paths[fid] + u"/" + name).lstrip(u"/")
+        
+        return qid
+    
+    def open(self, fid, mode):
+    
+        # Requests to open files for reading only need to wait for one store,
+        # but all stores need to be ready before files are written.
+        if not self._broadcast("open", (fid, mode), fid, wait_all=mode & 3 != 0,
+                               accept=lambda result: result):
+            return False
+        
+        self.opened[fid] = mode
+        return True
+    
+    def is_opened(self, fid):
+    
+        return fid in self.opened
+    
+    def read(self, fid, offset, count):
+    
+        return self._hedge("read", self._ready(fid), "read", (fid, offset, count))
+    
+    def write(self, fid, offset, data):
+    
+        return self._broadcast("write", (fid, offset, data), wait_all=True,
+                               accept=lambda count: count == len(data))
+    
+    def remove(self, fid):
+    
+        return self._broadcast("remove", (fid,), wait_all=True,
+                               accept=lambda result: result == True)
+    
+    def wstat(self, fid, st):
+    
+        self._broadcast("wstat", (fid, st), wait_all=True)
+        
+        if st.name != u"":
+            self.paths[fid] = (self.paths[fid].rpartition(u"/")[0] + u"/" + st.name).lstrip(u"/")
+    
+    def report(self):
+    
+        """Returns a dictionary containing the 50th and 99th percentile
+        latencies in seconds for each kind of operation, with the number of
+        operations that were hedged and the number of requests cancelled."""
+        
+        results = {}
+        
+        self.lock.acquire()
+        try:
+            trackers = list(self.latencies.items())
+            hedged = self.hedged.copy()
+            cancelled = self.cancelled.copy()
+        finally:
+            self.lock.release()
+        
+        for op, tracker in trackers:
+            results[op] = {
+                "count": tracker.count,
+                "p50": tracker.percentile(50),
+                "p99": tracker.percentile(99),
+                "hedged": hedged[op],
+                "cancelled": cancelled[op]
+                }
+        
+        return results
+    
+    # Dispatch methods
+    
+    def _ready(self, fid):
+    
+        # Wait until at least one store has finished setting up the fid.
+        self.condition.acquire()
+        try:
+            while not self.ready.get(fid):
+                if fid not in self.ready:
+                    raise KeyError(fid)
+                self.condition.wait()
+            return list(self.ready[fid])
+        finally:
+            self.condition.release()
+    
+    def _active(self):
+    
+        self.lock.acquire()
+        try:
+            return [i for i in range(len(self.stores)) if i not in self.diverged]
+        finally:
+            self.lock.release()
+    
+    def _broadcast(self, name, args, fid = None, wait = True, wait_all = False,
+                   accept = lambda result: True):
+        
+        # Submit the request to each store's writer thread. If a fid is given
+        # then the stores that have finished the request successfully become
+        # the ones that are ready to handle reads for it.
+        if fid != None:
+            self.condition.acquire()
+            generation = next(self.next_generation)
+            self.generations[fid] = generation
+            self.ready[fid] = set()
+            self.condition.release()
+        
+        pending = []
+        
+        for i in self._active():
+        
+            future = self.writers[i].submit(getattr(self.stores[i], name), *args)
+            future.store = i
+            
+            if fid != None:
+                future.add_done_callback(
+                    lambda f, i=i: self._finished(f, i, fid, generation, accept))
+            
+            pending.append(future)
+        
+        if not wait:
+            return None
+        
+        if wait_all:
+            futures.wait(pending)
+            return self._agree(name, pending, accept)
+        
+        # Return the first acceptable result, or the last result if none of
+        # them are acceptable.
+        result = None
+        for future in futures.as_completed(pending):
+            if future.exception() == None:
+                result = future.result()
+                if accept(result):
+                    return result
+        
+        return result
+    
+    def _agree(self, name, pending, accept):
+    
+        # Use the outcome reported by most of the stores, or failure if there
+        # is no majority, and stop using the stores that disagree with it.
+        succeeded = []
+        failed = []
+        
+        for future in pending:
+            if future.exception() == None and accept(future.result()):
+                succeeded.append(future)
+            else:
+                failed.append(future)
+        
+        if len(succeeded) * 2 > len(pending):
+            outcome, diverged = succeeded, failed
+        else:
+            outcome, diverged = failed, succeeded
+        
+        if diverged:
+            self.lock.acquire()
+            self.diverged.update(future.store for future in diverged)
+            self.lock.release()
+            
+            sys.stderr.write("Stores %s disagreed with the others about %s and "
+                             "are no longer used.\n" % (
+                             u", ".join(str(f.store) for f in diverged), name))
+        
+        # Prefer a result to an exception when reporting a failure.
+        for future in outcome:
+            if future.exception() == None:
+                return future.result()
+        
+        raise outcome[0].exception()
+    
+    def _finished(self, future, i, fid, generation, accept):
+    
+        if future.exception() != None or not accept(future.result()):
+            return
+        
+        self.condition.acquire()
+        if self.generations.get(fid) == generation:
+            self.ready[fid].add(i)
+            self.condition.notify_all()
+        self.condition.release()
+    
+    def _delay(self, op):
+    
+        if not self.hedging:
+            return None
+        
+        self.lock.acquire()
+        tracker = self.attempts[op]
+        self.lock.release()
+        
+        if tracker.count < 20:
+            return self.initial_delay
+        
+        delay = tracker.percentile(self.percentile)
+        return min(self.max_delay, max(self.min_delay, delay))
+    
+    def _choose(self, candidates):
+    
+        # Prefer the stores with the fewest requests in progress, taking turns
+        # between stores that are equally busy.
+        self.lock.acquire()
+        n = len(self.stores)
+        start = self.next
+        self.next = (self.next + 1) % n
+        candidates = [i for i in candidates if i not in self.diverged] or candidates
+        order = sorted(candidates, key=lambda i: (self.in_flight[i], (i - start) % n))
+        self.lock.release()
+        return order
+    
+    def _submit(self, i, name, args):
+    
+        self.lock.acquire()
+        self.in_flight[i] += 1
+        self.lock.release()
+        
+        started = time.time()
+        call = object()
+        future = self.readers[i].submit(self._run, self.stores[i], call, name, args)
+        future.add_done_callback(lambda f: self._done(i))
+        future.started = started
+        future.store = i
+        future.call = call
+        return future
+    
+    def _run(self, store, call, name, args):
+    
+        # Stores that can cancel requests are told which call each of their
+        # requests belongs to, so that only this call is cancelled if it loses.
+        begin_call = getattr(store, "begin_call", None)
+        if begin_call == None:
+            return getattr(store, name)(*args)
+        
+        begin_call(call)
+        try:
+            return getattr(store, name)(*args)
+        finally:
+            store.end_call(call)
+    
+    def _done(self, i):
+    
+        self.lock.acquire()
+        self.in_flight[i] -= 1
+        self.lock.release()
+    
+    def _hedge(self, op, candidates, name, args):
+    
+        order = self._choose(candidates)
+        started = time.time()
+        
+        pending = [self._submit(order[0], name, args)]
+        done, not_done = futures.wait(pending, timeout=self._delay(op))
+        
+        # If the first store is slow to reply then send the request to the
+        # next store as well.
+        if not done and len(order) > 1:
+            self.lock.acquire()
+            self.hedged[op] += 1
+            self.lock.release()
+            pending.append(self._submit(order[1], name, args))
+        
+        winner = None
+        remaining = set(pending)
+        
+        while remaining and winner == None:
+            done, remaining = futures.wait(remaining, return_when=futures.FIRST_COMPLETED)
+            for future in done:
+                if future.exception() == None:
+                    winner = future
+                    break
+        
+        finished = time.time()
+        
+        # Cancel the requests that lost. Those that have already started can
+        # only be cancelled if the store supports it, as ProxyStore does by
+        # flushing the upstream request made for the call, if any.
+        for future in remaining:
+            self.lock.acquire()
+            self.cancelled[op] += 1
+            self.lock.release()
+            if not future.cancel():
+                cancel = getattr(self.stores[future.store], "cancel", None)
+                if cancel != None:
+                    cancel(future.call)
+        
+        if winner == None:
+            raise pending[0].exception()
+        
+        self.lock.acquire()
+        self.wins[winner.store] += 1
+        attempts = self.attempts[op]
+        latencies = self.latencies[op]
+        self.lock.release()
+        
+        attempts.add(finished - winner.started)
+        latencies.add(finished - started)
+        
+        return winner.result()
+
+
+def benchmark(reads = 5000, stall = 0.02, stall_rate = 0.1, port = 17600):
+
+    """Reads a file through a server using a ReplicatedStore with three
+    stores, one of which stalls for a time on some of the reads sent to it,
+    and prints the latencies seen by the client with and without hedging."""
+    
+    import dictserver, random
+    
+    class StallingStore(dictserver.DictStore):
+    
+        def __init__(self, dictionary, seed):
+            dictserver.DictStore.__init__(self, dictionary)
+            self.random = random.Random(seed)
+        
+        def read(self, fid, offset, count):
+            if self.random.random() < stall_rate:
+                time.sleep(stall)
+            return dictserver.DictStore.read(self, fid, offset, count)
+    
+    contents = {u"file": u"x" * 1000}
+    
+    for hedging in (False, True):
+    
+        stores = [StallingStore(contents, 1), dictserver.DictStore(contents),
+                  dictserver.DictStore(contents)]
+        
+        store = ReplicatedStore(stores, hedging=hedging)
+        server = styxserver.StyxServer(store)
+        t = threading.Thread(target=server.serve, args=("127.0.0.1", port, True))
+        t.daemon = True
+        t.start()
+        time.sleep(0.1)
+        
+        c = client.Client("127.0.0.1", port, u"", u"")
+        f = c.open("file", 0)
+        latencies = LatencyTracker(reads)
+        
+        for i in range(reads):
+            started = time.time()
+            f.read(0, 100)
+            latencies.add(time.time() - started)
+        
+        print("%-8s client p50 %7.3f ms  p99 %7.3f ms   store p50 %7.3f ms  p99 %7.3f ms  hedged %i" % (
+            hedging and "hedged" or "unhedged",
+            latencies.percentile(50) * 1000, latencies.percentile(99) * 1000,
+            store.latencies["read"].percentile(50) * 1000,
+            store.latencies["read"].percentile(99) * 1000, store.hedged["read"]))
+        
+        port += 1
+
+
+if __name__ == "__main__":
+
+    if len(sys.argv) == 2 and sys.argv[1] == "--benchmark":
+        benchmark()
+        sys.exit()
+    
+    if len(sys.argv) < 3:
+        sys.stderr.write("Usage: %s <port> <directory>|styx://<host>:<port> ...\n" % sys.argv[0])
+        sys.stderr.write("       %s --benchmark\n" % sys.argv[0])
+        sys.exit(1)
+    
+    import localfileserver
+    
+    port = int(sys.argv[1])
+    stores = []
+    
+    for source in sys.argv[2:]:
+    
+        if source.startswith("styx://"):
+            host, remote_port = source[7:].rsplit(":", 1)
+            upstream = client.Client(host, int(remote_port), u"", u"")
+            stores.append(styxproxy.ProxyStore(upstream, ttl=0))
+        else:
+            stores.append(localfileserver.FileStore(source))
+    
+    store = ReplicatedStore(stores)
+    server = styxserver.StyxServer(store)
+    server.serve(b"", port)
@@ -0,0 +1,558 @@
+#!/usr/bin/env python
+
+# sqliteserver.py - Serves a namespace held in an SQLite database.
+#
+# Copyright (C) 2018 David Boddie <david@boddie.org.uk>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os, sqlite3, sys, time
+import styx, styxserver
+
+class SQLiteStore:
+
+    """Maintains information about files and directories in an SQLite database.
+    Each object is a row in a table indexed by its full path and by its parent
+    and name, so that walks are a single lookup and directory listings can be
+    read a page at a time. File contents are kept in the table as blobs unless
+    they grow larger than INLINE_LIMIT, in which case they are moved to files
+    in a directory next to the database.
+    """
+    
+    INLINE_LIMIT = 65536
+    
+    # The number of rows to fetch at a time when reading a directory.
+    PAGE_SIZE = 256
+    
+    # Qid paths must not be reused after files are removed, so they are
+    # allocated with AUTOINCREMENT instead of reusing the largest rowid.
+    schema = """
+        CREATE TABLE IF NOT EXISTS files (
+            qpath INTEGER PRIMARY KEY AUTOINCREMENT,
+            path TEXT UNIQUE NOT NULL,
+            parent INTEGER,
+            name TEXT NOT NULL,
+            mode INTEGER NOT NULL,
+            atime INTEGER NOT NULL,
+            mtime INTEGER NOT NULL,
+            length INTEGER NOT NULL,
+            version INTEGER NOT NULL,
+            data BLOB,
+            external INTEGER NOT NULL DEFAULT 0
+            );
+        CREATE INDEX IF NOT EXISTS files_parent ON files (parent, name);
+        """
+    
+    columns = "qpath, path, parent, name, mode, atime, mtime, length, version, external"
+    
+    def __init__(self, database, blob_dir = None):
+    
+        self.db = sqlite3.connect(database, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self._upgrade()
+        self.db.executescript(self.schema)
+        
+        if blob_dir == None:
+            if database == ":memory:":
+                blob_dir = None
+            else:
+                blob_dir = os.path.abspath(database) + ".blobs"
+        
+        self.blob_dir = blob_dir
+        
+        self.qids = {}
+        self.paths = {}
+        self.opened = {}
+        self.root_fid = None
+        
+        # Directory read positions for each fid: (next offset, last name).
+        self.cursors = {}
+        
+        if self._row(u"") == None:
+            now = int(time.time())
+            self.db.execute(
+                "INSERT INTO files (path, parent, name, mode, atime, mtime, "
+                "length, version) VALUES ('', NULL, '', ?, ?, ?, 0, 0)",
+                (styx.Stat.DMDIR | 0o755, now, now))
+            self.db.commit()
+    
+    def _upgrade(self):
+    
+        # Copy the rows of tables created without AUTOINCREMENT into a new
+        # table that has it. The largest qid path in use is recorded, but
+        # those of files removed before the upgrade cannot be recovered.
+        row = self.db.execute("SELECT sql FROM sqlite_master "
+                              "WHERE type = 'table' AND name = 'files'").fetchone()
+        
+        if row == None or "AUTOINCREMENT" in row[0].upper():
+            return
+        
+        self.db.executescript(
+            "BEGIN; "
+            "ALTER TABLE files RENAME TO old_files; "
+            "DROP INDEX IF EXISTS files_parent; " + self.schema +
+            "INSERT INTO files SELECT * FROM old_files; "
+            "DROP TABLE old_files; "
+            "COMMIT;")
+    
+    def get_root_qid(self, fid, afid, uname, aname):
+    
+        qid = self.make_qid(u"/")
+        self.set_qid_path(fid, qid, u"/")
+        self.root_fid = fid
+        return qid
+    
+    def get_qid_path(self, fid):
+    
+        return self.qids[fid], self.paths[fid]
+    
+    def set_qid_path(self, fid, qid, path):
+    
+        path = path.lstrip(u"/")
+        
+        self.qids[fid] = qid
+        self.paths[fid] = path
+    
+    def make_qid(self, path):
+    
+        row = self._row(self._normalise(path))
+        
+        if row == None:
+            return None
+        
+        return self._qid(row)
+    
+    def free_qid_path(self, fid):
+    
+        del self.qids[fid]
+        del self.paths[fid]
+        
+        if fid in self.opened:
+            del self.opened[fid]
+        
+        self.cursors.pop(fid, None)
+    
+    def stat(self, fid):
+    
+        row = self._row(self.paths[fid])
+        
+        if row == None:
+            return None
+        
+        return self._stat(row)
+    
+    def create(self, fid, name, perm):
+    
+        if name in (u"", u".", u"..") or u"/" in name:
+            return False
+        
+        elif fid in self.opened:
+            return False
+        
+        path = self.paths[fid]
+        parent = self._row(path)
+        
+        if parent == None or not parent[4] & styx.Stat.DMDIR:
+            return False
+        
+        new_path = self._join(path, name)
+        
+        # Apply the permissions of the directory to those requested, as
+        # described in the open(5) manual page.
+        if perm & styx.Stat.DMDIR:
+            mode = perm & (~0o777 | (parent[4] & 0o777))
+        else:
+            mode = perm & (~0o666 | (parent[4] & 0o666))
+        
+        now = int(time.time())
+        
+        try:
+            self.db.execute(
+                "INSERT INTO files (path, parent, name, mode, atime, mtime, "
+                "length, version, data) VALUES (?, ?, ?, ?, ?, ?, 0, 0, ?)",
+                (new_path, parent[0], name, mode & 0xffffffff, now, now,
+                 None if perm & styx.Stat.DMDIR else b""))
+        except sqlite3.IntegrityError:
+            # The path already exists.
+            return False
+        
+        self._touch(parent[0], now)
+        self.db.commit()
+        
+        # Update the fid to refer to the new object.
+        qid = self.make_qid(new_path)
+        self.set_qid_path(fid, qid, new_path)
+        
+        return qid
+    
+    def open(self, fid, mode):
+    
+        if fid in self.opened:
+            self.opened[fid] = mode
+            if mode & styx.Stat.DMEXCL:
+                return False
+        else:
+            self.opened[fid] = mode
+        
+        # Truncate files opened with OTRUNC.
+        if mode & 0x10:
+            row = self._row(self.paths[fid])
+            if row != None and not row[4] & styx.Stat.DMDIR:
+                self._truncate(row, 0)
+                self.db.commit()
+        
+        return True
+    
+    def is_opened(self, fid):
+    
+        return fid in self.opened
+    
+    def read(self, fid, offset, count):
+    
+        row = self._row(self.paths[fid])
+        
+        if row == None:
+            return None
+        
+        if row[4] & styx.Stat.DMDIR:
+            return self._read_dir(fid, row, offset, count)
+        
+        if row[9]:
+            f = open(self._blob_path(row[0]), "rb")
+            f.seek(offset)
+            data = f.read(count)
+            f.close()
+            return data
+        
+        # Let the database extract the requested part of the blob.
+        return self.db.execute(
+            "SELECT substr(data, ?, ?) FROM files WHERE qpath = ?",
+            (offset + 1, count, row[0])).fetchone()[0] or b""
+    
+    def write(self, fid, offset, data):
+    
+        row = self._row(self.paths[fid])
+        
+        if row == None or row[4] & styx.Stat.DMDIR:
+            return -1
+        
+        if row[4] & styx.Stat.DMAPPEND:
+            offset = row[7]
+        
+        end = max(row[7], offset + len(data))
+        
+        if not row[9] and end > self.INLINE_LIMIT and self.blob_dir != None:
+            self._externalise(row)
+            row = self._row(row[1])
+        
+        if row[9]:
+            f = open(self._blob_path(row[0]), "r+b")
+            f.seek(offset)
+            f.write(data)
+            f.close()
+        else:
+            old = self.db.execute("SELECT data FROM files WHERE qpath = ?",
+                                  (row[0],)).fetchone()[0] or b""
+            if offset > len(old):
+                old += b"\x00" * (offset - len(old))
+            new = old[:offset] + data + old[offset + len(data):]
+            self.db.execute("UPDATE files SET data = ? WHERE qpath = ?",
+                            (sqlite3.Binary(new), row[0]))
+        
+        self.db.execute(
+            "UPDATE files SET length = ?, mtime = ?, version = version + 1 "
+            "WHERE qpath = ?", (end, int(time.time()), row[0]))
+        self.db.commit()
+        
+        return len(data)
+    
+    def remove(self, fid):
+    
+        path = self.paths[fid]
+        row = self._row(path)
+        
+        if row == None:
+            return u"No such file or directory."
+        elif row[0] == self._row(u"")[0]:
+            return u"Cannot remove the root directory."
+        
+        if row[4] & styx.Stat.DMDIR:
+            child = self.db.execute(
+                "SELECT 1 FROM files WHERE parent = ? LIMIT 1", (row[0],)).fetchone()
+            if child != None:
+                return u"Directory not empty."
+        
+        self.db.execute("DELETE FROM files WHERE qpath = ?", (row[0],))
+        self._touch(row[2], int(time.time()))
+        self.db.commit()
+        
+        if row[9]:
+            try:
+                os.remove(self._blob_path(row[0]))
+            except OSError:
+                pass
+        
+        return True
+    
+    def wstat(self, fid, st):
+    
+        path = self.paths[fid]
+        row = self._row(path)
+        
+        if row == None:
+            return
+        
+        qpath = row[0]
+        
+        # Only update the name if the specified name is not empty and differs
+        # from the existing path.
+        if st.name != u"" and st.name != row[3] and u"/" not in st.name:
+            try:
+                self._rename(row, st.name)
+            except sqlite3.IntegrityError:
+                # An object with the new name already exists.
+                self.db.rollback()
+                return
+            path = self._join(path.rpartition(u"/")[0], st.name)
+            self.paths[fid] = path
+        
+        if st.mode != 0xffffffff:
+            # The directory bit cannot be changed.
+            mode = (row[4] & styx.Stat.DMDIR) | (st.mode & ~styx.Stat.DMDIR)
+            self.db.execute("UPDATE files SET mode = ? WHERE qpath = ?",
+                            (mode & 0xffffffff, qpath))
+        
+        if st.mtime != 0xffffffff:
+            self.db.execute("UPDATE files SET mtime = ? WHERE qpath = ?",
+                            (st.mtime, qpath))
+        
+        if st.atime != 0xffffffff:
+            self.db.execute("UPDATE files SET atime = ? WHERE qpath = ?",
+                            (st.atime, qpath))
+        
+        if st.length != 0xffffffffffffffff and not row[4] & styx.Stat.DMDIR:
+            self._truncate(self._row(path), st.length)
+        
+        self.db.commit()
+    
+    def add(self, path, data = None, perm = 0o644):
+    
+        """Adds the object with the given path to the store without using the
+        protocol, creating any missing parent directories. If data is None then
+        a directory is created. Changes are not committed until commit() is
+        called, so that large namespaces can be populated quickly.
+        """
+        
+        path = self._normalise(path)
+        parent_path, sep, name = path.rpartition(u"/")
+        parent = self._row(parent_path)
+        
+        if parent == None:
+            self.add(parent_path, None, 0o755)
+            parent = self._row(parent_path)
+        
+        now = int(time.time())
+        
+        if data == None:
+            mode = styx.Stat.DMDIR | (perm & 0o777)
+            length = 0
+        else:
+            mode = perm & 0o777
+            length = len(data)
+        
+        self.db.execute(
+            "INSERT INTO files (path, parent, name, mode, atime, mtime, "
+            "length, version, data) VALUES (?, ?, ?, ?, ?, ?, ?, 0, ?)",
+            (path, parent[0], name, mode, now, now, length,
+             None if data == None else sqlite3.Binary(data)))
+        
+        if data != None and length > self.INLINE_LIMIT and self.blob_dir != None:
+            self._externalise(self._row(path))
+    
+    def commit(self):
+    
+        self.db.commit()
+    
+    # Helper methods
+    
+    def _normalise(self, path):
+    
+        return u"/".join(p for p in path.split(u"/") if p)
+    
+    def _join(self, path, name):
+    
+        if path:
+            return path + u"/" + name
+        else:
+            return name
+    
+    def _row(self, path):
+    
+        return self.db.execute("SELECT " + self.columns + " FROM files WHERE path = ?",
+                               (path,)).fetchone()
+    
+    def _qid(self, row):
+    
+        if row[4] & styx.Stat.DMDIR:
+            qtype = 0x80
+        else:
+            qtype = 0
+        
+        return (qtype, row[8] & 0xffffffff, row[0])
+    
+    def _stat(self, row):
+    
+        return styx.Stat(0, 0, self._qid(row), row[4], row[5], row[6],
+                         row[7], row[3], u"sqlite", u"sqlite", u"")
+    
+    def _read_dir(self, fid, row, offset, count):
+    
+        # Directory reads are expected to continue from the end of the previous
+        # read, so the name of the last entry sent is kept for each fid and used
+        # as the key to start the next page from. Reads from other offsets fall
+        # back to skipping entries from the start of the directory.
+        if offset == 0:
+            last = None
+        elif fid in self.cursors and self.cursors[fid][0] == offset:
+            last = self.cursors[fid][1]
+        else:
+            last = self._skip_entries(row[0], offset)
+            if last == None:
+                return b""
+        
+        data = b""
+        
+        while True:
+        
+            if last == None:
+                rows = self.db.execute(
+                    "SELECT " + self.columns + " FROM files WHERE parent = ? "
+                    "ORDER BY name LIMIT ?", (row[0], self.PAGE_SIZE)).fetchall()
+            else:
+                rows = self.db.execute(
+                    "SELECT " + self.columns + " FROM files WHERE parent = ? "
+                    "AND name > ? ORDER BY name LIMIT ?",
+                    (row[0], last, self.PAGE_SIZE)).fetchall()
+            
+            for child in rows:
+                entry = self._stat(child).encode()
+                
+                # Only send whole entries.
+                if len(data) + len(entry) > count:
+                    self.cursors[fid] = (offset + len(data), last)
+                    return data
+                
+                data += entry
+                last = child[3]
+            
+            if len(rows) < self.PAGE_SIZE:
+                break
+        
+        self.cursors[fid] = (offset + len(data), last)
+        return data
+    
+    def _skip_entries(self, parent, offset):
+    
+        # Returns the name of the entry that ends at the given offset, or None
+        # if the offset does not fall on an entry boundary.
+        position = 0
+        
+        for child in self.db.execute("SELECT " + self.columns + " FROM files "
+                                     "WHERE parent = ? ORDER BY name", (parent,)):
+            position += len(self._stat(child).encode())
+            if position == offset:
+                return child[3]
+            elif position > offset:
+                break
+        
+        return None
+    
+    def _touch(self, qpath, now):
+    
+        self.db.execute("UPDATE files SET mtime = ?, version = version + 1 "
+                        "WHERE qpath = ?", (now, qpath))
+    
+    def _blob_path(self, qpath):
+    
+        return os.path.join(self.blob_dir, "%i" % qpath)
+    
+    def _externalise(self, row):
+    
+        # Move the contents of a file out of the database into its own file.
+        if not os.path.isdir(self.blob_dir):
+            os.makedirs(self.blob_dir)
+        
+        data = self.db.execute("SELECT data FROM files WHERE qpath = ?",
+                               (row[0],)).fetchone()[0] or b""
+        
+        f = open(self._blob_path(row[0]), "wb")
+        f.write(data)
+        f.close()
+        
+        self.db.execute("UPDATE files SET data = NULL, external = 1 WHERE qpath = ?",
+                        (row[0],))
+    
+    def _truncate(self, row, length):
+    
+        if row[9]:
+            f = open(self._blob_path(row[0]), "r+b")
+            f.truncate(length)
+            f.close()
+        else:
+            data = self.db.execute("SELECT data FROM files WHERE qpath = ?",
+                                   (row[0],)).fetchone()[0] or b""
+            data = data[:length] + b"\x00" * max(0, length - len(data))
+            self.db.execute("UPDATE files SET data = ? WHERE qpath = ?",
+                            (sqlite3.Binary(data), row[0]))
+        
+        self.db.execute("UPDATE files SET length = ?, mtime = ?, version = version + 1 "
+                        "WHERE qpath = ?", (length, int(time.time()), row[0]))
+    
+    def _rename(self, row, name):
+    
+        old_path = row[1]
+        new_path = self._join(old_path.rpartition(u"/")[0], name)
+        
+        self.db.execute("UPDATE files SET path = ?, name = ? WHERE qpath = ?",
+                        (new_path, name, row[0]))
+        
+        # Update the paths of everything beneath a directory. The range covers
+        # all paths that start with the old path followed by a slash.
+        if row[4] & styx.Stat.DMDIR:
+            n = len(old_path) + 1
+            self.db.execute(
+                "UPDATE files SET path = ? || substr(path, ?) "
+                "WHERE path >= ? AND path < ?",
+                (new_path, n, old_path + u"/", old_path + u"0"))
+        
+        # Also update the paths of any fids that refer to renamed objects.
+        for fid, path in self.paths.items():
+            if path == old_path or path.startswith(old_path + u"/"):
+                self.paths[fid] = new_path + path[len(old_path):]
+        
+        self._touch(row[2], int(time.time()))
+
+
+if __name__ == "__main__":
+
+    if len(sys.argv) != 3:
+        sys.stderr.write("Usage: %s <database> <port>\n" % sys.argv[0])
+        sys.exit(1)
+    
+    database = sys.argv[1]
+    port = int(sys.argv[2])
+    
+    store = SQLiteStore(database)
+    server = styxserver.StyxServer(store)
+    server.serve(b"", port)
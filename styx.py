@@ -17,7 +17,7 @@
 
 # Using the information from the Inferno man 5 pages.
 
-import struct
+import array, socket, struct
 
 class StringReceiver:
 
@@ -40,11 +40,146 @@ class SocketReceiver:
     def recv(self, n):
         data = b""
         while len(data) < n:
-            data += self.sock.recv(n - len(data))
+            piece = self.sock.recv(n - len(data))
+            if not piece:
+                raise EOFError("Connection closed.")
+            data += piece
         
         return data
 
 
+class BufferedReceiver:
+
+    """Reads from a socket in large pieces so that several messages sent
+    together can be decoded without a system call for each of them. Use the
+    same receiver for all the messages read from a socket."""
+    
+    MAX_READ = 1024 * 1024
+    
+    def __init__(self, sock, size = 65536):
+    
+        self.sock = sock
+        self.size = size
+        self.buffer = b""
+        self.ptr = 0
+    
+    def recv(self, n):
+    
+        end = self.ptr + n
+        if end <= len(self.buffer):
+            data = self.buffer[self.ptr:end]
+            self.ptr = end
+            return data
+        
+        pieces = [self.buffer[self.ptr:]]
+        available = len(pieces[0])
+        
+        while available < n:
+            # Limit the size of each read, since the socket allocates space
+            # for the amount requested before anything is received.
+            piece = self.sock.recv(min(max(self.size, n - available), self.MAX_READ))
+            if not piece:
+                raise EOFError("Connection closed.")
+            pieces.append(piece)
+            available += len(piece)
+        
+        self.buffer = b"".join(pieces)
+        self.ptr = n
+        return self.buffer[:n]
+    
+    def pending(self):
+    
+        """Returns the number of bytes that have been read from the socket but
+        not yet decoded."""
+        
+        return len(self.buffer) - self.ptr
+    
+    def ready(self):
+    
+        """Returns True if a complete message can be decoded without reading
+        from the socket."""
+        
+        if len(self.buffer) - self.ptr < 4:
+            return False
+        
+        size = struct.unpack_from("<I", self.buffer, self.ptr)[0]
+        return self.ptr + size <= len(self.buffer)
+
+
+class QueuedSender:
+
+    """Collects encoded messages instead of sending them immediately, so that
+    they can be sent together with a single system call by flush()."""
+    
+    # Avoid exceeding the limit on the number of buffers passed to sendmsg.
+    MAX_PIECES = 64
+    
+    def __init__(self, sock):
+    
+        self.sock = sock
+        self.pieces = []
+        
+        # The number of bytes waiting to be sent.
+        self.size = 0
+    
+    def sendall(self, data):
+    
+        self.pieces.append(data)
+        self.size += len(data)
+        if len(self.pieces) >= self.MAX_PIECES:
+            self.flush()
+    
+    def flush(self):
+    
+        pieces = self.pieces
+        if not pieces:
+            return
+        
+        self.pieces = []
+        self.size = 0
+        
+        if len(pieces) == 1 or not hasattr(self.sock, "sendmsg"):
+            self.sock.sendall(b"".join(pieces))
+            return
+        
+        sent = self.sock.sendmsg(pieces)
+        total = sum(map(len, pieces))
+        if sent < total:
+            self.sock.sendall(b"".join(pieces)[sent:])
+
+
+def set_tcp_options(sock, nodelay = None, cork = None):
+
+    """Sets the TCP_NODELAY and TCP_CORK options of a socket, if they are not
+    None and are supported by the socket, returning True if any were set."""
+    
+    changed = False
+    
+    for option, value in (("TCP_NODELAY", nodelay), ("TCP_CORK", cork)):
+        if value == None or not hasattr(socket, option):
+            continue
+        try:
+            sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, option), int(value))
+            changed = True
+        except (socket.error, OSError):
+            # The socket may not be a TCP socket.
+            pass
+    
+    return changed
+
+
+def unix_address(path):
+
+    """Returns the address of the Unix domain socket with the given path.
+    Paths that begin with "@" refer to sockets in the abstract namespace,
+    which is only available on Linux."""
+    
+    if path.startswith("@"):
+        return "\0" + path[1:]
+    
+    return path
+
+
 def decode_string(stream):
 
     length = struct.unpack("<H", stream.recv(2))[0]
@@ -99,12 +234,12 @@ def decode_format(stream, obj):
         elif name == "stat":
             value = Stat()
             value.decode(stream)
-        elif length in obj.__dict__:
-            value = stream.recv(obj.__dict__[length])
+        elif length in obj.__slots__:
+            value = stream.recv(getattr(obj, length))
         else:
             raise StyxError("decode_format: Unknown field length specifier: %s" % length)
         
-        obj.__dict__[name] = value
+        setattr(obj, name, value)
 
 def encode_format(stream, obj):
 
@@ -112,7 +247,7 @@ def encode_format(stream, obj):
     
     for name, length in obj.format:
     
-        value = obj.__dict__[name]
+        value = getattr(obj, name)
         
         if length == "s":
             # UTF-8 string
@@ -141,9 +276,24 @@ def encode_format(stream, obj):
 class StyxError(Exception):
     pass
 
+class FrameError(StyxError):
+
+    """Raised by decode() when a message is larger than allowed or does not
+    describe its contents correctly. The tag is that of the message, so that
+    an error can be sent in reply before the connection is closed."""
+    
+    def __init__(self, message, tag = None):
+    
+        StyxError.__init__(self, message)
+        self.tag = tag
+
 
 class StyxMessage:
 
+    # Messages store their fields in slots rather than dictionaries. Each
+    # subclass lists the fields in its format, and any others it uses.
+    __slots__ = ("size", "tag")
+    
     def init(self, size, tag):
     
         self.size = size
@@ -154,7 +304,7 @@ class StyxMessage:
         s = self.msg_name + "(tag=" + repr(self.tag)
         
         for name, length in self.format:
-            s += ", " + "%s=%s" % (name, repr(self.__dict__[name]))
+            s += ", " + "%s=%s" % (name, repr(getattr(self, name)))
         
         return s + ")"
     
@@ -173,6 +323,7 @@ class StyxMessage:
         # Finally, prepend the length to the byte string and send it.
         data = struct.pack("<I", len(data) + 4) + data
         stream.sendall(data)
+        return len(data)
 
 
 class Tversion(StyxMessage):
@@ -180,6 +331,7 @@ class Tversion(StyxMessage):
     msg_name = "Tversion"
     code = 100
     format = [("msize", 4), ("version", "s")]
+    __slots__ = ("msize", "version")
     
     def __init__(self, tag = None, msize = 0, version = ""):
     
@@ -192,6 +344,7 @@ class Rversion(StyxMessage):
     msg_name = "Rversion"
     code = 101
     format = [("msize", 4), ("version", "s")]
+    __slots__ = ("msize", "version")
     
     def __init__(self, tag = None, msize = 0, version = ""):
     
@@ -205,6 +358,7 @@ class Tattach(StyxMessage):
     msg_name = "Tattach"
     code = 104
     format = [("fid", 4), ("afid", 4), ("uname", "s"), ("aname", "s")]
+    __slots__ = ("fid", "afid", "uname", "aname")
     
     NOFID = 0xffffffff
     
@@ -221,6 +375,7 @@ class Rattach(StyxMessage):
     msg_name = "Rattach"
     code = 105
     format = [("qid", 13)]
+    __slots__ = ("qid",)
     
     def __init__(self, tag = None, qid = None):
     
@@ -233,6 +388,7 @@ class Rerror(StyxMessage):
     msg_name = "Rerror"
     code = 107
     format = [("ename", "s")]
+    __slots__ = ("ename",)
     
     def __init__(self, tag = None, ename = None):
     
@@ -244,18 +400,20 @@ class Tflush(StyxMessage):
 
     msg_name = "Tflush"
     code = 108
-    format = [("oldtag", 4)]
+    format = [("oldtag", 2)]
+    __slots__ = ("oldtag",)
     
-    def __init__(self, tag = None, fid = None):
+    def __init__(self, tag = None, oldtag = None):
     
         self.tag = tag
-        self.fid = fid
+        self.oldtag = oldtag
 
 class Rflush(StyxMessage):
 
     msg_name = "Rflush"
     code = 109
     format = []
+    __slots__ = ()
     
     def __init__(self, tag = None):
     
@@ -267,6 +425,7 @@ class Twalk(StyxMessage):
     msg_name = "Twalk"
     code = 110
     format = [("fid", 4), ("newfid", 4), ("nwname", 2)] # nwname of wname[s]
+    __slots__ = ("fid", "newfid", "nwname", "wname")
     
     def __init__(self, tag = None, fid = None, newfid = None, wname = []):
     
@@ -302,12 +461,14 @@ class Twalk(StyxMessage):
         
         data = struct.pack("<I", len(data) + 4) + data
         stream.sendall(data)
+        return len(data)
 
 class Rwalk(StyxMessage):
 
     msg_name = "Rwalk"
     code = 111
     format = [("nwqid", 2)] # nwqid of wqid[13]
+    __slots__ = ("nwqid", "wqid")
     
     def __init__(self, tag = None, wqid = []):
     
@@ -341,6 +502,7 @@ class Rwalk(StyxMessage):
         
         data = struct.pack("<I", len(data) + 4) + data
         stream.sendall(data)
+        return len(data)
 
 
 class Topen(StyxMessage):
@@ -348,6 +510,7 @@ class Topen(StyxMessage):
     msg_name = "Topen"
     code = 112
     format = [("fid", 4), ("mode", 1)]
+    __slots__ = ("fid", "mode")
     
     def __init__(self, tag = None, fid = None, mode = None):
     
@@ -360,6 +523,7 @@ class Ropen(StyxMessage):
     msg_name = "Ropen"
     code = 113
     format = [("qid", 13), ("iounit", 4)]
+    __slots__ = ("qid", "iounit")
     
     def __init__(self, tag = None, qid = None, iounit = None):
     
@@ -373,6 +537,7 @@ class Tcreate(StyxMessage):
     msg_name = "Tcreate"
     code = 114
     format = [("fid", 4), ("name", "s"), ("perm", 4), ("mode", 1)]
+    __slots__ = ("fid", "name", "perm", "mode")
     
     def __init__(self, tag = None, fid = None, name = "", perm = 0, mode = None):
     
@@ -387,6 +552,7 @@ class Rcreate(StyxMessage):
     msg_name = "Rcreate"
     code = 115
     format = [("qid", 13), ("iounit", 4)]
+    __slots__ = ("qid", "iounit")
     
     def __init__(self, tag = None, qid = None, iounit = None):
     
@@ -400,6 +566,7 @@ class Tread(StyxMessage):
     msg_name = "Tread"
     code = 116
     format = [("fid", 4), ("offset", 8), ("count", 4)]
+    __slots__ = ("fid", "offset", "count")
     
     def __init__(self, tag = None, fid = None, offset = 0, count = 0):
     
@@ -413,6 +580,7 @@ class Rread(StyxMessage):
     msg_name = "Rread"
     code = 117
     format = [("count", 4), ("data", "count")]
+    __slots__ = ("count", "data")
     
     def __init__(self, tag = None, data = ""):
     
@@ -426,6 +594,7 @@ class Twrite(StyxMessage):
     msg_name = "Twrite"
     code = 118
     format = [("fid", 4), ("offset", 8), ("count", 4), ("data", "count")]
+    __slots__ = ("fid", "offset", "count", "data")
     
     def __init__(self, tag = None, fid = None, offset = 0, data = ""):
     
@@ -440,6 +609,7 @@ class Rwrite(StyxMessage):
     msg_name = "Rwrite"
     code = 119
     format = [("count", 4)]
+    __slots__ = ("count",)
     
     def __init__(self, tag = None, count = 0):
     
@@ -452,6 +622,7 @@ class Tclunk(StyxMessage):
     msg_name = "Tclunk"
     code = 120
     format = [("fid", 4)]
+    __slots__ = ("fid",)
     
     def __init__(self, tag = None, fid = None):
     
@@ -463,6 +634,7 @@ class Rclunk(StyxMessage):
     msg_name = "Rclunk"
     code = 121
     format = []
+    __slots__ = ()
     
     def __init__(self, tag = None):
     
@@ -474,6 +646,7 @@ class Tremove(StyxMessage):
     msg_name = "Tremove"
     code = 122
     format = [("fid", 4)]
+    __slots__ = ("fid",)
     
     def __init__(self, tag = None, fid = None):
     
@@ -485,6 +658,7 @@ class Rremove(StyxMessage):
     msg_name = "Rremove"
     code = 123
     format = []
+    __slots__ = ()
     
     def __init__(self, tag = None):
     
@@ -496,6 +670,7 @@ class Tstat(StyxMessage):
     msg_name = "Tstat"
     code = 124
     format = [("fid", 4)]
+    __slots__ = ("fid",)
     
     def __init__(self, tag = None, fid = None):
     
@@ -510,6 +685,7 @@ class Rstat(StyxMessage):
     # stat[n] it includes a 16-bit length, but the stat object itself
     # includes its own length field.
     format = [("stat_size", 2), ("stat", "stat")]
+    __slots__ = ("stat_size", "stat")
     
     def __init__(self, tag = None, stat = None):
     
@@ -532,6 +708,7 @@ class Rstat(StyxMessage):
         
         data = struct.pack("<I", len(data) + 4) + data
         stream.sendall(data)
+        return len(data)
 
 
 class Twstat(StyxMessage):
@@ -542,6 +719,7 @@ class Twstat(StyxMessage):
     # stat[n] it includes a 16-bit length, but the stat object itself
     # includes its own length field.
     format = [("fid", 4), ("stat_size", 2), ("stat", "stat")]
+    __slots__ = ("fid", "stat_size", "stat")
     
     def __init__(self, tag = None, fid = None, stat = None):
     
@@ -557,16 +735,18 @@ class Twstat(StyxMessage):
         # Prepend the size of the stat structure itself.
         stat_data = encode_data(stat_data)
         
-        data = struct.pack("<BH", self.code, self.tag) + stat_data
+        data = struct.pack("<BHI", self.code, self.tag, self.fid) + stat_data
         
         data = struct.pack("<I", len(data) + 4) + data
         stream.sendall(data)
+        return len(data)
 
 class Rwstat(StyxMessage):
 
     msg_name = "Rwstat"
     code = 127
     format = []
+    __slots__ = ()
     
     def __init__(self, tag = None, stat = None):
     
@@ -585,6 +765,8 @@ class Stat:
         ("atime", 4), ("mtime", 4), ("length", 8), ("name", "s"), ("uid", "s"),
         ("gid", "s"), ("muid", "s")
         ]
+    __slots__ = ("size", "type", "dev", "qid", "mode", "atime", "mtime",
+                 "length", "name", "uid", "gid", "muid")
     
     def __init__(self, type = 0, dev = 0, qid = (0, 0, 0), mode = 0,
                        atime = 0, mtime = 0, length = 0, name = u"", uid = u"",
@@ -606,7 +788,7 @@ class Stat:
     
         pieces = []
         for name, length in self.format[1:]:
-            pieces.append("%s=%s" % (name, repr(self.__dict__[name])))
+            pieces.append("%s=%s" % (name, repr(getattr(self, name))))
         
         return "Stat(" + ", ".join(pieces) + ")"
     
@@ -616,11 +798,7 @@ class Stat:
             decode_format(stream, self)
             return self
         else:
-            stream = StringReceiver(data)
-            items = []
-            while stream.ptr < len(data):
-                items.append(Stat().decode(stream))
-            return items
+            return decode_stats(data).decode()
     
     def encode(self):
     
@@ -637,6 +815,200 @@ class Stat:
         return encode_data(data)
 
 
+# The fixed part of a stat entry, including its size, and the offset of the
+# length of the name within an entry.
+STAT_HEADER = struct.Struct("<HHIBIQIIIQ")
+STAT_NAME = STAT_HEADER.size
+
+def encode_stats(stats):
+
+    """Encodes a sequence of Stat objects or tuples of their fields, in the
+    order used by the Stat constructor, as a directory listing."""
+    
+    pack = STAT_HEADER.pack
+    pack_length = struct.Struct("<H").pack
+    pieces = []
+    append = pieces.append
+    
+    for s in stats:
+    
+        if isinstance(s, Stat):
+            s = (s.type, s.dev, s.qid, s.mode, s.atime, s.mtime, s.length,
+                 s.name, s.uid, s.gid, s.muid)
+        
+        type_, dev, qid, mode, atime, mtime, length, name, uid, gid, muid = s
+        
+        name = name.encode("utf8")
+        uid = uid.encode("utf8")
+        gid = gid.encode("utf8")
+        muid = muid.encode("utf8")
+        
+        # The size does not include the size field itself.
+        size = STAT_NAME + 6 + len(name) + len(uid) + len(gid) + len(muid)
+        append(pack(size, type_, dev, qid[0], qid[1], qid[2], mode,
+                    int(atime), int(mtime), length))
+        append(pack_length(len(name)))
+        append(name)
+        append(pack_length(len(uid)))
+        append(uid)
+        append(pack_length(len(gid)))
+        append(gid)
+        append(pack_length(len(muid)))
+        append(muid)
+    
+    return b"".join(pieces)
+
+def decode_stats(data):
+
+    """Returns a StatList describing the entries in a directory listing,
+    without decoding them."""
+    
+    view = memoryview(data)
+    offsets = array.array("L")
+    unpack_from = struct.unpack_from
+    end = len(view)
+    pos = 0
+    
+    while pos < end:
+        offsets.append(pos)
+        if pos + STAT_NAME > end:
+            raise StyxError("Truncated stat entry at offset %i." % pos)
+        pos += 2 + unpack_from("<H", view, pos)[0]
+    
+    if pos != end:
+        raise StyxError("Truncated stat entry at offset %i." % offsets[-1])
+    
+    return StatList(view, offsets)
+
+
+class StatList:
+
+    """A sequence of StatView objects for the entries in a directory listing,
+    which are only created when they are accessed."""
+    
+    def __init__(self, data, offsets):
+    
+        self.data = data
+        self.offsets = offsets
+    
+    def __len__(self):
+        return len(self.offsets)
+    
+    def __getitem__(self, index):
+    
+        if isinstance(index, slice):
+            return StatList(self.data, self.offsets[index])
+        
+        return StatView(self.data, self.offsets[index])
+    
+    def __iter__(self):
+    
+        data = self.data
+        for offset in self.offsets:
+            yield StatView(data, offset)
+    
+    def names(self):
+    
+        """Returns an iterator over the names of the entries."""
+        
+        data = self.data
+        unpack_from = struct.unpack_from
+        
+        for offset in self.offsets:
+            start = offset + STAT_NAME
+            length = unpack_from("<H", data, start)[0]
+            yield str(data[start + 2:start + 2 + length], "utf8")
+    
+    def find(self, name):
+    
+        """Returns a StatView for the entry with the given name, or None if
+        there is no such entry. Only the names are compared."""
+        
+        utf8 = name.encode("utf8")
+        key = struct.pack("<H", len(utf8)) + utf8
+        data = self.data
+        
+        for offset in self.offsets:
+            start = offset + STAT_NAME
+            if data[start:start + len(key)] == key:
+                return StatView(data, offset)
+        
+        return None
+    
+    def decode(self):
+    
+        """Returns a list of Stat objects for all the entries."""
+        
+        return [view.decode() for view in self]
+
+
+class StatView:
+
+    """Provides the same attributes as a Stat object for an entry in a
+    directory listing, decoding each of them when it is accessed."""
+    
+    __slots__ = ("data", "offset")
+    
+    def __init__(self, data, offset):
+    
+        self.data = data
+        self.offset = offset
+    
+    def _header(self):
+        return STAT_HEADER.unpack_from(self.data, self.offset)
+    
+    def _string(self, index):
+    
+        # Skip the strings before the one with the given index.
+        data = self.data
+        start = self.offset + STAT_NAME
+        
+        while True:
+            length = struct.unpack_from("<H", data, start)[0]
+            if index == 0:
+                return str(data[start + 2:start + 2 + length], "utf8")
+            start += 2 + length
+            index -= 1
+    
+    type = property(lambda self: self._header()[1])
+    dev = property(lambda self: self._header()[2])
+    qid = property(lambda self: self._header()[3:6])
+    mode = property(lambda self: self._header()[6])
+    atime = property(lambda self: self._header()[7])
+    mtime = property(lambda self: self._header()[8])
+    length = property(lambda self: self._header()[9])
+    name = property(lambda self: self._string(0))
+    uid = property(lambda self: self._string(1))
+    gid = property(lambda self: self._string(2))
+    muid = property(lambda self: self._string(3))
+    
+    def __repr__(self):
+        return "StatView(offset=%i, name=%s)" % (self.offset, repr(self.name))
+    
+    def decode(self):
+    
+        """Returns a Stat object containing all the fields of the entry."""
+        
+        h = self._header()
+        data = self.data
+        start = self.offset + STAT_NAME
+        strings = []
+        
+        for i in range(4):
+            length = struct.unpack_from("<H", data, start)[0]
+            strings.append(str(data[start + 2:start + 2 + length], "utf8"))
+            start += 2 + length
+        
+        return Stat(h[1], h[2], h[3:6], h[6], h[7], h[8], h[9], *strings)
+    
+    def encode(self):
+    
+        """Returns the encoded entry without decoding it."""
+        
+        size = struct.unpack_from("<H", self.data, self.offset)[0]
+        return bytes(self.data[self.offset:self.offset + 2 + size])
+
+
 class File:
 
     OREAD = 0
@@ -653,6 +1025,9 @@ class File:
     def read(self, offset, count):
         return self.client.read(self.fid, offset, count)
     
+    def write(self, offset, data):
+        return self.client.write(self.fid, offset, data)
+    
     def close(self):
         self.client._clunk(self.fid)
 
@@ -687,9 +1062,66 @@ MessageTypes = {
     Rwstat.code: Rwstat 
     }
 
-def decode(sock = None, data = None):
+class MessagePool:
+
+    """Keeps a few message objects of each of the most frequently used types
+    so that they can be reused instead of allocating new ones. A pool should
+    only be used by one connection at a time, and a message must not be used
+    after it has been returned to the pool with put()."""
+    
+    TYPES = (Tread, Rread, Twrite, Rwrite, Tstat, Rstat, Tclunk, Rclunk)
+    
+    def __init__(self, size = 4, types = TYPES):
+    
+        self.size = size
+        self.free = dict((cls, []) for cls in types)
+        self.created = 0
+        self.reused = 0
+    
+    def get(self, cls):
+    
+        """Returns an object of the given message class, ready to be decoded.
+        An object that is reused keeps the values of the fields of the message
+        it last held until they are overwritten."""
+        
+        free = self.free.get(cls)
+        if free:
+            self.reused += 1
+            return free.pop()
+        
+        self.created += 1
+        return cls()
+    
+    def new(self, cls, *args):
+    
+        """Returns an object of the given message class initialised with the
+        arguments, as if the class had been called with them."""
+        
+        free = self.free.get(cls)
+        if free:
+            self.reused += 1
+            msg = free.pop()
+            msg.__init__(*args)
+            return msg
+        
+        self.created += 1
+        return cls(*args)
+    
+    def put(self, msg):
+    
+        free = self.free.get(msg.__class__)
+        if free != None and len(free) < self.size:
+            free.append(msg)
+
+
+def decode(sock = None, data = None, pool = None, stream = None,
+           max_size = None):
 
-    if sock:
+    # The stream can be a receiver, such as a BufferedReceiver, that is used
+    # for all the messages read from a socket.
+    if stream != None:
+        pass
+    elif sock:
         stream = SocketReceiver(sock)
     elif data:
         stream = StringReceiver(data)
@@ -701,11 +1133,46 @@ def decode(sock = None, data = None):
     message_type = struct.unpack("<b", stream.recv(1))[0]
     tag = struct.unpack("<H", stream.recv(2))[0]
     
+    if max_size != None:
+        return decode_frame(size, message_type, tag, stream, pool, max_size)
+    
     # Find the relevant message class to handle this type and create an
     # instance of it to parse the message data.
     try:
         Message = MessageTypes[message_type]
+        if pool != None:
+            return pool.get(Message).decode(size, tag, stream)
         return Message().decode(size, tag, stream)
     except:
         #return size, message_type, tag, stream
         raise
+
+
+def decode_frame(size, message_type, tag, stream, pool, max_size):
+
+    # Read exactly the rest of the message before decoding it, so that the
+    # lengths of its fields cannot cause more than max_size bytes to be read.
+    if size > max_size:
+        raise FrameError("Message too large.", tag)
+    elif size < 7:
+        raise FrameError("Message too small.", tag)
+    
+    Message = MessageTypes.get(message_type)
+    if Message == None:
+        raise FrameError("Unknown message type.", tag)
+    
+    body = StringReceiver(stream.recv(size - 7))
+    
+    try:
+        if pool != None:
+            message = pool.get(Message).decode(size, tag, body)
+        else:
+            message = Message().decode(size, tag, body)
+    except Exception:
+        # The body has been read, so no error can be caused by the stream.
+        raise FrameError("Malformed message.", tag)
+    
+    if body.ptr != size - 7:
+        raise FrameError("Malformed message.", tag)
+    
+    return message
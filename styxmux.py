@@ -0,0 +1,573 @@
+#!/usr/bin/env python
+
+# styxmux.py - Multiplexes many Styx client connections onto a few upstream
+#              connections.
+#
+# Copyright (C) 2018 David Boddie <david@boddie.org.uk>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import socket, sys, threading
+import styx
+
+NOTAG = 0xffff
+NOFID = 0xffffffff
+
+class MuxError(Exception):
+    pass
+
+
+class FidAllocator:
+
+    """Allocates fids for use on upstream connections. Fids are unique across
+    all connections so that they remain valid for servers that share a single
+    table of fids between clients. They start at a high number to keep them
+    apart from the fids used by clients connected directly to the same server.
+    """
+    
+    FID_BASE = 0x40000000
+    
+    def __init__(self):
+    
+        self.lock = threading.Lock()
+        self.next = self.FID_BASE
+        self.free = []
+    
+    def alloc(self):
+    
+        self.lock.acquire()
+        try:
+            if self.free:
+                return self.free.pop()
+            
+            fid = self.next
+            self.next += 1
+            return fid
+        finally:
+            self.lock.release()
+    
+    def release(self, fid):
+    
+        self.lock.acquire()
+        self.free.append(fid)
+        self.lock.release()
+
+
+class Upstream:
+
+    """Represents a connection to the upstream server. Requests are sent with
+    tags allocated by this object and replies are passed to the callbacks
+    supplied with each request by a thread that reads from the connection.
+    """
+    
+    def __init__(self, host, port, msize, fids):
+    
+        self.socket = socket.create_connection((host, port))
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.fids = fids
+        
+        self.lock = threading.Lock()
+        self.send_lock = threading.Lock()
+        self.pending = {}
+        self.next_tag = 0
+        
+        # The reason that the connection stopped working, if it has.
+        self.error = None
+        
+        # Negotiate the version before any other messages are sent.
+        styx.Tversion(NOTAG, msize, u"9P2000").encode(self.socket)
+        reply = styx.decode(sock=self.socket)
+        
+        if not isinstance(reply, styx.Rversion) or reply.version != u"9P2000":
+            raise MuxError("Upstream server does not support 9P2000.")
+        
+        self.msize = min(msize, reply.msize)
+        
+        # Attached root fids and qids for each user and tree.
+        self.roots = {}
+        
+        self.thread = threading.Thread(target=self.read_replies)
+        self.thread.daemon = True
+        self.thread.start()
+    
+    def request(self, msg, callback):
+    
+        # Allocate a tag that is not in use by an outstanding request.
+        self.lock.acquire()
+        try:
+            if self.error != None:
+                raise MuxError(self.error)
+            
+            while self.next_tag in self.pending:
+                self.next_tag = (self.next_tag + 1) % NOTAG
+            
+            tag = self.next_tag
+            self.next_tag = (tag + 1) % NOTAG
+            self.pending[tag] = callback
+        finally:
+            self.lock.release()
+        
+        msg.tag = tag
+        
+        self.send_lock.acquire()
+        try:
+            msg.encode(self.socket)
+        except socket.error as e:
+            self.lock.acquire()
+            callback = self.pending.pop(tag, None)
+            self.lock.release()
+            
+            self.fail(u"Upstream connection lost: %s" % e)
+            
+            # The callback has been called if the connection was found to
+            # have failed by the thread reading replies.
+            if callback != None:
+                raise MuxError(self.error)
+        finally:
+            self.send_lock.release()
+        
+        return tag
+    
+    def call(self, msg):
+    
+        # Send a request and wait for its reply.
+        event = threading.Event()
+        result = []
+        
+        def callback(reply):
+            result.append(reply)
+            event.set()
+        
+        self.request(msg, callback)
+        event.wait()
+        
+        return result[0]
+    
+    def cancel(self, tag):
+    
+        # Forget about a request so that any reply to it is discarded.
+        # Returns True if no reply to it had been received.
+        self.lock.acquire()
+        callback = self.pending.pop(tag, None)
+        self.lock.release()
+        
+        return callback != None
+    
+    def read_replies(self):
+    
+        try:
+            while True:
+            
+                try:
+                    reply = styx.decode(sock=self.socket)
+                except (EOFError, socket.error):
+                    break
+                
+                self.lock.acquire()
+                callback = self.pending.pop(reply.tag, None)
+                self.lock.release()
+                
+                if callback != None:
+                    callback(reply)
+        finally:
+            self.fail(u"Upstream connection lost.")
+    
+    def fail(self, message):
+    
+        # Mark the connection as unusable and answer the requests waiting for
+        # replies with errors, so that their clients are not left waiting.
+        self.lock.acquire()
+        if self.error == None:
+            self.error = message
+        pending = self.pending
+        self.pending = {}
+        self.lock.release()
+        
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        
+        for tag, callback in pending.items():
+            callback(styx.Rerror(tag, self.error))
+    
+    def root(self, uname, aname):
+    
+        # Attach once for each user and tree, sharing the root fid between all
+        # the clients that attach with the same details.
+        key = (uname, aname)
+        
+        self.lock.acquire()
+        try:
+            event = self.roots.get(key)
+            if event == None:
+                self.roots[key] = event = threading.Event()
+                owner = True
+            else:
+                owner = False
+        finally:
+            self.lock.release()
+        
+        if owner:
+            fid = self.fids.alloc()
+            try:
+                reply = self.call(styx.Tattach(fid=fid, afid=NOFID, uname=uname,
+                                               aname=aname))
+            except MuxError as e:
+                reply = styx.Rerror(NOTAG, str(e))
+            if isinstance(reply, styx.Rerror):
+                self.fids.release(fid)
+                event.root = None
+                event.error = reply.ename
+                # Allow a later attach to try again.
+                self.lock.acquire()
+                del self.roots[key]
+                self.lock.release()
+            else:
+                event.root = (fid, reply.qid)
+            event.set()
+        else:
+            event.wait()
+        
+        if event.root == None:
+            raise MuxError(event.error)
+        
+        return event.root
+
+
+class Session:
+
+    """Represents a connection from a downstream client. Fids and tags used by
+    the client are mapped to those used on the upstream connection.
+    """
+    
+    def __init__(self, mux, conn, upstream):
+    
+        self.mux = mux
+        self.conn = conn
+        self.upstream = upstream
+        
+        self.send_lock = threading.Lock()
+        self.lock = threading.Lock()
+        
+        # Downstream fid -> upstream fid, downstream tag -> (upstream tag,
+        # function to call if the request is flushed before it is answered).
+        self.fids = {}
+        self.tags = {}
+    
+    def reply(self, msg):
+    
+        self.send_lock.acquire()
+        try:
+            msg.encode(self.conn)
+        except socket.error:
+            pass
+        finally:
+            self.send_lock.release()
+    
+    def run(self):
+    
+        try:
+            while True:
+            
+                try:
+                    msg = styx.decode(sock=self.conn)
+                except (EOFError, socket.error):
+                    break
+                
+                handler = self.handlers.get(msg.code, Session.forward)
+                
+                try:
+                    handler(self, msg)
+                except MuxError as e:
+                    self.reply(styx.Rerror(msg.tag, str(e)))
+                except socket.error:
+                    break
+        finally:
+            self.close()
+    
+    def close(self):
+    
+        self.close_fids()
+        
+        try:
+            self.conn.close()
+        except socket.error:
+            pass
+    
+    def close_fids(self):
+    
+        # Clunk any fids that the client left behind.
+        self.lock.acquire()
+        fids = list(self.fids.values())
+        self.fids.clear()
+        self.lock.release()
+        
+        for ufid in fids:
+            try:
+                self.upstream.request(styx.Tclunk(fid=ufid),
+                                      lambda reply, ufid=ufid: self.mux.fids.release(ufid))
+            except MuxError:
+                self.mux.fids.release(ufid)
+    
+    def _ufid(self, fid):
+    
+        try:
+            return self.fids[fid]
+        except KeyError:
+            raise MuxError("Unknown fid.")
+    
+    def _send(self, msg, tag, callback, flushed = None):
+    
+        # Send the message upstream, recording its tag so that it can be
+        # flushed, and pass the reply to the callback with the client's tag.
+        # If the request is flushed before a reply arrives, the callback is
+        # not called but the flushed function is, if given.
+        def on_reply(reply):
+        
+            self.lock.acquire()
+            self.tags.pop(tag, None)
+            self.lock.release()
+            
+            # The callback can return a different reply to send to the client.
+            reply = callback(reply) or reply
+            reply.tag = tag
+            self.reply(reply)
+        
+        self.lock.acquire()
+        self.tags[tag] = None
+        self.lock.release()
+        
+        try:
+            utag = self.upstream.request(msg, on_reply)
+        except MuxError as e:
+            # Answer the request as if the upstream server had failed it.
+            on_reply(styx.Rerror(tag, str(e)))
+            return
+        
+        self.lock.acquire()
+        if tag in self.tags:
+            self.tags[tag] = (utag, flushed)
+        self.lock.release()
+    
+    def Tversion(self, msg):
+    
+        # Versions are negotiated locally. Starting a new session releases all
+        # the fids belonging to the old one.
+        self.close_fids()
+        
+        if msg.version.startswith(u"9P2000"):
+            version = u"9P2000"
+        else:
+            version = u"unknown"
+        
+        msize = min(msg.msize, self.upstream.msize)
+        self.reply(styx.Rversion(msg.tag, msize, version))
+    
+    def Tattach(self, msg):
+    
+        if msg.fid in self.fids:
+            raise MuxError("Fid in use.")
+        
+        # Clone the shared root fid instead of attaching again.
+        root_fid, qid = self.upstream.root(msg.uname, msg.aname)
+        
+        fid = msg.fid
+        ufid = self.mux.fids.alloc()
+        self.fids[fid] = ufid
+        
+        def callback(reply):
+        
+            if isinstance(reply, styx.Rerror):
+                self._release(fid, ufid)
+            else:
+                return styx.Rattach(reply.tag, qid)
+        
+        self._send(styx.Twalk(fid=root_fid, newfid=ufid, wname=[]), msg.tag,
+                   callback, lambda: self._release(fid, ufid))
+    
+    def Twalk(self, msg):
+    
+        fid = msg.fid
+        newfid = msg.newfid
+        ufid = self._ufid(fid)
+        
+        if newfid == fid:
+            unewfid = ufid
+        elif newfid in self.fids:
+            raise MuxError("Fid in use.")
+        else:
+            unewfid = self.mux.fids.alloc()
+            self.fids[newfid] = unewfid
+        
+        nwname = len(msg.wname)
+        
+        def callback(reply):
+        
+            # The new fid is only valid if every element was walked.
+            if newfid != fid:
+                if isinstance(reply, styx.Rerror) or reply.nwqid < nwname:
+                    self._release(newfid, unewfid)
+        
+        # A walk that is flushed does not create the new fid.
+        if newfid != fid:
+            flushed = lambda: self._release(newfid, unewfid)
+        else:
+            flushed = None
+        
+        msg.fid = ufid
+        msg.newfid = unewfid
+        self._send(msg, msg.tag, callback, flushed)
+    
+    def Tclunk(self, msg):
+    
+        fid = msg.fid
+        ufid = self._ufid(fid)
+        
+        def callback(reply):
+            # The fid is released whether or not the request succeeded.
+            self._release(fid, ufid)
+        
+        msg.fid = ufid
+        self._send(msg, msg.tag, callback)
+    
+    Tremove = Tclunk
+    
+    def Tflush(self, msg):
+    
+        self.lock.acquire()
+        entry = self.tags.get(msg.oldtag)
+        self.lock.release()
+        
+        if entry == None:
+            # The request has already been answered, or was never sent.
+            self.reply(styx.Rflush(msg.tag))
+            return
+        
+        utag, flushed = entry
+        
+        def callback(reply):
+            # The upstream server will not reply to the old request now. If
+            # it had not already replied, undo anything that the old request
+            # would have done with its reply.
+            if self.upstream.cancel(utag) and flushed != None:
+                flushed()
+            self.lock.acquire()
+            self.tags.pop(msg.oldtag, None)
+            self.lock.release()
+        
+        self._send(styx.Tflush(oldtag=utag), msg.tag, callback)
+    
+    def forward(self, msg):
+    
+        # Messages that refer to an existing fid without changing it.
+        if msg.code not in self.forwarded:
+            raise MuxError("Unsupported message.")
+        
+        msg.fid = self._ufid(msg.fid)
+        self._send(msg, msg.tag, lambda reply: None)
+    
+    def _release(self, fid, ufid):
+    
+        self.lock.acquire()
+        if self.fids.get(fid) == ufid:
+            del self.fids[fid]
+        self.lock.release()
+        
+        self.mux.fids.release(ufid)
+    
+    handlers = {
+        styx.Tversion.code: Tversion,
+        styx.Tattach.code: Tattach,
+        styx.Twalk.code: Twalk,
+        styx.Tclunk.code: Tclunk,
+        styx.Tremove.code: Tremove,
+        styx.Tflush.code: Tflush
+        }
+    
+    forwarded = set([styx.Topen.code, styx.Tcreate.code, styx.Tread.code,
+                     styx.Twrite.code, styx.Tstat.code, styx.Twstat.code])
+
+
+class StyxMux:
+
+    """Accepts connections from clients and forwards their requests over a
+    small number of persistent connections to an upstream server. Each client
+    is assigned to one of the upstream connections in turn.
+    """
+    
+    MSIZE = 65536 + 24
+    
+    def __init__(self, host, port, connections = 1, msize = MSIZE):
+    
+        self.host = host
+        self.port = port
+        self.msize = msize
+        self.fids = FidAllocator()
+        self.upstreams = []
+        
+        for i in range(connections):
+            self.upstreams.append(Upstream(host, port, msize, self.fids))
+        
+        self.next_upstream = 0
+    
+    def serve(self, host, port):
+    
+        s = socket.socket()
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        s.bind((host, port))
+        s.listen(128)
+        
+        while True:
+        
+            conn, client = s.accept()
+            
+            i = self.next_upstream
+            self.next_upstream = (i + 1) % len(self.upstreams)
+            
+            # Replace connections that have failed. Clients that were using
+            # them receive errors for all their requests and need to attach
+            # again.
+            upstream = self.upstreams[i]
+            if upstream.error != None:
+                try:
+                    upstream = self.upstreams[i] = Upstream(
+                        self.host, self.port, self.msize, self.fids)
+                except (EOFError, socket.error, MuxError):
+                    conn.close()
+                    continue
+            
+            session = Session(self, conn, upstream)
+            t = threading.Thread(target=session.run)
+            t.daemon = True
+            t.start()
+
+
+if __name__ == "__main__":
+
+    if not 4 <= len(sys.argv) <= 5:
+        sys.stderr.write("Usage: %s <upstream host> <upstream port> <port> [connections]\n" % sys.argv[0])
+        sys.exit(1)
+    
+    host = sys.argv[1]
+    upstream_port = int(sys.argv[2])
+    port = int(sys.argv[3])
+    
+    if len(sys.argv) == 5:
+        connections = int(sys.argv[4])
+    else:
+        connections = 1
+    
+    mux = StyxMux(host, upstream_port, connections)
+    mux.serve(b"", port)
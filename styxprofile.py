@@ -0,0 +1,285 @@
+# styxprofile.py - A sampling profiler for servers that can be started and
+#                  stopped while they are running.
+#
+# Copyright (C) 2018 David Boddie <david@boddie.org.uk>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os, signal, sys, threading, time
+import styx, styxserver, styxspans
+
+# The names of the methods that the server calls on stores.
+STORE_METHODS = set(["get_root_qid", "get_qid_path", "set_qid_path",
+                     "make_qid", "free_qid_path", "stat", "create", "open",
+                     "is_opened", "read", "write", "remove", "wstat"])
+
+class SamplingProfiler:
+
+    """Periodically samples the stacks of the threads that are handling
+    connections for a server, attributing each sample to the type of message
+    being handled and the store method being called, if any. Threads waiting
+    for requests are not sampled. Nothing is done until start() is called,
+    so the profiler costs nothing while it is stopped."""
+    
+    def __init__(self, interval = 0.01):
+    
+        self.interval = interval
+        self.thread = None
+        self.running = False
+        self.lock = threading.Lock()
+        
+        # Collapsed stacks -> number of samples, and (message type, store
+        # method) -> number of samples.
+        self.stacks = {}
+        self.requests = {}
+        self.samples = 0
+        self.started = None
+        self.stopped = None
+        
+        self.handle_code = styxserver.StyxServer.handle.__code__
+        self.wait_codes = (styx.SocketReceiver.recv.__code__,
+                           styx.BufferedReceiver.recv.__code__)
+        self.handler_codes = dict((f.__code__, f.__name__)
+                                  for f in styxserver.StyxServer.handlers.values())
+        self.labels = {}
+    
+    def start(self):
+    
+        self.lock.acquire()
+        try:
+            if self.running:
+                return False
+            
+            self.stacks = {}
+            self.requests = {}
+            self.samples = 0
+            self.started = time.time()
+            self.running = True
+            
+            self.thread = threading.Thread(target=self.run)
+            self.thread.daemon = True
+            self.thread.start()
+            return True
+        finally:
+            self.lock.release()
+    
+    def stop(self):
+    
+        self.lock.acquire()
+        try:
+            if not self.running:
+                return False
+            self.running = False
+            thread = self.thread
+        finally:
+            self.lock.release()
+        
+        thread.join()
+        self.stopped = time.time()
+        return True
+    
+    def run(self):
+    
+        ident = threading.get_ident()
+        next_sample = time.time()
+        
+        while self.running:
+        
+            for thread_ident, frame in sys._current_frames().items():
+                if thread_ident != ident:
+                    self.sample(frame)
+            
+            # Keep to the interval on average, without trying to catch up
+            # after long pauses.
+            next_sample = max(next_sample + self.interval, time.time())
+            time.sleep(max(next_sample - time.time(), 0))
+    
+    def sample(self, frame):
+    
+        # Collect the frames from the innermost outwards, stopping at the
+        # frame of the server's connection handler.
+        if frame.f_code in self.wait_codes:
+            return
+        
+        frames = []
+        while frame != None:
+            frames.append(frame.f_code)
+            if frame.f_code is self.handle_code:
+                break
+            frame = frame.f_back
+        else:
+            # The thread is not handling a connection.
+            return
+        
+        frames.reverse()
+        
+        # The handler for the message is called from the connection handler,
+        # and it calls the store method. Samples taken outside handlers are
+        # attributed to decoding, encoding or the server itself.
+        if len(frames) > 1 and frames[1].co_name in ("decode", "encode"):
+            message = u"[%s]" % frames[1].co_name
+        else:
+            message = u"[server]"
+        method = None
+        
+        for i, code in enumerate(frames):
+            name = self.handler_codes.get(code)
+            if name != None:
+                message = name
+                method = self._store_method(frames[i + 1:])
+                break
+        
+        if method == None and len(frames) > 1:
+            # Fids left by disconnected clients are freed by the connection
+            # handler itself.
+            method = self._store_method(frames[1:])
+        
+        stack = [message]
+        if method != None:
+            stack.append(u"store:" + method)
+        stack += [self._label(code) for code in frames]
+        key = u";".join(stack)
+        
+        self.stacks[key] = self.stacks.get(key, 0) + 1
+        request = (message, method)
+        self.requests[request] = self.requests.get(request, 0) + 1
+        self.samples += 1
+    
+    def _store_method(self, frames):
+    
+        # Stores wrapped by styxspans.TracedStore are called through wrapper
+        # functions, so look past these to find the store method itself.
+        for code in frames:
+            if code.co_filename != styxspans.__file__:
+                if code.co_name in STORE_METHODS:
+                    return code.co_name
+                break
+        return None
+    
+    def _label(self, code):
+    
+        label = self.labels.get(code)
+        if label == None:
+            label = self.labels[code] = u"%s (%s:%i)" % (
+                code.co_name, os.path.basename(code.co_filename), code.co_firstlineno)
+        return label
+    
+    def write_collapsed(self, path):
+    
+        """Writes the samples as collapsed stacks, one per line followed by
+        the number of samples, as used by flame graph tools."""
+        
+        f = open(path, "w")
+        for stack, count in sorted(self.stacks.items()):
+            f.write(u"%s %i\n" % (stack, count))
+        f.close()
+    
+    def report(self):
+    
+        """Returns a summary of the samples taken for each message type and
+        store method."""
+        
+        lines = [u"%i samples in %.1f s" % (self.samples,
+                                             (self.stopped or time.time()) - self.started)]
+        
+        for (message, method), count in sorted(self.requests.items(),
+                                               key=lambda item: -item[1]):
+            lines.append(u"%6.1f%% %8i  %s %s" % (
+                100.0 * count / max(self.samples, 1), count, message, method or u""))
+        
+        return u"\n".join(lines) + u"\n"
+
+
+class ProfilerControl:
+
+    """Starts and stops a profiler when the process receives a signal or when
+    "start" or "stop" is written to a control file, writing the samples to a
+    collapsed stack file when the profiler stops. Worker processes forked from
+    the process write to files with their process IDs appended to the names.
+    """
+    
+    def __init__(self, profiler, path, signum = signal.SIGUSR1,
+                 control = None, poll = 0.5):
+    
+        self.profiler = profiler
+        self.path = path
+        self.control = control
+        self.poll = poll
+        self.pid = os.getpid()
+        
+        signal.signal(signum, self.toggle)
+        
+        if control != None:
+            # Ignore any command already in the control file.
+            try:
+                mtime = os.stat(control).st_mtime
+            except OSError:
+                mtime = None
+            
+            t = threading.Thread(target=self.watch, args=(mtime,))
+            t.daemon = True
+            t.start()
+    
+    def toggle(self, signum = None, frame = None):
+    
+        if self.profiler.running:
+            self.stop()
+        else:
+            self.start()
+    
+    def start(self):
+    
+        if self.profiler.start():
+            sys.stderr.write("Profiling started in process %i.\n" % os.getpid())
+    
+    def stop(self):
+    
+        if not self.profiler.stop():
+            return
+        
+        path = self.path
+        if os.getpid() != self.pid:
+            path = "%s.%i" % (path, os.getpid())
+        
+        self.profiler.write_collapsed(path)
+        sys.stderr.write("Profiling stopped. Collapsed stacks written to %s.\n" % path)
+        sys.stderr.write(self.profiler.report())
+    
+    def watch(self, mtime):
+    
+        # The thread that watches the control file does not survive forking,
+        # so only the original process can be controlled in this way.
+        
+        while True:
+        
+            time.sleep(self.poll)
+            
+            try:
+                new_mtime = os.stat(self.control).st_mtime
+            except OSError:
+                continue
+            
+            if new_mtime == mtime:
+                continue
+            mtime = new_mtime
+            
+            try:
+                command = open(self.control).read().strip()
+            except IOError:
+                continue
+            
+            if command == "start":
+                self.start()
+            elif command == "stop":
+                self.stop()
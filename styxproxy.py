@@ -0,0 +1,610 @@
+#!/usr/bin/env python
+
+# styxproxy.py - Re-exports the contents of another Styx server with caching.
+#
+# Copyright (C) 2018 David Boddie <david@boddie.org.uk>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import collections, sys, threading, time
+import client, styx, styxserver
+
+class Coalescer:
+
+    """Ensures that only one call is made for each key at a time. Callers that
+    ask for a key while a call for it is in progress wait for that call to
+    finish and share its result. Calls that fail because they were flushed on
+    behalf of the caller that made them are not shared; the callers waiting
+    for them make the call again.
+    """
+    
+    def __init__(self):
+    
+        self.lock = threading.Lock()
+        self.pending = {}
+    
+    def call(self, key, function, *args):
+    
+        while True:
+        
+            self.lock.acquire()
+            try:
+                pending = self.pending.get(key)
+                if pending == None:
+                    pending = self.pending[key] = [threading.Event(), None, None]
+                    owner = True
+                else:
+                    owner = False
+            finally:
+                self.lock.release()
+            
+            if owner:
+                break
+            
+            pending[0].wait()
+            if isinstance(pending[2], client.FlushedError):
+                continue
+            elif pending[2] != None:
+                raise pending[2]
+            return pending[1]
+        
+        try:
+            pending[1] = function(*args)
+        except Exception as e:
+            pending[2] = e
+            raise
+        finally:
+            self.lock.acquire()
+            del self.pending[key]
+            self.lock.release()
+            pending[0].set()
+        
+        return pending[1]
+
+
+class BlockCache:
+
+    """Holds blocks of file data in least recently used order, discarding the
+    oldest blocks when the total size of the blocks exceeds the budget.
+    """
+    
+    def __init__(self, budget):
+    
+        self.budget = budget
+        self.size = 0
+        self.blocks = collections.OrderedDict()
+        self.lock = threading.Lock()
+    
+    def get(self, key):
+    
+        self.lock.acquire()
+        try:
+            value = self.blocks.pop(key, None)
+            if value != None:
+                self.blocks[key] = value
+            return value
+        finally:
+            self.lock.release()
+    
+    def put(self, key, value):
+    
+        self.lock.acquire()
+        try:
+            old = self.blocks.pop(key, None)
+            if old != None:
+                self.size -= len(old[1])
+            
+            self.blocks[key] = value
+            self.size += len(value[1])
+            
+            while self.size > self.budget and self.blocks:
+                k, v = self.blocks.popitem(last=False)
+                self.size -= len(v[1])
+        finally:
+            self.lock.release()
+    
+    def discard(self, qpath):
+    
+        self.lock.acquire()
+        try:
+            for key in [k for k in self.blocks if k[0] == qpath]:
+                self.size -= len(self.blocks.pop(key)[1])
+        finally:
+            self.lock.release()
+
+
+class ProxyStore:
+
+    """Maintains information about files and directories held by an upstream
+    Styx server, accessed using a client.Client object. Qids, stat information,
+    directory listings and blocks of file data are cached. Cached metadata is
+    refreshed after ttl seconds, and file blocks are keyed by qid version so
+    that changes reported by the upstream server cause them to be fetched
+    again. Identical upstream requests made at the same time are combined.
+    """
+    
+    def __init__(self, upstream, ttl = 5.0, cache_size = 64 * 1024 * 1024):
+    
+        self.upstream = upstream
+        self.ttl = ttl
+        
+        self.qids = {}
+        self.paths = {}
+        self.opened = {}
+        self.root_fid = None
+        
+        # Upstream fids for opened downstream fids, and the qids returned by
+        # the upstream server when they were opened.
+        self.upstream_fids = {}
+        self.open_qids = {}
+        
+        # Cached (expiry time, stat) values for paths and (expiry time, qid
+        # version, data) values for directory listings.
+        self.stats = {}
+        self.listings = {}
+        self.blocks = BlockCache(cache_size)
+        self.block_size = upstream.msize - 24
+        
+        # Hits and misses for each of the caches.
+        self.hits = {u"stat": 0, u"listing": 0, u"block": 0}
+        self.misses = {u"stat": 0, u"listing": 0, u"block": 0}
+        
+        # The client can only send one request at a time.
+        self.lock = threading.Lock()
+        self.coalescer = Coalescer()
+        
+        # The call that each thread is making on behalf of a caller that may
+        # cancel it, and the calls that have been cancelled. These have their
+        # own lock so that calls can be cancelled while they are in progress.
+        self.calls = threading.local()
+        self.cancelled = set()
+        self.cancel_lock = threading.Lock()
+    
+    def get_root_qid(self, fid, afid, uname, aname):
+    
+        qid = self.make_qid(u"/")
+        self.set_qid_path(fid, qid, u"/")
+        self.root_fid = fid
+        return qid
+    
+    def get_qid_path(self, fid):
+    
+        return self.qids[fid], self.paths[fid]
+    
+    def set_qid_path(self, fid, qid, path):
+    
+        path = path.lstrip(u"/")
+        
+        self.qids[fid] = qid
+        self.paths[fid] = path
+    
+    def make_qid(self, path):
+    
+        s = self._cached_stat(self._normalise(path))
+        
+        if s == None:
+            return None
+        
+        return s.qid
+    
+    def free_qid_path(self, fid):
+    
+        del self.qids[fid]
+        del self.paths[fid]
+        
+        if fid in self.opened:
+            del self.opened[fid]
+        
+        upstream_fid = self.upstream_fids.pop(fid, None)
+        self.open_qids.pop(fid, None)
+        
+        if upstream_fid != None:
+            self._call(self.upstream._clunk, upstream_fid)
+    
+    def stat(self, fid):
+    
+        return self._cached_stat(self._normalise(self.paths[fid]))
+    
+    def create(self, fid, name, perm):
+    
+        if fid in self.opened:
+            return False
+        
+        path = self._normalise(self.paths[fid])
+        
+        try:
+            upstream_fid = self._call(self._create, path, name, perm)
+        except client.ClientError:
+            return False
+        
+        new_path = self._join(path, name)
+        self._invalidate(path)
+        self._invalidate(new_path)
+        
+        qid = self.make_qid(new_path)
+        self.set_qid_path(fid, qid, new_path)
+        
+        # The upstream fid is already open for the new object, so it is
+        # clunked and opened again with the mode that the server asks for.
+        self._call(self.upstream._clunk, upstream_fid)
+        
+        return qid
+    
+    def open(self, fid, mode):
+    
+        if fid in self.opened:
+            self.opened[fid] = mode
+            if mode & styx.Stat.DMEXCL:
+                return False
+        else:
+            self.opened[fid] = mode
+        
+        path = self._normalise(self.paths[fid])
+        
+        try:
+            upstream_fid, qid = self._call(self._open, path, mode)
+        except client.ClientError:
+            del self.opened[fid]
+            return False
+        
+        self.upstream_fids[fid] = upstream_fid
+        self.open_qids[fid] = qid
+        
+        # Opening a file validates any cached information about it.
+        cached = self.stats.get(path)
+        if cached != None and cached[1] != None and cached[1].qid != qid:
+            self._invalidate(path)
+            self.blocks.discard(qid[2])
+        
+        if mode & 0x10:
+            self._invalidate(path)
+            self.blocks.discard(qid[2])
+        
+        return True
+    
+    def is_opened(self, fid):
+    
+        return fid in self.opened
+    
+    def read(self, fid, offset, count):
+    
+        path = self._normalise(self.paths[fid])
+        qid = self.open_qids.get(fid, self.qids[fid])
+        
+        if qid[0] & 0x80:
+            data = self._listing(path, fid)
+            return data[offset:offset + count]
+        
+        data = b""
+        block_size = self.block_size
+        
+        # Assemble the data from the blocks that cover the range requested.
+        while len(data) < count:
+        
+            position = offset + len(data)
+            index = position // block_size
+            block = self._block(fid, qid, index)
+            
+            start = position - (index * block_size)
+            piece = block[start:start + count - len(data)]
+            data += piece
+            
+            # Stop at the end of the file.
+            if len(block) < block_size or not piece:
+                break
+        
+        return data
+    
+    def write(self, fid, offset, data):
+    
+        path = self._normalise(self.paths[fid])
+        qid = self.qids[fid]
+        
+        if qid[0] & 0x80:
+            return -1
+        
+        upstream_fid = self.upstream_fids.get(fid)
+        if upstream_fid == None:
+            return -2
+        
+        written = 0
+        
+        try:
+            while written < len(data):
+                piece = data[written:written + self.block_size]
+                reply = self._call(self.upstream.send, styx.Twrite(
+                    tag=2, fid=upstream_fid, offset=offset + written, data=piece))
+                written += reply.count
+                if reply.count < len(piece):
+                    break
+        except client.ClientError:
+            pass
+        
+        self._invalidate(path)
+        self.blocks.discard(qid[2])
+        
+        return written
+    
+    def remove(self, fid):
+    
+        path = self._normalise(self.paths[fid])
+        
+        try:
+            self._call(self._remove, path)
+        except client.ClientError as e:
+            return str(e)
+        
+        self._invalidate(path)
+        self._invalidate(path.rpartition(u"/")[0])
+        self.blocks.discard(self.qids[fid][2])
+        
+        return True
+    
+    def wstat(self, fid, st):
+    
+        path = self._normalise(self.paths[fid])
+        
+        try:
+            self._call(self._wstat, path, st)
+        except client.ClientError:
+            pass
+        
+        parent = path.rpartition(u"/")[0]
+        self._invalidate(path)
+        self._invalidate(parent)
+        self.blocks.discard(self.qids[fid][2])
+        
+        if st.name != u"" and st.name != path.rpartition(u"/")[2]:
+            self.paths[fid] = self._join(parent, st.name)
+    
+    def begin_call(self, call):
+    
+        """Identifies the requests made by the current thread, until
+        end_call() is called, as belonging to the given call object, so that
+        they can be cancelled with cancel()."""
+        
+        self.calls.current = call
+    
+    def end_call(self, call):
+    
+        self.calls.current = None
+        
+        self.cancel_lock.acquire()
+        self.cancelled.discard(call)
+        self.cancel_lock.release()
+    
+    def cancel(self, call):
+    
+        """Abandons the requests made for the given call. The upstream request
+        in progress is flushed if it belongs to the call, and any later
+        requests for the call fail without being sent."""
+        
+        self.cancel_lock.acquire()
+        self.cancelled.add(call)
+        self.cancel_lock.release()
+        
+        return self.upstream.flush(call)
+    
+    # Cache methods
+    
+    def cache_counters(self):
+    
+        """Returns a dictionary mapping the name of each cache to its numbers
+        of hits and misses."""
+        
+        return dict((name, (self.hits[name], self.misses[name])) for name in self.hits)
+    
+    def _cached_stat(self, path):
+    
+        cached = self.stats.get(path)
+        
+        if cached != None and cached[0] > time.time():
+            self.hits[u"stat"] += 1
+            return cached[1]
+        
+        self.misses[u"stat"] += 1
+        
+        try:
+            s = self.coalescer.call(("stat", path), self._fetch_stat, path)
+        except client.FlushedError:
+            raise
+        except client.ClientError:
+            # Other errors are reported as missing files but are not cached,
+            # so that the next request asks the upstream server again.
+            return None
+        
+        self.stats[path] = (time.time() + self.ttl, s)
+        return s
+    
+    def _listing(self, path, fid):
+    
+        qid = self.open_qids.get(fid, self.qids[fid])
+        cached = self.listings.get(path)
+        
+        if cached != None and cached[0] > time.time() and cached[1] == qid[1]:
+            self.hits[u"listing"] += 1
+            return cached[2]
+        
+        self.misses[u"listing"] += 1
+        data = self.coalescer.call(("list", path), self._call, self._read_all, path)
+        self.listings[path] = (time.time() + self.ttl, qid[1], data)
+        return data
+    
+    def _block(self, fid, qid, index):
+    
+        key = (qid[2], qid[1], index)
+        cached = self.blocks.get(key)
+        
+        if cached != None and cached[0] > time.time():
+            self.hits[u"block"] += 1
+            return cached[1]
+        
+        self.misses[u"block"] += 1
+        block = self.coalescer.call(key, self._fetch_block, fid, index)
+        self.blocks.put(key, (time.time() + self.ttl, block))
+        return block
+    
+    def _invalidate(self, path):
+    
+        self.stats.pop(path, None)
+        self.listings.pop(path, None)
+    
+    # Upstream methods
+    
+    def _call(self, function, *args):
+    
+        call = getattr(self.calls, "current", None)
+        
+        self.lock.acquire()
+        try:
+            self.cancel_lock.acquire()
+            cancelled = call in self.cancelled
+            self.cancel_lock.release()
+            
+            if cancelled:
+                raise client.FlushedError("Request cancelled.")
+            
+            self.upstream.owner = call
+            return function(*args)
+        finally:
+            self.upstream.owner = None
+            self.lock.release()
+    
+    def _fetch_stat(self, path):
+    
+        # Only the absence of a file is remembered.
+        try:
+            return self._call(self._stat, path)
+        except client.NotFoundError:
+            return None
+    
+    def _fetch_block(self, fid, index):
+    
+        upstream_fid = self.upstream_fids[fid]
+        reply = self._call(self.upstream.send, styx.Tread(
+            tag=2, fid=upstream_fid, offset=index * self.block_size,
+            count=self.block_size))
+        return reply.data
+    
+    def _stat(self, path):
+    
+        fid = self.upstream._walk(path)
+        try:
+            return self.upstream._stat(fid)
+        finally:
+            self.upstream._clunk_old(fid)
+    
+    def _open(self, path, mode):
+    
+        fid = self.upstream._walk(path)
+        try:
+            reply = self.upstream.send(styx.Topen(tag=2, fid=fid, mode=mode))
+        except client.ClientError:
+            self.upstream._clunk_old(fid)
+            raise
+        
+        return fid, reply.qid
+    
+    def _create(self, path, name, perm):
+    
+        fid = self.upstream._walk(path)
+        try:
+            self.upstream.send(styx.Tcreate(tag=2, fid=fid, name=name,
+                                            perm=perm, mode=0))
+        except client.ClientError:
+            self.upstream._clunk_old(fid)
+            raise
+        
+        return fid
+    
+    def _read_all(self, path):
+    
+        fid, qid = self._open(path, 0)
+        data = b""
+        
+        try:
+            while True:
+                reply = self.upstream.send(styx.Tread(
+                    tag=2, fid=fid, offset=len(data), count=self.block_size))
+                if len(reply.data) == 0:
+                    break
+                data += reply.data
+        finally:
+            self.upstream._clunk_old(fid)
+        
+        return data
+    
+    def _remove(self, path):
+    
+        fid = self.upstream._walk(path)
+        try:
+            self.upstream.send(styx.Tremove(tag=2, fid=fid))
+        finally:
+            # The fid is clunked by the remove request, even if it fails.
+            self.upstream.fids.discard(fid)
+    
+    def _wstat(self, path, st):
+    
+        fid = self.upstream._walk(path)
+        try:
+            self.upstream.send(styx.Twstat(tag=2, fid=fid, stat=st))
+        finally:
+            self.upstream._clunk_old(fid)
+    
+    # Helper methods
+    
+    def _normalise(self, path):
+    
+        return u"/".join(p for p in path.split(u"/") if p)
+    
+    def _join(self, path, name):
+    
+        if path:
+            return path + u"/" + name
+        else:
+            return name
+
+
+class StyxProxy(styxserver.StyxServer):
+
+    """Serves the contents of an upstream Styx server, using a ProxyStore to
+    cache information obtained from it.
+    """
+    
+    def __init__(self, host, port, uname = u"", aname = u"", ttl = 5.0,
+                 cache_size = 64 * 1024 * 1024):
+    
+        self.upstream = client.Client(host, port, uname, aname)
+        styxserver.StyxServer.__init__(self, ProxyStore(self.upstream, ttl, cache_size))
+
+
+if __name__ == "__main__":
+
+    if not 4 <= len(sys.argv) <= 5:
+        sys.stderr.write("Usage: %s <upstream host> <upstream port> <port> [ttl]\n" % sys.argv[0])
+        sys.exit(1)
+    
+    host = sys.argv[1]
+    upstream_port = int(sys.argv[2])
+    port = int(sys.argv[3])
+    
+    if len(sys.argv) == 5:
+        ttl = float(sys.argv[4])
+    else:
+        ttl = 5.0
+    
+    # Serve each client in its own thread so that identical requests from
+    # different clients can be combined.
+    server = StyxProxy(host, upstream_port, ttl=ttl)
+    server.serve(b"", port, threaded=True)
@@ -15,7 +15,7 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import socket
+import errno, itertools, os, select, signal, socket, stat, struct, sys, threading, time
 import styx
 
 class StyxServerError(Exception):
@@ -25,42 +25,608 @@ class StyxServer:
 
     MAX_MSG_SIZE = 0
     
-    def __init__(self, store):
+    # Messages that refer to existing fids.
+    fid_messages = set([styx.Twalk.code, styx.Topen.code, styx.Tcreate.code,
+                        styx.Tread.code, styx.Twrite.code, styx.Tclunk.code,
+                        styx.Tremove.code, styx.Tstat.code, styx.Twstat.code])
+    
+    def __init__(self, store, recorder = None):
     
         self.store = store
         self.clients = {}
+        
+        # An object with connect, record and disconnect methods that is given
+        # each message received, such as a styxtrace.TraceRecorder.
+        self.recorder = recorder
+        
+        # A styxstats.Metrics object, if metrics are enabled.
+        self.metrics = None
+        
+        # An object with start and stop methods that is told when each phase
+        # of handling a request begins and ends, such as a styxspans.Hooks
+        # object, if tracing is enabled.
+        self.hooks = None
+        
+        # The styx.MessagePool objects used by each client, if message
+        # objects are reused.
+        self.pool_size = None
+        self.pools = {}
+        
+        # How replies are sent: whether Nagle's algorithm is disabled,
+        # whether the connection is corked while more requests are waiting
+        # to be handled, and whether the replies to those requests are
+        # collected and sent together.
+        self.nodelay = True
+        self.cork = False
+        self.coalesce = True
+        
+        # The fids used by each client are mapped to fids that are unique in
+        # the store, so that clients served at the same time do not interfere
+        # with each other. The fid that each client attached with is recorded
+        # so that clunking it disconnects the client.
+        self.fids = {}
+        self.roots = {}
+        self.free_fids = []
+        self.next_fid = 0
+        self.fid_lock = threading.Lock()
+        
+        self.connection_numbers = itertools.count(1)
+        
+        # Limits on the resources used by each connection and by the server
+        # as a whole. None means that there is no limit.
+        self.max_frame = None
+        self.max_fids = None
+        self.max_requests = None
+        self.max_output = None
+        self.send_timeout = None
+        self.max_connections = None
+        self.max_server_fids = None
+        self.connection_lock = threading.Lock()
+    
+    def enable_metrics(self, path = u".styxstats"):
+    
+        """Collects metrics about the requests handled by the server and makes
+        them available in a read-only directory at the given path, alongside
+        the contents of the store. This should be called before serving."""
+        
+        import mountserver, styxstats
+        
+        self.metrics = styxstats.Metrics(self, self.store)
+        
+        store = mountserver.MountStore()
+        store.mount(u"", self.store)
+        store.mount(path, styxstats.StatsStore(self.metrics))
+        self.store = store
+        
+        return self.metrics
+    
+    def enable_tracing(self, hooks):
+    
+        """Reports the start and end of each phase of handling requests to the
+        given hooks object: decoding, dispatching to a handler, calls to the
+        store and encoding the reply. This should be called after
+        enable_metrics() if both are used."""
+        
+        import styxspans
+        
+        self.hooks = hooks
+        self.store = styxspans.TracedStore(self.store, hooks)
+    
+    def enable_message_pools(self, size = 4):
+    
+        """Reuses the objects for the most frequently sent and received
+        messages, keeping up to the given number of each type for each
+        connection. This should be called before serving."""
+        
+        self.pool_size = size
+    
+    def configure_sockets(self, nodelay = True, cork = False, coalesce = True):
+    
+        """Sets the policy used to send replies on each connection. If nodelay
+        is True, TCP_NODELAY is set so that the kernel does not hold back
+        small replies. If cork is True, TCP_CORK is set while requests that
+        have already been received are handled, and cleared when there are no
+        more. If coalesce is True, the replies to those requests are collected
+        and sent together with a single system call. This should be called
+        before serving."""
+        
+        self.nodelay = nodelay
+        self.cork = cork
+        self.coalesce = coalesce
+    
+    def configure_limits(self, max_frame = None, max_fids = None,
+                         max_requests = None, max_output = None,
+                         send_timeout = None, max_connections = None,
+                         max_server_fids = None):
     
-    def serve(self, host, port):
+        """Limits the resources that clients can use. Messages larger than
+        max_frame bytes are refused and the connection is closed; clients are
+        also told to use no more than this in reply to Tversion. Each
+        connection can use up to max_fids fids, and the server up to
+        max_server_fids, with requests for more failing with an error.
+        
+        When a client sends requests without reading the replies, the server
+        stops reading requests from it while max_requests replies, or
+        max_output bytes of them, are waiting to be sent, until they have
+        been sent. If a reply cannot be sent for send_timeout seconds, the
+        client is disconnected. Connections made when max_connections
+        clients are already connected are closed immediately.
+        
+        Each time a limit is reached, it is recorded in the server's metrics,
+        if they are enabled. This should be called before serving."""
+        
+        self.max_frame = max_frame
+        self.max_fids = max_fids
+        self.max_requests = max_requests
+        self.max_output = max_output
+        self.send_timeout = send_timeout
+        self.max_connections = max_connections
+        self.max_server_fids = max_server_fids
+    
+    def parse_limits(self, text):
+    
+        """Configures the limits described by a string containing
+        comma-separated name=value pairs, such as "max_fids=1024,
+        send_timeout=30", using the names of configure_limits arguments."""
+        
+        limits = {}
+        
+        for item in text.split(","):
+            name, value = item.split("=")
+            name = name.strip()
+            if name == "send_timeout":
+                limits[name] = float(value)
+            else:
+                limits[name] = int(value)
+        
+        self.configure_limits(**limits)
+    
+    def limit_reached(self, client, limit):
+    
+        if self.metrics != None:
+            self.metrics.limit_reached(client, limit)
+    
+    def new_reply(self, client, cls, *args):
+    
+        pool = self.pools.get(client)
+        if pool != None:
+            return pool.new(cls, *args)
+        
+        return cls(*args)
+    
+    def serve(self, host, port, threaded = False):
+    
+        s = self.listen(host, port)
+        self.accept(s, threaded)
+    
+    def serve_unix(self, path, threaded = False):
+    
+        s = self.listen_unix(path)
+        self.accept(s, threaded)
+    
+    def listen(self, host, port, reuse_port = False):
     
         s = socket.socket()
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        
+        if reuse_port:
+            # Allow other processes to listen on the same port, leaving the
+            # kernel to distribute connections between them.
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        
         s.bind((host, port))
-        s.listen(1)
+        s.listen(5)
+        return s
+    
+    def listen_unix(self, path):
+    
+        """Listens on a Unix domain socket with the given path, replacing any
+        socket that already exists there. Paths that begin with "@" are in the
+        abstract namespace and do not appear in the file system."""
+        
+        address = styx.unix_address(path)
+        
+        if address == path:
+            try:
+                if stat.S_ISSOCK(os.stat(path).st_mode):
+                    os.unlink(path)
+            except OSError:
+                pass
+        
+        s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        s.bind(address)
+        s.listen(5)
+        return s
+    
+    def connect_pair(self):
+    
+        """Returns a socket connected to the server by a socket pair, for use
+        by a client in the same process, and handles requests received from
+        it in a new thread."""
+        
+        conn, other = socket.socketpair()
         
+        t = threading.Thread(target=self.handle,
+                             args=(conn, self._client_name(u"pair")))
+        t.daemon = True
+        t.start()
+        
+        return other
+    
+    def _client_name(self, kind):
+    
+        # Clients connected by Unix domain sockets and socket pairs have no
+        # addresses, so give each of them a number instead.
+        return (kind, next(self.connection_numbers))
+    
+    def accept(self, s, threaded = False):
+    
         while True:
         
             conn, client = s.accept()
-            self.clients[client] = self.store
+            
+            if not isinstance(client, tuple):
+                client = self._client_name(u"unix")
+            
+            if threaded:
+                # Handle each connection in its own thread so that several
+                # clients can be served at the same time.
+                t = threading.Thread(target=self.handle, args=(conn, client))
+                t.daemon = True
+                t.start()
+            else:
+                self.handle(conn, client)
+    
+    def serve_workers(self, host, port, workers, threaded = False):
+    
+        """Forks the given number of worker processes, each accepting and
+        handling connections, and restarts any workers that exit. Any caches
+        in the store should be built before this is called so that they are
+        shared between the workers."""
+        
+        # Each worker listens on its own socket if the system allows sockets
+        # to share a port. Otherwise, they all accept connections from a
+        # socket created here. If the port is None then the host is the path
+        # of a Unix domain socket, which is always shared.
+        if port == None:
+            shared = self.listen_unix(host)
+        elif hasattr(socket, "SO_REUSEPORT"):
+            shared = None
+        else:
+            shared = self.listen(host, port)
+        
+        children = {}
+        
+        def spawn(number):
+        
+            pid = os.fork()
+            if pid == 0:
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                signal.signal(signal.SIGINT, signal.SIG_DFL)
+                try:
+                    if shared == None:
+                        self.accept(self.listen(host, port, True), threaded)
+                    else:
+                        self.accept(shared, threaded)
+                finally:
+                    os._exit(1)
+            
+            children[pid] = (number, time.time())
+        
+        def stop(signum, frame):
+            sys.exit(0)
+        
+        signal.signal(signal.SIGTERM, stop)
+        
+        try:
+            for number in range(workers):
+                spawn(number)
+            
+            while True:
+            
+                pid, status = os.wait()
+                if pid not in children:
+                    continue
+                
+                number, started = children.pop(pid)
+                
+                # Avoid restarting workers in a tight loop if they fail as
+                # soon as they start.
+                if time.time() - started < 1:
+                    time.sleep(1)
+                
+                spawn(number)
+        
+        finally:
+            for pid in children:
+                try:
+                    os.kill(pid, signal.SIGTERM)
+                except OSError:
+                    pass
+            for pid in children:
+                try:
+                    os.waitpid(pid, 0)
+                except OSError:
+                    pass
+    
+    def handle(self, conn, client):
+    
+        self.connection_lock.acquire()
+        try:
+            refused = self.max_connections != None and \
+                      len(self.clients) >= self.max_connections
+            if not refused:
+                self.clients[client] = self.store
+        finally:
+            self.connection_lock.release()
+        
+        if refused:
+            self.limit_reached(client, "connections")
+            conn.close()
+            return
+        
+        self.fids[client] = {}
+        
+        recorder = self.recorder
+        if recorder != None:
+            connection = recorder.connect()
+        
+        metrics = self.metrics
+        if metrics != None:
+            metrics.connect(client)
+        
+        # The connection is always cleaned up, even if handling a request
+        # fails unexpectedly.
+        sender = conn
+        
+        try:
+            hooks = self.hooks
+            
+            pool = None
+            if self.pool_size != None:
+                pool = self.pools[client] = styx.MessagePool(self.pool_size)
+            
+            # Requests are read in large pieces. If they arrive faster than they
+            # can be handled, the replies to them are collected until there are
+            # no more requests waiting, then sent together.
+            receiver = styx.BufferedReceiver(conn)
+            if self.coalesce:
+                sender = styx.QueuedSender(conn)
+            else:
+                sender = conn
+            
+            styx.set_tcp_options(conn, nodelay=self.nodelay)
+            corked = False
+            
+            # Sending fails instead of waiting indefinitely for a client that
+            # does not read its replies.
+            if self.send_timeout != None:
+                seconds = int(self.send_timeout)
+                microseconds = int((self.send_timeout - seconds) * 1000000)
+                conn.setsockopt(socket.SOL_SOCKET, socket.SO_SNDTIMEO,
+                                struct.pack("ll", seconds, microseconds))
+            
+            # The number of replies waiting to be sent.
+            queued = 0
+            
+            # Messages are read in the same way whether or not their size is
+            # limited, so that malformed messages are always detected.
+            max_frame = self.max_frame
+            if max_frame == None:
+                max_frame = 0xffffffff
             
             while client in self.clients:
             
-                message = styx.decode(sock=conn)
+                try:
+                    if hooks != None:
+                        # Wait for a request so that the time spent waiting is not
+                        # included in the time taken to decode it.
+                        if not receiver.ready():
+                            select.select([conn], [], [])
+                        hooks.start("decode", client, None)
+                    
+                    message = styx.decode(pool=pool, stream=receiver,
+                                          max_size=max_frame)
+                    
+                    if self.cork and not corked and receiver.ready():
+                        corked = styx.set_tcp_options(conn, cork=True)
+                except (EOFError, socket.error):
+                    # The connection was closed by the client.
+                    break
+                except styx.FrameError as e:
+                    # The rest of the message cannot be read safely, so reply with
+                    # an error, if possible, and close the connection.
+                    self.limit_reached(client, "frame")
+                    if e.tag != None:
+                        try:
+                            styx.Rerror(e.tag, str(e)).encode(sender)
+                        except socket.error:
+                            pass
+                    break
+                
+                if hooks != None:
+                    hooks.stop("decode", client, message, message.size)
+                    hooks.start("dispatch", client, message)
+                
+                # Record the message before its fids are changed.
+                if recorder != None:
+                    recorder.record(connection, message)
+                
+                fid = new_fid = None
+                
+                if metrics != None:
+                    started = time.time()
+                    metrics.begin()
                 
                 try:
                     handler = self.handlers[message.code]
+                    fid, new_fid = self.map_fids(client, message)
                     reply = handler(self, client, message)
                 except KeyError:
                     reply = styx.Rerror(message.tag, "Unsupported message.")
                 except StyxServerError as e:
-                    reply = styx.Rerror(message.tag, e.message)
-                except socket.error:
-                    # The connection was probably closed by the client.
+                    reply = styx.Rerror(message.tag, str(e))
+                
+                self.unmap_fids(client, message, fid, new_fid, reply)
+                
+                if hooks != None:
+                    hooks.stop("dispatch", client, message)
+                    hooks.start("encode", client, reply)
+                
+                sent = 0
+                try:
+                    sent = reply.encode(sender)
+                    queued += 1
+                    
+                    if not receiver.ready():
+                        if sender is not conn:
+                            sender.flush()
+                        queued = 0
+                        if corked:
+                            corked = not styx.set_tcp_options(conn, cork=False)
+                    
+                    elif sender is not conn and \
+                         ((self.max_requests != None and queued >= self.max_requests) or
+                          (self.max_output != None and sender.size >= self.max_output)):
+                        # Stop reading requests until the replies to earlier ones
+                        # have been sent, so that a client cannot make the server
+                        # hold more replies than allowed by not reading them.
+                        self.limit_reached(client, "output")
+                        sender.flush()
+                        queued = 0
+                
+                except socket.error as e:
+                    if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                        self.limit_reached(client, "send_timeout")
                     break
+                finally:
+                    if metrics != None:
+                        metrics.end(client, message, reply, sent, time.time() - started)
+                    if hooks != None:
+                        hooks.stop("encode", client, reply, sent)
                 
-                reply.encode(conn)
+                if pool != None:
+                    pool.put(message)
+                    pool.put(reply)
+        finally:
+            # Send any replies that are still waiting, such as the reply to a
+            # request that disconnected the client.
+            if sender is not conn:
+                try:
+                    sender.flush()
+                except socket.error:
+                    pass
+            
+            self.clients.pop(client, None)
+            self.roots.pop(client, None)
+            self.pools.pop(client, None)
+            
+            # Release any fids that the client did not clunk.
+            for fid in self.fids.pop(client).values():
+                try:
+                    self.store.free_qid_path(fid)
+                except KeyError:
+                    pass
+                self.release_fid(fid)
+            
+            if recorder != None:
+                recorder.disconnect(connection)
+            
+            if metrics != None:
+                metrics.disconnect(client)
+            
+            conn.close()
+    
+    def map_fids(self, client, msg):
+    
+        # Replace the client's fids in the message with those used in the
+        # store, allocating new ones for fids that the message introduces.
+        # Returns the client's fid and the new fid, if any.
+        fids = self.fids[client]
+        fid = new_fid = None
+        
+        if msg.code in self.fid_messages:
+            fid = msg.fid
+            if fid not in fids:
+                raise StyxServerError("Unknown fid.")
+            msg.fid = fids[fid]
+        
+        if msg.code == styx.Tattach.code:
+            new_fid = msg.fid
+        elif msg.code == styx.Twalk.code and msg.newfid != fid:
+            new_fid = msg.newfid
+        
+        if new_fid != None:
+            if new_fid in fids:
+                raise StyxServerError("Fid in use.")
+            
+            if self.max_fids != None and len(fids) >= self.max_fids:
+                self.limit_reached(client, "fids")
+                raise StyxServerError("Too many fids.")
+            
+            try:
+                fids[new_fid] = self.alloc_fid()
+            except StyxServerError:
+                self.limit_reached(client, "server_fids")
+                raise
+            
+            if msg.code == styx.Tattach.code:
+                msg.fid = fids[new_fid]
+            else:
+                msg.newfid = fids[new_fid]
+        
+        elif msg.code == styx.Twalk.code:
+            msg.newfid = msg.fid
+        
+        return fid, new_fid
+    
+    def unmap_fids(self, client, msg, fid, new_fid, reply):
+    
+        fids = self.fids[client]
+        
+        # Release new fids if the message failed to make use of them.
+        if new_fid != None:
+            if isinstance(reply, styx.Rerror) or \
+               (msg.code == styx.Twalk.code and len(reply.wqid) < len(msg.wname)):
+                self.release_fid(fids.pop(new_fid))
+            elif msg.code == styx.Tattach.code:
+                self.roots[client] = fids[new_fid]
+        
+        # Clunked and removed fids are released whether or not the request
+        # succeeded.
+        if msg.code in (styx.Tclunk.code, styx.Tremove.code) and fid in fids:
+            self.release_fid(fids.pop(fid))
+    
+    def alloc_fid(self):
+    
+        self.fid_lock.acquire()
+        try:
+            if self.free_fids:
+                return self.free_fids.pop()
+            
+            # All the fids allocated so far are in use.
+            if self.max_server_fids != None and self.next_fid >= self.max_server_fids:
+                raise StyxServerError("Too many fids in use.")
+            
+            fid = self.next_fid
+            self.next_fid += 1
+            return fid
+        finally:
+            self.fid_lock.release()
+    
+    def release_fid(self, fid):
+    
+        self.fid_lock.acquire()
+        self.free_fids.append(fid)
+        self.fid_lock.release()
     
     def Tversion(self, client, msg):
     
-        return styx.Rversion(msg.tag, msg.msize, msg.version)
+        msize = msg.msize
+        if self.max_frame != None:
+            msize = min(msize, self.max_frame)
+        
+        return styx.Rversion(msg.tag, msize, msg.version)
     
     def Tattach(self, client, msg):
     
@@ -80,7 +646,7 @@ class StyxServer:
         if s == None:
             return styx.Rerror(msg.tag, "Not found.")
         
-        return styx.Rstat(msg.tag, s)
+        return self.new_reply(client, styx.Rstat, msg.tag, s)
     
     def Twalk(self, client, msg):
     
@@ -156,7 +722,7 @@ class StyxServer:
         # The fid must have an existing qid.
         data = store.read(msg.fid, msg.offset, msg.count)
         
-        return styx.Rread(msg.tag, data)
+        return self.new_reply(client, styx.Rread, msg.tag, data)
     
     def Twrite(self, client, msg):
     
@@ -170,7 +736,7 @@ class StyxServer:
         elif count != len(msg.data):
             return styx.Rerror(msg.tag, "Failed to write data.")
         
-        return styx.Rwrite(msg.tag, count)
+        return self.new_reply(client, styx.Rwrite, msg.tag, count)
     
     def Tclunk(self, client, msg):
     
@@ -181,10 +747,10 @@ class StyxServer:
         
         # Additionally, if the fid refers to the root of the file system then
         # remove the client from the clients dictionary to disconnect it.
-        if msg.fid == store.root_fid:
+        if msg.fid == self.roots.get(client):
             del self.clients[client]
         
-        return styx.Rclunk(msg.tag)
+        return self.new_reply(client, styx.Rclunk, msg.tag)
     
     def Tremove(self, client, msg):
     
@@ -0,0 +1,277 @@
+# styxspans.py - Hooks for measuring the time taken by each phase of handling
+#                requests.
+#
+# Copyright (C) 2018 David Boddie <david@boddie.org.uk>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import json, os, threading, time
+
+class Hooks:
+
+    """Receives events from a server when it starts and stops each phase of
+    handling a request. The phases are "decode", "dispatch" and "encode", with
+    "store.<method>" phases inside "dispatch" for each call to the store.
+    
+    The client is the address of the connection and msg is the message being
+    decoded, dispatched or encoded. Both are None when decoding starts and for
+    store calls, which are made by the thread dispatching the request. The
+    size is the number of bytes decoded or encoded, or zero.
+    
+    Both methods are called on the thread handling the connection, so they
+    should return quickly. This class does nothing with the events.
+    """
+    
+    def start(self, phase, client, msg):
+        pass
+    
+    def stop(self, phase, client, msg, size = 0):
+        pass
+
+
+class HookList(Hooks):
+
+    """Passes events to each of a list of hooks objects."""
+    
+    def __init__(self, hooks):
+    
+        self.hooks = hooks
+    
+    def start(self, phase, client, msg):
+    
+        for hooks in self.hooks:
+            hooks.start(phase, client, msg)
+    
+    def stop(self, phase, client, msg, size = 0):
+    
+        for hooks in self.hooks:
+            hooks.stop(phase, client, msg, size)
+
+
+class TracedStore:
+
+    """Passes calls to a store, reporting the start and end of each call to
+    the hooks object. Other attributes are read from the store."""
+    
+    def __init__(self, store, hooks):
+    
+        self.store = store
+        self.hooks = hooks
+    
+    def __getattr__(self, name):
+    
+        value = getattr(self.store, name)
+        if not callable(value):
+            return value
+        
+        phase = "store." + name
+        hooks = self.hooks
+        
+        def call(*args):
+            hooks.start(phase, None, None)
+            try:
+                return value(*args)
+            finally:
+                hooks.stop(phase, None, None)
+        
+        # Keep the wrapper so that later calls do not need to make another.
+        self.__dict__[name] = call
+        return call
+
+
+class PhaseTimer(Hooks):
+
+    """Records when each phase started on each thread, and the request being
+    dispatched, so that subclasses can work out how long each phase took."""
+    
+    def __init__(self):
+    
+        self.local = threading.local()
+    
+    def start(self, phase, client, msg):
+    
+        local = self.local
+        try:
+            starts = local.starts
+        except AttributeError:
+            starts = local.starts = {}
+        
+        starts[phase] = time.perf_counter()
+        
+        if phase == "dispatch":
+            local.msg = msg
+    
+    def stop(self, phase, client, msg, size = 0):
+    
+        now = time.perf_counter()
+        local = self.local
+        started = local.starts.pop(phase, None)
+        if started == None:
+            return
+        
+        # Store calls are attributed to the request being dispatched.
+        request = getattr(local, "msg", None)
+        if msg == None:
+            msg = request
+        
+        self.span(phase, client, msg, size, started, now)
+        
+        if phase == "dispatch":
+            local.msg = None
+    
+    def span(self, phase, client, msg, size, started, finished):
+        pass
+
+
+class SpanCollector(PhaseTimer):
+
+    """Adds up the time spent in each phase for each type of message."""
+    
+    def __init__(self):
+    
+        PhaseTimer.__init__(self)
+        self.lock = threading.Lock()
+        # (phase, message type) -> [count, seconds, longest, bytes]
+        self.totals = {}
+    
+    def span(self, phase, client, msg, size, started, finished):
+    
+        if msg == None:
+            key = (phase, u"")
+        else:
+            key = (phase, msg.msg_name)
+        
+        elapsed = finished - started
+        
+        self.lock.acquire()
+        try:
+            entry = self.totals.get(key)
+            if entry == None:
+                entry = self.totals[key] = [0, 0.0, 0.0, 0]
+            entry[0] += 1
+            entry[1] += elapsed
+            entry[2] = max(entry[2], elapsed)
+            entry[3] += size
+        finally:
+            self.lock.release()
+    
+    def phases(self):
+    
+        """Returns a dictionary mapping each phase to its count, total time,
+        longest time and number of bytes."""
+        
+        result = {}
+        
+        self.lock.acquire()
+        try:
+            for (phase, name), entry in self.totals.items():
+                total = result.setdefault(phase, [0, 0.0, 0.0, 0])
+                total[0] += entry[0]
+                total[1] += entry[1]
+                total[2] = max(total[2], entry[2])
+                total[3] += entry[3]
+        finally:
+            self.lock.release()
+        
+        return result
+    
+    def report(self):
+    
+        """Returns a description of the time spent in each phase, followed by
+        the time spent for each type of message."""
+        
+        def row(name, entry):
+            count, seconds, longest, size = entry
+            return "%-28s %9i %11.3f %9.1f %9.3f %12i" % (
+                name, count, seconds * 1000, seconds * 1e6 / count,
+                longest * 1000, size)
+        
+        def header(title):
+            return "%-28s %9s %11s %9s %9s %12s" % (
+                title, "count", "total ms", "mean us", "max ms", "bytes")
+        
+        lines = [header("phase")]
+        
+        for phase, entry in sorted(self.phases().items()):
+            lines.append(row(phase, entry))
+        
+        lines.append("")
+        lines.append(header("phase and message type"))
+        
+        self.lock.acquire()
+        totals = sorted(self.totals.items())
+        self.lock.release()
+        
+        for (phase, name), entry in totals:
+            lines.append(row("%s %s" % (phase, name), entry))
+        
+        return "\n".join(lines) + "\n"
+
+
+class ChromeTraceExporter(PhaseTimer):
+
+    """Records each phase as a complete event in the Chrome trace event
+    format, which can be loaded into chrome://tracing or Perfetto to view the
+    phases as a flame chart. At most max_events events are kept."""
+    
+    def __init__(self, max_events = 1000000):
+    
+        PhaseTimer.__init__(self)
+        self.max_events = max_events
+        self.events = []
+        self.dropped = 0
+        self.origin = time.perf_counter()
+        self.lock = threading.Lock()
+    
+    def span(self, phase, client, msg, size, started, finished):
+    
+        if len(self.events) >= self.max_events:
+            self.dropped += 1
+            return
+        
+        args = {"bytes": size}
+        
+        if msg != None:
+            args["type"] = msg.msg_name
+            args["tag"] = msg.tag
+            if hasattr(msg, "fid"):
+                args["fid"] = msg.fid
+        
+        if isinstance(client, tuple) and len(client) >= 2:
+            args["client"] = "%s:%s" % client[:2]
+        elif client != None:
+            args["client"] = "%s" % (client,)
+        
+        event = {"name": phase, "cat": phase.split(".")[0], "ph": "X",
+                 "ts": (started - self.origin) * 1e6,
+                 "dur": (finished - started) * 1e6,
+                 "pid": os.getpid(), "tid": threading.current_thread().ident,
+                 "args": args}
+        
+        self.lock.acquire()
+        self.events.append(event)
+        self.lock.release()
+    
+    def write(self, path):
+    
+        """Writes the events recorded so far to the file with the given path."""
+        
+        self.lock.acquire()
+        events = self.events[:]
+        self.lock.release()
+        
+        f = open(path, "w")
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms",
+                   "otherData": {"dropped": self.dropped}}, f)
+        f.close()
@@ -0,0 +1,409 @@
+# styxstats.py - Collects metrics about a server and serves them as files.
+#
+# Copyright (C) 2018 David Boddie <david@boddie.org.uk>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import bisect, threading, time
+import styx
+
+# The upper bounds of the buckets used for latency histograms, in seconds.
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+           0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class Counters:
+
+    """Holds the counters and latency histogram for one kind of message or
+    one connection."""
+    
+    def __init__(self):
+    
+        self.requests = 0
+        self.errors = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.seconds = 0.0
+        # One more bucket than there are bounds, for slower requests.
+        self.buckets = [0] * (len(BUCKETS) + 1)
+    
+    def add(self, failed, bytes_in, bytes_out, seconds):
+    
+        self.requests += 1
+        if failed:
+            self.errors += 1
+        self.bytes_in += bytes_in
+        self.bytes_out += bytes_out
+        self.seconds += seconds
+        self.buckets[bisect.bisect_left(BUCKETS, seconds)] += 1
+    
+    def percentile(self, p):
+    
+        # Returns the upper bound of the bucket containing the percentile, or
+        # None if it is in the last bucket or there have been no requests.
+        if self.requests == 0:
+            return None
+        
+        target = self.requests * p / 100.0
+        total = 0
+        
+        for bound, count in zip(BUCKETS, self.buckets):
+            total += count
+            if total >= target:
+                return bound
+        
+        return None
+
+
+class Metrics:
+
+    """Records information about the requests handled by a server, for each
+    type of message and each connection, and describes it in text or in the
+    Prometheus exposition format."""
+    
+    def __init__(self, server, store):
+    
+        self.server = server
+        self.store = store
+        self.started = time.time()
+        
+        self.lock = threading.Lock()
+        self.messages = {}
+        self.connections = {}
+        self.in_flight = 0
+        
+        # The number of times each of the server's limits has been reached.
+        self.limits = {}
+    
+    def connect(self, client):
+    
+        self.lock.acquire()
+        self.connections[client] = Counters()
+        self.lock.release()
+    
+    def disconnect(self, client):
+    
+        self.lock.acquire()
+        self.connections.pop(client, None)
+        self.lock.release()
+    
+    def limit_reached(self, client, limit):
+    
+        self.lock.acquire()
+        self.limits[limit] = self.limits.get(limit, 0) + 1
+        self.lock.release()
+    
+    def begin(self):
+    
+        self.lock.acquire()
+        self.in_flight += 1
+        self.lock.release()
+    
+    def end(self, client, msg, reply, sent, seconds):
+    
+        failed = isinstance(reply, styx.Rerror)
+        
+        self.lock.acquire()
+        try:
+            self.in_flight -= 1
+            
+            counters = self.messages.get(msg.msg_name)
+            if counters == None:
+                counters = self.messages[msg.msg_name] = Counters()
+            counters.add(failed, msg.size, sent, seconds)
+            
+            counters = self.connections.get(client)
+            if counters != None:
+                counters.add(failed, msg.size, sent, seconds)
+        finally:
+            self.lock.release()
+    
+    def snapshot(self):
+    
+        """Returns a dictionary containing copies of the current values."""
+        
+        self.lock.acquire()
+        try:
+            messages = dict((name, self._copy(c)) for name, c in self.messages.items())
+            connections = dict((self._client_name(client), self._copy(c))
+                               for client, c in self.connections.items())
+            in_flight = self.in_flight
+            limits = dict(self.limits)
+        finally:
+            self.lock.release()
+        
+        # Count the fids in use by each connection.
+        fids = {}
+        for client, table in list(self.server.fids.items()):
+            fids[self._client_name(client)] = len(table)
+        
+        caches = {}
+        if hasattr(self.store, "cache_counters"):
+            caches = self.store.cache_counters()
+        
+        return {"uptime": time.time() - self.started, "in_flight": in_flight,
+                "messages": messages, "connections": connections,
+                "fids": fids, "caches": caches, "limits": limits}
+    
+    def _copy(self, counters):
+    
+        copy = Counters()
+        copy.__dict__.update(counters.__dict__)
+        copy.buckets = counters.buckets[:]
+        return copy
+    
+    def _client_name(self, client):
+    
+        if isinstance(client, tuple) and len(client) >= 2:
+            return u"%s:%s" % client[:2]
+        else:
+            return u"%s" % (client,)
+    
+    def text(self):
+    
+        s = self.snapshot()
+        lines = []
+        
+        lines.append(u"uptime %.1f s" % s["uptime"])
+        lines.append(u"connections %i" % len(s["connections"]))
+        lines.append(u"in flight %i" % s["in_flight"])
+        lines.append(u"open fids %i" % sum(s["fids"].values()))
+        lines.append(u"")
+        
+        def ms(value):
+            if value == None:
+                return u"%9s" % u"-"
+            return u"%9.2f" % (value * 1000)
+        
+        for title, table in ((u"message", s["messages"]),
+                             (u"connection", s["connections"])):
+            lines.append(u"%-21s %9s %7s %12s %12s %9s %9s %9s" % (
+                title, u"requests", u"errors", u"bytes in", u"bytes out",
+                u"mean ms", u"p50 ms", u"p99 ms"))
+            
+            for name in sorted(table):
+                c = table[name]
+                if c.requests:
+                    mean = c.seconds / c.requests
+                else:
+                    mean = None
+                lines.append(u"%-21s %9i %7i %12i %12i %s %s %s" % (
+                    name, c.requests, c.errors, c.bytes_in, c.bytes_out,
+                    ms(mean), ms(c.percentile(50)), ms(c.percentile(99))))
+            
+            lines.append(u"")
+        
+        if s["caches"]:
+            lines.append(u"%-21s %12s %12s %9s" % (u"cache", u"hits", u"misses", u"hit rate"))
+            for name in sorted(s["caches"]):
+                hits, misses = s["caches"][name]
+                if hits + misses:
+                    rate = u"%8.1f%%" % (100.0 * hits / (hits + misses))
+                else:
+                    rate = u"%9s" % u"-"
+                lines.append(u"%-21s %12i %12i %s" % (name, hits, misses, rate))
+            lines.append(u"")
+        
+        if s["limits"]:
+            lines.append(u"%-21s %12s" % (u"limit", u"reached"))
+            for name in sorted(s["limits"]):
+                lines.append(u"%-21s %12i" % (name, s["limits"][name]))
+            lines.append(u"")
+        
+        return u"\n".join(lines).encode("utf8")
+    
+    def prometheus(self):
+    
+        s = self.snapshot()
+        lines = []
+        
+        def metric(name, kind, description, values):
+            lines.append(u"# HELP %s %s" % (name, description))
+            lines.append(u"# TYPE %s %s" % (name, kind))
+            for labels, value in values:
+                lines.append(u"%s%s %s" % (name, labels, value))
+        
+        def label(key, value):
+            value = value.replace(u"\\", u"\\\\").replace(u"\"", u"\\\"")
+            return u"{%s=\"%s\"}" % (key, value)
+        
+        messages = sorted(s["messages"].items())
+        connections = sorted(s["connections"].items())
+        
+        metric(u"styx_uptime_seconds", u"gauge", u"Time since the server started.",
+               [(u"", u"%.3f" % s["uptime"])])
+        metric(u"styx_connections", u"gauge", u"Connected clients.",
+               [(u"", len(connections))])
+        metric(u"styx_in_flight_requests", u"gauge", u"Requests being handled.",
+               [(u"", s["in_flight"])])
+        metric(u"styx_open_fids", u"gauge", u"Fids in use by each connection.",
+               [(label(u"connection", name), count)
+                for name, count in sorted(s["fids"].items())])
+        
+        for key, source, title in ((u"type", messages, u"message type"),
+                                   (u"connection", connections, u"connection")):
+            prefix = u"styx_"
+            if key == u"connection":
+                prefix = u"styx_connection_"
+            
+            metric(prefix + u"requests_total", u"counter", u"Requests received, by %s." % title,
+                   [(label(key, n), c.requests) for n, c in source])
+            metric(prefix + u"errors_total", u"counter", u"Requests that failed, by %s." % title,
+                   [(label(key, n), c.errors) for n, c in source])
+            metric(prefix + u"received_bytes_total", u"counter", u"Bytes received, by %s." % title,
+                   [(label(key, n), c.bytes_in) for n, c in source])
+            metric(prefix + u"sent_bytes_total", u"counter", u"Bytes sent, by %s." % title,
+                   [(label(key, n), c.bytes_out) for n, c in source])
+        
+        # Latency histograms are only given for each type of message.
+        name = u"styx_request_duration_seconds"
+        lines.append(u"# HELP %s Time taken to handle requests, by message type." % name)
+        lines.append(u"# TYPE %s histogram" % name)
+        
+        for n, c in messages:
+            total = 0
+            for bound, count in zip(BUCKETS + (u"+Inf",), c.buckets):
+                total += count
+                lines.append(u"%s_bucket{type=\"%s\",le=\"%s\"} %i" % (name, n, bound, total))
+            lines.append(u"%s_sum%s %.6f" % (name, label(u"type", n), c.seconds))
+            lines.append(u"%s_count%s %i" % (name, label(u"type", n), c.requests))
+        
+        caches = sorted(s["caches"].items())
+        if caches:
+            metric(u"styx_cache_hits_total", u"counter", u"Cache hits in the store.",
+                   [(label(u"cache", n), hits) for n, (hits, misses) in caches])
+            metric(u"styx_cache_misses_total", u"counter", u"Cache misses in the store.",
+                   [(label(u"cache", n), misses) for n, (hits, misses) in caches])
+        
+        limits = sorted(s["limits"].items())
+        if limits:
+            metric(u"styx_limits_reached_total", u"counter",
+                   u"Times that each of the server's limits was reached.",
+                   [(label(u"limit", n), count) for n, count in limits])
+        
+        return (u"\n".join(lines) + u"\n").encode("utf8")
+
+
+class StatsStore:
+
+    """Serves a read-only directory containing the metrics collected by a
+    Metrics object, as text in the metrics file and in the Prometheus
+    exposition format in the prometheus file. The contents of each file are
+    produced when it is opened.
+    """
+    
+    FILES = [u"metrics", u"prometheus"]
+    
+    def __init__(self, metrics):
+    
+        self.metrics = metrics
+        self.qids = {}
+        self.paths = {}
+        self.opened = {}
+        self.contents = {}
+        self.root_fid = None
+    
+    def get_root_qid(self, fid, afid, uname, aname):
+    
+        qid = self.make_qid(u"/")
+        self.set_qid_path(fid, qid, u"/")
+        self.root_fid = fid
+        return qid
+    
+    def get_qid_path(self, fid):
+    
+        return self.qids[fid], self.paths[fid]
+    
+    def set_qid_path(self, fid, qid, path):
+    
+        path = path.lstrip(u"/")
+        
+        self.qids[fid] = qid
+        self.paths[fid] = path
+    
+    def make_qid(self, path):
+    
+        path = path.strip(u"/")
+        
+        if path == u"":
+            return (0x80, 0, 0)
+        elif path in self.FILES:
+            return (0, 0, self.FILES.index(path) + 1)
+        
+        return None
+    
+    def free_qid_path(self, fid):
+    
+        del self.qids[fid]
+        del self.paths[fid]
+        
+        self.opened.pop(fid, None)
+        self.contents.pop(fid, None)
+    
+    def stat(self, fid):
+    
+        return self._stat(self.qids[fid], self.paths[fid])
+    
+    def _stat(self, qid, path):
+    
+        now = int(time.time())
+        
+        if qid[0] & 0x80:
+            mode = styx.Stat.DMDIR | 0o555
+        else:
+            mode = 0o444
+        
+        # The files have no fixed length, like those in /proc.
+        return styx.Stat(0, 0, qid, mode, now, now, 0, path.split(u"/")[-1],
+                         u"styx", u"styx", u"")
+    
+    def create(self, fid, name, perm):
+        return False
+    
+    def open(self, fid, mode):
+    
+        if mode & 3 != 0:
+            return False
+        
+        self.opened[fid] = mode
+        
+        path = self.paths[fid]
+        if path == u"metrics":
+            self.contents[fid] = self.metrics.text()
+        elif path == u"prometheus":
+            self.contents[fid] = self.metrics.prometheus()
+        
+        return True
+    
+    def is_opened(self, fid):
+    
+        return fid in self.opened
+    
+    def read(self, fid, offset, count):
+    
+        if self.qids[fid][0] & 0x80:
+            data = styx.encode_stats([self._stat(self.make_qid(name), name)
+                                      for name in self.FILES])
+        else:
+            data = self.contents.get(fid, b"")
+        
+        return data[offset:offset + count]
+    
+    def write(self, fid, offset, data):
+        return -1
+    
+    def remove(self, fid):
+        return u"Cannot remove metrics."
+    
+    def wstat(self, fid, st):
+        pass
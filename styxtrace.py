@@ -0,0 +1,544 @@
+#!/usr/bin/env python
+
+# styxtrace.py - Records the messages received by a server and replays them.
+#
+# Copyright (C) 2018 David Boddie <david@boddie.org.uk>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import argparse, json, os, socket, struct, sys, threading, time
+import styx, styxmux, styxserver
+
+# A trace file starts with MAGIC and contains a record for each message. Each
+# record has a header containing the time the message was received, the number
+# of the connection it was received on, the length of the encoded message that
+# follows and, for write requests recorded without their data, the amount of
+# data. Records with a zero message length mark the end of a connection.
+MAGIC = b"STYXTRC\x01"
+HEADER = struct.Struct("<dIII")
+
+NOTAG = 0xffff
+NOFID = 0xffffffff
+
+class TraceError(Exception):
+    pass
+
+
+class TraceRecorder:
+
+    """Writes the messages passed to it to a trace file. The data in write
+    requests is left out unless keep_data is True, so that traces stay small.
+    Processes forked after the recorder is created write to their own files,
+    named after the trace file and their process IDs."""
+    
+    def __init__(self, path, keep_data = False):
+    
+        self.path = path
+        self.keep_data = keep_data
+        self.lock = threading.Lock()
+        self.file = None
+        self.pid = None
+        self.next_connection = 0
+        
+        # The connection and data length for the record being written.
+        self.current = None
+        
+        self._open()
+    
+    def _open(self):
+    
+        if self.pid == None:
+            path = self.path
+        else:
+            path = "%s.%i" % (self.path, os.getpid())
+            # Keep the file inherited from the parent process open so that
+            # its buffered data is not written a second time when it is
+            # garbage collected.
+            self.inherited = self.file
+        
+        self.pid = os.getpid()
+        self.file = open(path, "wb")
+        self.file.write(MAGIC)
+    
+    def connect(self):
+    
+        """Returns a number for a new connection."""
+        
+        self.lock.acquire()
+        self.next_connection += 1
+        connection = self.next_connection
+        self.lock.release()
+        
+        return connection
+    
+    def record(self, connection, msg):
+    
+        self.lock.acquire()
+        try:
+            if self.pid != os.getpid():
+                self._open()
+            
+            if msg.code == styx.Twrite.code and not self.keep_data:
+                # Record the write with an empty payload and its real length.
+                data = msg.data
+                length = len(data)
+                msg.data = b""
+                try:
+                    self.current = (connection, length)
+                    msg.encode(self)
+                finally:
+                    msg.data = data
+            else:
+                self.current = (connection, 0)
+                msg.encode(self)
+        finally:
+            self.lock.release()
+    
+    def sendall(self, data):
+    
+        # Called by the encode method of the message being recorded.
+        connection, length = self.current
+        self.file.write(HEADER.pack(time.time(), connection, len(data), length))
+        self.file.write(data)
+    
+    def disconnect(self, connection):
+    
+        self.lock.acquire()
+        try:
+            if self.pid == os.getpid():
+                self.file.write(HEADER.pack(time.time(), connection, 0, 0))
+                # Make sure that finished connections are in the file even if
+                # the process is killed.
+                self.file.flush()
+        finally:
+            self.lock.release()
+    
+    def flush(self):
+    
+        self.lock.acquire()
+        self.file.flush()
+        self.lock.release()
+    
+    def close(self):
+    
+        self.lock.acquire()
+        self.file.close()
+        self.lock.release()
+
+
+def read_trace(path):
+
+    """Returns a list of (time, connection, message, length) tuples from the
+    trace file with the given path. The message is None for records that
+    mark the end of a connection."""
+    
+    f = open(path, "rb")
+    try:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise TraceError("%s is not a trace file." % path)
+        
+        records = []
+        
+        while True:
+        
+            header = f.read(HEADER.size)
+            if len(header) < HEADER.size:
+                # Traces from servers that were stopped may end part way
+                # through a record.
+                break
+            
+            t, connection, size, length = HEADER.unpack(header)
+            
+            if size == 0:
+                records.append((t, connection, None, 0))
+                continue
+            
+            data = f.read(size)
+            if len(data) < size:
+                break
+            
+            records.append((t, connection, styx.decode(data=data), length))
+    
+    finally:
+        f.close()
+    
+    return records
+
+
+class ReplayConnection:
+
+    """Replays the messages from one connection in a trace over a connection to
+    a server, giving them new tags and fids."""
+    
+    def __init__(self, replayer, records):
+    
+        self.replayer = replayer
+        self.records = records
+        
+        # Use the message size from the trace, if the connection began with
+        # a version request.
+        msize = styxmux.StyxMux.MSIZE
+        for t, connection, msg, length in records:
+            if msg != None and msg.code == styx.Tversion.code:
+                msize = msg.msize
+                break
+        
+        self.upstream = styxmux.Upstream(replayer.host, replayer.port, msize,
+                                         replayer.fids)
+        
+        # Fids and tags from the trace -> those used for the replay.
+        self.fids = {}
+        self.tags = {}
+        
+        self.lock = threading.Lock()
+        self.outstanding = 0
+        self.done = threading.Condition(self.lock)
+    
+    def run(self, origin, start):
+    
+        speed = self.replayer.speed
+        
+        for t, connection, msg, length in self.records:
+        
+            if msg == None:
+                break
+            elif msg.code == styx.Tversion.code:
+                # The version was negotiated when the connection was made.
+                continue
+            
+            if speed > 0:
+                due = start + (t - origin) / speed
+                delay = due - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+                else:
+                    self.replayer.lateness(-delay)
+            
+            self.send(msg, length)
+            
+            if speed <= 0:
+                # Replay as fast as possible, waiting for each reply.
+                self.wait()
+        
+        self.wait()
+        
+        try:
+            self.upstream.socket.close()
+        except socket.error:
+            pass
+    
+    def wait(self):
+    
+        self.lock.acquire()
+        while self.outstanding > 0:
+            self.done.wait()
+        self.lock.release()
+    
+    def send(self, msg, length):
+    
+        if length > 0:
+            msg.data = b"\0" * length
+        
+        fid = new_fid = None
+        old_tag = msg.tag
+        
+        # Map the fids in the message, allocating new ones for those that
+        # the message introduces.
+        self.lock.acquire()
+        try:
+            if msg.code in styxserver.StyxServer.fid_messages:
+                fid = msg.fid
+                msg.fid = self.fids.get(fid, NOFID)
+            
+            if msg.code == styx.Tattach.code:
+                new_fid = self.replayer.fids.alloc()
+                self.fids[msg.fid] = new_fid
+                msg.fid = new_fid
+                msg.afid = self.fids.get(msg.afid, NOFID)
+            
+            elif msg.code == styx.Twalk.code:
+                if msg.newfid == fid:
+                    msg.newfid = msg.fid
+                else:
+                    new_fid = self.replayer.fids.alloc()
+                    self.fids[msg.newfid] = new_fid
+                    msg.newfid = new_fid
+            
+            elif msg.code in (styx.Tclunk.code, styx.Tremove.code):
+                # Later messages may reuse the fid for something else.
+                self.fids.pop(fid, None)
+            
+            elif msg.code == styx.Tflush.code:
+                msg.oldtag = self.tags.get(msg.oldtag, NOTAG)
+            
+            self.outstanding += 1
+        finally:
+            self.lock.release()
+        
+        name = msg.msg_name
+        started = time.time()
+        
+        # Whether the reply has arrived, which it can do before the request
+        # has been sent completely.
+        answered = []
+        
+        def callback(reply):
+        
+            finished = time.time()
+            failed = isinstance(reply, styx.Rerror)
+            
+            # Release fids that are no longer in use.
+            if new_fid != None:
+                if failed or (msg.code == styx.Twalk.code and \
+                              len(reply.wqid) < len(msg.wname)):
+                    self._release(new_fid)
+            
+            if msg.code in (styx.Tclunk.code, styx.Tremove.code) and msg.fid != NOFID:
+                self.replayer.fids.release(msg.fid)
+            
+            self.replayer.result(name, finished - started, failed)
+            
+            self.lock.acquire()
+            answered.append(True)
+            self.tags.pop(old_tag, None)
+            self.outstanding -= 1
+            self.done.notify_all()
+            self.lock.release()
+        
+        # The lock is not held while the request is sent, so that the thread
+        # reading replies can still take it if sending blocks. The tag is
+        # recorded afterwards unless the reply has already arrived.
+        try:
+            tag = self.upstream.request(msg, callback)
+        except socket.error:
+            self.lock.acquire()
+            self.outstanding -= 1
+            self.done.notify_all()
+            self.lock.release()
+            self.replayer.result(name, 0, True)
+            return
+        
+        self.lock.acquire()
+        if not answered:
+            self.tags[old_tag] = tag
+        self.lock.release()
+    
+    def _release(self, fid):
+    
+        self.lock.acquire()
+        for key, value in list(self.fids.items()):
+            if value == fid:
+                del self.fids[key]
+        self.lock.release()
+        
+        self.replayer.fids.release(fid)
+
+
+class Replayer:
+
+    """Replays a trace against a server, either at a multiple of the speed at
+    which it was recorded or, if the speed is zero, as fast as possible, and
+    collects the latency of each kind of request."""
+    
+    def __init__(self, host, port, speed = 1.0):
+    
+        self.host = host
+        self.port = port
+        self.speed = speed
+        
+        self.fids = styxmux.FidAllocator()
+        self.lock = threading.Lock()
+        self.latencies = {}
+        self.errors = {}
+        self.max_lateness = 0
+    
+    def replay(self, records):
+    
+        if not records:
+            return self.summary(0)
+        
+        # Group the records by connection, keeping their order.
+        connections = {}
+        for record in records:
+            connections.setdefault(record[1], []).append(record)
+        
+        origin = records[0][0]
+        start = time.time()
+        if self.speed > 0:
+            # Allow time for the first connections to be made.
+            start += 0.1
+        threads = []
+        
+        # Start each connection at the time its first message was received.
+        for number, connection_records in sorted(connections.items(),
+                                                 key=lambda item: item[1][0][0]):
+            if self.speed > 0:
+                delay = start + (connection_records[0][0] - origin) / self.speed - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+            
+            connection = ReplayConnection(self, connection_records)
+            t = threading.Thread(target=connection.run, args=(origin, start))
+            t.daemon = True
+            t.start()
+            threads.append(t)
+        
+        for t in threads:
+            t.join()
+        
+        return self.summary(time.time() - start)
+    
+    def result(self, name, latency, failed):
+    
+        self.lock.acquire()
+        if failed:
+            self.errors[name] = self.errors.get(name, 0) + 1
+        else:
+            self.latencies.setdefault(name, []).append(latency)
+        self.lock.release()
+    
+    def lateness(self, delay):
+    
+        # Record how far behind the trace the replay has fallen.
+        self.max_lateness = max(self.max_lateness, delay)
+    
+    def summary(self, elapsed):
+    
+        results = {"elapsed_s": elapsed, "speed": self.speed,
+                   "max_lateness_ms": self.max_lateness * 1000,
+                   "messages": {}}
+        
+        for name in sorted(set(self.latencies) | set(self.errors)):
+        
+            values = sorted(self.latencies.get(name, []))
+            entry = results["messages"][name] = {
+                "count": len(values), "errors": self.errors.get(name, 0)}
+            
+            for label, p in (("p50", 50), ("p90", 90), ("p99", 99), ("p999", 99.9)):
+                if values:
+                    entry[label + "_ms"] = values[int(round(p / 100.0 * (len(values) - 1)))] * 1000
+                else:
+                    entry[label + "_ms"] = None
+            
+            if values:
+                entry["max_ms"] = values[-1] * 1000
+            else:
+                entry["max_ms"] = None
+        
+        return results
+
+
+def compare(results, baseline):
+
+    """Returns lines describing the differences in latency between the results
+    and a baseline for each kind of message found in both."""
+    
+    lines = []
+    
+    for name, entry in sorted(results["messages"].items()):
+    
+        old = baseline["messages"].get(name)
+        if old == None:
+            continue
+        
+        pieces = []
+        for label in ("p50_ms", "p99_ms"):
+            if entry[label] == None or not old[label]:
+                continue
+            pieces.append("%s %.3f -> %.3f ms (%+.1f%%)" % (
+                label[:-3], old[label], entry[label],
+                (entry[label] / old[label] - 1) * 100))
+        
+        if pieces:
+            lines.append("%-9s %s" % (name, ", ".join(pieces)))
+    
+    return lines
+
+
+def dump(path):
+
+    records = read_trace(path)
+    if not records:
+        return
+    
+    origin = records[0][0]
+    
+    for t, connection, msg, length in records:
+        if msg == None:
+            text = "disconnected"
+        elif length > 0:
+            text = "%r with %i bytes" % (msg, length)
+        else:
+            text = repr(msg)
+        sys.stdout.write("%12.6f %5i %s\n" % (t - origin, connection, text))
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Show or replay traces of the messages received by a Styx server.")
+    subparsers = parser.add_subparsers(dest="command")
+    
+    dump_parser = subparsers.add_parser("dump", help="Show the contents of a trace.")
+    dump_parser.add_argument("trace")
+    
+    replay_parser = subparsers.add_parser("replay", help="Replay a trace against a server.")
+    replay_parser.add_argument("trace")
+    replay_parser.add_argument("host")
+    replay_parser.add_argument("port", type=int)
+    replay_parser.add_argument("--speed", type=float, default=1.0,
+                               help="Replay at this multiple of the recorded speed, or as fast as possible if 0 (default 1).")
+    replay_parser.add_argument("--output", help="Write the results to this JSON file.")
+    replay_parser.add_argument("--baseline", help="Compare the results with those in this JSON file.")
+    
+    args = parser.parse_args()
+    
+    if args.command == "dump":
+        dump(args.trace)
+        sys.exit()
+    elif args.command != "replay":
+        parser.print_help()
+        sys.exit(1)
+    
+    replayer = Replayer(args.host, args.port, args.speed)
+    results = replayer.replay(read_trace(args.trace))
+    
+    sys.stdout.write("%-9s %8s %7s %9s %9s %9s %9s %9s\n" % (
+        "message", "count", "errors", "p50 ms", "p90 ms", "p99 ms", "p999 ms", "max ms"))
+    
+    for name, entry in sorted(results["messages"].items()):
+        values = []
+        for label in ("p50_ms", "p90_ms", "p99_ms", "p999_ms", "max_ms"):
+            if entry[label] == None:
+                values.append("%9s" % "-")
+            else:
+                values.append("%9.3f" % entry[label])
+        sys.stdout.write("%-9s %8i %7i %s\n" % (name, entry["count"], entry["errors"], " ".join(values)))
+    
+    sys.stdout.write("Replayed in %.3f s; at most %.3f ms behind the trace.\n" % (
+        results["elapsed_s"], results["max_lateness_ms"]))
+    
+    if args.output:
+        f = open(args.output, "w")
+        json.dump(results, f, indent=2, sort_keys=True)
+        f.write("\n")
+        f.close()
+    
+    if args.baseline:
+        f = open(args.baseline)
+        baseline = json.load(f)
+        f.close()
+        
+        sys.stdout.write("\nChanges from the baseline:\n")
+        for line in compare(results, baseline):
+            sys.stdout.write("  " + line + "\n")
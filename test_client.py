@@ -0,0 +1,98 @@
+# test_client.py - Tests for the client's tree operations, using servers in the
+#                  same process.
+#
+# Copyright (C) 2018 David Boddie <david@boddie.org.uk>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os, shutil, tempfile, unittest
+import client, dictserver, styxserver
+
+class RenamingStore(dictserver.DictStore):
+
+    """Lists some entries under other names, as a broken or hostile server
+    might."""
+    
+    def __init__(self, dictionary, names):
+    
+        dictserver.DictStore.__init__(self, dictionary)
+        self.names = names
+    
+    def _stat(self, qid, path):
+    
+        s = dictserver.DictStore._stat(self, qid, path)
+        if s != None:
+            s.name = self.names.get(path.lstrip(u"/"), s.name)
+        return s
+
+
+def connect(store):
+
+    c = client.Client()
+    c.connect_socket(styxserver.StyxServer(store).connect_pair(), u"", u"")
+    return c
+
+
+class SyncTest(unittest.TestCase):
+
+    def setUp(self):
+    
+        self.directory = tempfile.mkdtemp()
+        self.local_dir = os.path.join(self.directory, "inner", "local")
+    
+    def tearDown(self):
+    
+        shutil.rmtree(self.directory)
+    
+    def test_names_outside_the_tree_are_rejected(self):
+    
+        store = RenamingStore(
+            {u"d": {u"a": u"escaped", u"b": u"dot", u"sub": {u"c": u"loop"},
+                    u"ok": u"hello"}},
+            {u"d/a": u"../../escaped", u"d/b": u".", u"d/sub": u".."})
+        c = connect(store)
+        
+        # Directories named . or .. are not listed again.
+        paths = [path for path, s in c.walk_tree(u"d")]
+        self.assertEqual(paths, [u"d/ok"])
+        
+        errors = []
+        result = c.sync(u"d", self.local_dir, delete=True,
+                        onerror=lambda path, message: errors.append(path))
+        
+        self.assertEqual(sorted(errors), [u"d/.", u"d/..", u"d/../../escaped"])
+        self.assertEqual(result[u"fetched"], 1)
+        self.assertEqual(os.listdir(self.directory), ["inner"])
+        self.assertEqual(sorted(os.listdir(self.local_dir)), [".styxsync", "ok"])
+    
+    def test_manifest_entries_outside_the_tree_are_not_removed(self):
+    
+        os.makedirs(self.local_dir)
+        outside = os.path.join(self.directory, "outside")
+        open(outside, "w").close()
+        
+        manifest = os.path.join(self.local_dir, ".styxsync")
+        client.save_manifest(manifest, {u"../../outside": (0, 0, 0, 0, 1)})
+        
+        c = connect(dictserver.DictStore({u"d": {u"ok": u"hello"}}))
+        result = c.sync(u"d", self.local_dir, delete=True)
+        
+        self.assertTrue(os.path.exists(outside))
+        self.assertEqual(result[u"deleted"], 0)
+        self.assertEqual(result[u"errors"],
+                         [(u"../../outside", "Path is outside the local directory.")])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,74 @@
+# test_sqliteserver.py - Tests for the SQLite store.
+#
+# Copyright (C) 2018 David Boddie <david@boddie.org.uk>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os, shutil, sqlite3, tempfile, unittest
+import client, sqliteserver, styx, styxserver
+
+def connect(store):
+
+    c = client.Client()
+    c.connect_socket(styxserver.StyxServer(store).connect_pair(), u"", u"")
+    return c
+
+
+class SQLiteStoreTest(unittest.TestCase):
+
+    def setUp(self):
+    
+        self.directory = tempfile.mkdtemp()
+        self.database = os.path.join(self.directory, "files.db")
+    
+    def tearDown(self):
+    
+        shutil.rmtree(self.directory)
+    
+    def create(self, c, path):
+    
+        c.create(path, 0o644, styx.File.OWRITE)
+        return c.stat(path).qid
+    
+    def test_qid_paths_are_not_reused(self):
+    
+        c = connect(sqliteserver.SQLiteStore(self.database))
+        qids = [self.create(c, u"a"), self.create(c, u"b")]
+        c.remove(u"b")
+        
+        qid = self.create(c, u"c")
+        self.assertNotIn(qid[2], [q[2] for q in qids])
+        c.disconnect()
+        
+        # The next qid path is kept in the database.
+        c = connect(sqliteserver.SQLiteStore(self.database))
+        c.remove(u"c")
+        self.assertTrue(self.create(c, u"d")[2] > qid[2])
+        c.disconnect()
+    
+    def test_old_databases_are_upgraded(self):
+    
+        db = sqlite3.connect(self.database)
+        db.executescript(sqliteserver.SQLiteStore.schema.replace(u" AUTOINCREMENT", u""))
+        db.close()
+        
+        c = connect(sqliteserver.SQLiteStore(self.database))
+        qid = self.create(c, u"a")
+        c.remove(u"a")
+        self.assertTrue(self.create(c, u"b")[2] > qid[2])
+        c.disconnect()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,196 @@
+# test_styxproxy.py - Tests for the caching proxy, using servers in the same
+#                     process as upstream servers.
+#
+# Copyright (C) 2018 David Boddie <david@boddie.org.uk>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import threading, time, unittest
+import client, dictserver, styxproxy, styxserver
+
+class SlowStore(dictserver.DictStore):
+
+    """Counts the stat requests it receives and takes a while to answer them,
+    so that requests from several clients overlap."""
+    
+    def __init__(self, dictionary, delay):
+    
+        dictserver.DictStore.__init__(self, dictionary)
+        self.delay = delay
+        self.stats = 0
+    
+    def stat(self, fid):
+    
+        self.stats += 1
+        time.sleep(self.delay)
+        return dictserver.DictStore.stat(self, fid)
+
+
+class VersionedStore(dictserver.DictStore):
+
+    """Gives each path a fixed qid path and a version that can be changed."""
+    
+    def __init__(self, dictionary):
+    
+        dictserver.DictStore.__init__(self, dictionary)
+        self.versions = {}
+        self.qpaths = {}
+    
+    def make_qid(self, path):
+    
+        qid = dictserver.DictStore.make_qid(self, path)
+        if qid == None:
+            return None
+        
+        path = path.strip(u"/")
+        qpath = self.qpaths.setdefault(path, len(self.qpaths) + 1)
+        return (qid[0], self.versions.get(path, 0), qpath)
+
+
+def connect(server):
+
+    c = client.Client()
+    c.connect_socket(server.connect_pair(), u"", u"")
+    return c
+
+
+class ProxyTest(unittest.TestCase):
+
+    def start(self, store, ttl = 60.0):
+    
+        upstream = connect(styxserver.StyxServer(store))
+        self.proxy = styxproxy.ProxyStore(upstream, ttl=ttl)
+        return styxserver.StyxServer(self.proxy)
+    
+    def test_concurrent_stats_are_coalesced(self):
+    
+        store = SlowStore({u"file": u"hello"}, 0.3)
+        server = self.start(store)
+        clients = [connect(server), connect(server)]
+        store.stats = 0
+        
+        results = []
+        threads = [threading.Thread(target=lambda c=c: results.append(c.stat(u"file")))
+                   for c in clients]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        
+        self.assertEqual([s.length for s in results], [5, 5])
+        self.assertEqual(store.stats, 1)
+    
+    def test_block_discarded_when_version_changes(self):
+    
+        store = VersionedStore({u"file": u"hello"})
+        server = self.start(store)
+        c = connect(server)
+        
+        def read():
+            f = c.open(u"file", 0)
+            try:
+                return f.read(0, 100)
+            finally:
+                f.close()
+        
+        self.assertEqual(read(), b"hello")
+        
+        # A change that the upstream server does not report is not seen.
+        store.d[u"file"] = u"world"
+        self.assertEqual(read(), b"hello")
+        
+        store.versions[u"file"] = 1
+        self.assertEqual(read(), b"world")
+    
+    def test_missing_files_are_cached_but_errors_are_not(self):
+    
+        store = dictserver.DictStore({u"file": u"hello"})
+        self.start(store)
+        
+        self.assertEqual(self.proxy.make_qid(u"missing"), None)
+        self.assertEqual(self.proxy.stats[u"missing"][1], None)
+        
+        # Make the upstream client fail with an error that is not caused by a
+        # missing file.
+        send = self.proxy.upstream.send
+        def fail(msg):
+            raise client.ClientError("Too many fids.")
+        self.proxy.upstream.send = fail
+        
+        self.assertEqual(self.proxy.make_qid(u"file"), None)
+        self.assertNotIn(u"file", self.proxy.stats)
+        
+        self.proxy.upstream.send = send
+        self.assertNotEqual(self.proxy.make_qid(u"file"), None)
+    
+    def test_cancel_only_flushes_the_cancelled_call(self):
+    
+        store = SlowStore({u"file": u"hello"}, 0.3)
+        self.start(store)
+        
+        results = []
+        def stat(call):
+            self.proxy.begin_call(call)
+            try:
+                results.append(self.proxy.make_qid(u"file"))
+            finally:
+                self.proxy.end_call(call)
+        
+        call = object()
+        t = threading.Thread(target=stat, args=(call,))
+        t.start()
+        time.sleep(0.1)
+        
+        # Another call's request is not flushed, but this one's is.
+        self.assertFalse(self.proxy.cancel(object()))
+        self.assertTrue(self.proxy.cancel(call))
+        t.join()
+        
+        # The upstream server answers the stat before the flush, so the call
+        # completes with the file's qid, as a 9P client must accept a reply
+        # that arrives before the Rflush.
+        self.assertEqual(len(results), 1)
+        self.assertNotEqual(results[0], None)
+        self.assertEqual(results[0], self.proxy.make_qid(u"file"))
+        self.assertEqual(store.stats, 1)
+    
+    def test_flushed_calls_are_not_shared(self):
+    
+        coalescer = styxproxy.Coalescer()
+        started = threading.Event()
+        
+        def flushed():
+            started.set()
+            time.sleep(0.1)
+            raise client.FlushedError("Request flushed.")
+        
+        errors = []
+        def first():
+            try:
+                coalescer.call(u"key", flushed)
+            except client.FlushedError as e:
+                errors.append(e)
+        
+        t = threading.Thread(target=first)
+        t.start()
+        started.wait()
+        
+        # The waiting caller makes the call again instead of seeing the error.
+        self.assertEqual(coalescer.call(u"key", lambda: 42), 42)
+        t.join()
+        self.assertEqual(len(errors), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
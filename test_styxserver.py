@@ -0,0 +1,148 @@
+# test_styxserver.py - Tests for the server's handling of malformed messages
+#                      and resource limits.
+#
+# Copyright (C) 2018 David Boddie <david@boddie.org.uk>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import socket, struct, time, unittest
+import dictserver, styx, styxserver
+
+NOFID = 0xffffffff
+
+class ServerTest(unittest.TestCase):
+
+    def setUp(self):
+    
+        self.server = styxserver.StyxServer(dictserver.DictStore({u"file": u"hello"}))
+    
+    def connect(self):
+    
+        # Returns a socket for a connection that has been attached to the
+        # root of the store with fid 0.
+        s = self.server.connect_pair()
+        s.settimeout(5)
+        styx.Tversion(0xffff, 8192, u"9P2000").encode(s)
+        styx.decode(sock=s)
+        styx.Tattach(1, 0, NOFID, u"", u"").encode(s)
+        self.assertIsInstance(styx.decode(sock=s), styx.Rattach)
+        return s
+    
+    def request(self, s, msg):
+    
+        msg.encode(s)
+        return styx.decode(sock=s)
+    
+    def assertClosed(self, s):
+    
+        self.assertRaises(EOFError, styx.decode, sock=s)
+    
+    def wait_for_clients(self, count):
+    
+        for i in range(50):
+            if len(self.server.clients) == count:
+                break
+            time.sleep(0.02)
+        self.assertEqual(len(self.server.clients), count)
+    
+    def test_unknown_message_type(self):
+    
+        s = self.connect()
+        s.sendall(struct.pack("<IBH", 7, 99, 3))
+        
+        reply = styx.decode(sock=s)
+        self.assertIsInstance(reply, styx.Rerror)
+        self.assertEqual(reply.tag, 3)
+        self.assertClosed(s)
+    
+    def test_malformed_message(self):
+    
+        # A Twalk whose element count is larger than its body.
+        s = self.connect()
+        body = struct.pack("<IIH", 0, 1, 5)
+        s.sendall(struct.pack("<IBH", 7 + len(body), styx.Twalk.code, 4) + body)
+        
+        reply = styx.decode(sock=s)
+        self.assertIsInstance(reply, styx.Rerror)
+        self.assertEqual(reply.tag, 4)
+        self.assertClosed(s)
+    
+    def test_bad_messages_release_connections(self):
+    
+        self.server.configure_limits(max_connections=1)
+        
+        for i in range(3):
+            s = self.connect()
+            s.sendall(struct.pack("<IBH", 7, 99, 3))
+            styx.decode(sock=s)
+            self.assertClosed(s)
+            self.wait_for_clients(0)
+        
+        self.assertEqual(self.server.fids, {})
+    
+    def test_max_frame(self):
+    
+        self.server.configure_limits(max_frame=1024)
+        s = self.connect()
+        
+        reply = self.request(s, styx.Tversion(0xffff, 65536, u"9P2000"))
+        self.assertEqual(reply.msize, 1024)
+        
+        s = self.connect()
+        s.sendall(struct.pack("<IBH", 4096, styx.Twrite.code, 5) + b"x" * 100)
+        reply = styx.decode(sock=s)
+        self.assertEqual((reply.tag, reply.ename), (5, "Message too large."))
+        self.assertClosed(s)
+    
+    def test_max_fids(self):
+    
+        self.server.configure_limits(max_fids=3, max_server_fids=5)
+        s = self.connect()
+        
+        replies = [self.request(s, styx.Twalk(2, 0, fid, [])) for fid in (1, 2, 3)]
+        self.assertIsInstance(replies[1], styx.Rwalk)
+        self.assertIsInstance(replies[2], styx.Rerror)
+        
+        # Two fids are left for the server, and this client's attach uses one
+        # of them.
+        t = self.connect()
+        replies = [self.request(t, styx.Twalk(2, 0, fid, [])) for fid in (1, 2)]
+        self.assertIsInstance(replies[0], styx.Rwalk)
+        self.assertIsInstance(replies[1], styx.Rerror)
+        
+        # Fids that are clunked can be used again.
+        self.request(s, styx.Tclunk(2, 2))
+        self.assertIsInstance(self.request(t, styx.Twalk(2, 0, 2, [])), styx.Rwalk)
+    
+    def test_max_connections(self):
+    
+        self.server.configure_limits(max_connections=1)
+        s = self.connect()
+        
+        t = self.server.connect_pair()
+        t.settimeout(5)
+        styx.Tversion(0xffff, 8192, u"9P2000").encode(t)
+        try:
+            self.assertClosed(t)
+        except socket.error:
+            # The connection may be reset instead.
+            pass
+        
+        s.close()
+        self.wait_for_clients(0)
+        self.connect()
+
+
+if __name__ == "__main__":
+    unittest.main()
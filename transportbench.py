@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+
+# transportbench.py - Compares the latency of small requests and the
+#                     throughput of reads and writes over different transports.
+#
+# Copyright (C) 2018 David Boddie <david@boddie.org.uk>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import argparse, json, os, sys, tempfile, threading, time
+import client, loadgen, styx, styxserver
+
+TRANSPORTS = ("tcp", "unix", "pair")
+
+def connect(server, transport, msize):
+
+    """Returns a client connected to the server using the given transport.
+    The server is run in a thread in this process for each transport, so
+    that only the transport differs between them."""
+    
+    c = client.Client()
+    c.msize = msize
+    
+    if transport == "tcp":
+        s = server.listen("127.0.0.1", 0)
+        port = s.getsockname()[1]
+    elif transport == "unix":
+        path = os.path.join(tempfile.mkdtemp(), "styx")
+        s = server.listen_unix(path)
+    else:
+        c.connect_socket(server.connect_pair(), u"", u"")
+        return c
+    
+    # Accept the one connection that the client makes.
+    t = threading.Thread(target=lambda: server.handle(*s.accept()))
+    t.daemon = True
+    t.start()
+    
+    if transport == "tcp":
+        c.connect("127.0.0.1", port, u"", u"")
+    else:
+        c.connect_unix(path, u"", u"")
+        os.unlink(path)
+        os.rmdir(os.path.dirname(path))
+    
+    s.close()
+    return c
+
+
+def measure_latency(c, count):
+
+    """Returns a sorted list of the times taken by Tstat requests."""
+    
+    times = []
+    
+    for i in range(count):
+        started = time.perf_counter()
+        c.send(styx.Tstat(tag=3, fid=c.root_fid))
+        times.append(time.perf_counter() - started)
+    
+    times.sort()
+    return times
+
+
+def measure_throughput(c, size, write):
+
+    """Reads or writes the given number of bytes in messages of the largest
+    size allowed, returning the number of bytes transferred per second."""
+    
+    f = c.open(u"d0/f0", int(write))
+    chunk = c.msize - 24
+    data = b"x" * chunk
+    
+    started = time.perf_counter()
+    offset = 0
+    
+    while offset < size:
+        if write:
+            c.send(styx.Twrite(tag=3, fid=f.fid, offset=offset, data=data))
+        else:
+            c.send(styx.Tread(tag=3, fid=f.fid, offset=0, count=chunk))
+        offset += chunk
+    
+    elapsed = time.perf_counter() - started
+    f.close()
+    
+    return offset / elapsed
+
+
+def run(transports, count, size, msize):
+
+    results = {}
+    
+    for transport in transports:
+    
+        # The file read is large enough for every read to be a full one.
+        server = styxserver.StyxServer(loadgen.SyntheticStore(1, 1, msize))
+        c = connect(server, transport, msize)
+        
+        times = measure_latency(c, count)
+        results[transport] = {
+            "p50": loadgen.percentile(times, 50),
+            "p99": loadgen.percentile(times, 99),
+            "read_bytes_per_s": measure_throughput(c, size, False),
+            "write_bytes_per_s": measure_throughput(c, size, True)
+            }
+        
+        c.disconnect()
+    
+    return results
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Compare the latency of small requests and the throughput of reads and writes over TCP loopback, Unix domain sockets and socket pairs.")
+    parser.add_argument("--transports", default=",".join(TRANSPORTS),
+                        help="The transports to measure (default %s)." % ",".join(TRANSPORTS))
+    parser.add_argument("--requests", type=int, default=20000,
+                        help="The number of small requests used to measure latency (default 20000).")
+    parser.add_argument("--size", type=int, default=256,
+                        help="The number of megabytes read and written to measure throughput (default 256).")
+    parser.add_argument("--msize", type=int, default=65536,
+                        help="The maximum message size (default 65536).")
+    parser.add_argument("--output", help="Write the results to this JSON file.")
+    args = parser.parse_args()
+    
+    transports = args.transports.split(",")
+    for transport in transports:
+        if transport not in TRANSPORTS:
+            sys.stderr.write("Unknown transport: %s\n" % transport)
+            sys.exit(1)
+    
+    results = run(transports, args.requests, args.size * 1048576, args.msize)
+    
+    sys.stdout.write("%-10s %10s %10s %12s %12s\n" % (
+        "transport", "p50 us", "p99 us", "read MB/s", "write MB/s"))
+    
+    for transport in transports:
+        r = results[transport]
+        sys.stdout.write("%-10s %10.1f %10.1f %12.1f %12.1f\n" % (
+            transport, r["p50"] * 1e6, r["p99"] * 1e6,
+            r["read_bytes_per_s"] / 1048576, r["write_bytes_per_s"] / 1048576))
+    
+    if args.output:
+        f = open(args.output, "w")
+        json.dump(results, f, indent=2, sort_keys=True)
+        f.write("\n")
+        f.close()
@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+
+# treebench.py - Compares the time taken to list every entry in a large tree
+#                of directories serially and with Client.walk_tree.
+#
+# Copyright (C) 2018 David Boddie <david@boddie.org.uk>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import argparse, json, os, signal, sys, time
+import client, dictserver, styx, styxserver
+
+def make_tree(fanout, depth, files):
+
+    """Returns a dictionary containing fanout directories at each level down
+    to the given depth, with the given number of files in each directory at
+    the lowest level."""
+    
+    if depth == 0:
+        return dict((u"file%i" % i, u"x" * (i % 64)) for i in range(files))
+    
+    return dict((u"dir%i" % i, make_tree(fanout, depth - 1, files))
+                for i in range(fanout))
+
+
+def start_server(tree):
+
+    """Forks a process that serves the tree on the loopback interface,
+    returning its process id and port."""
+    
+    store = dictserver.DictStore(tree)
+    store.preload()
+    server = styxserver.StyxServer(store)
+    
+    s = server.listen("127.0.0.1", 0)
+    port = s.getsockname()[1]
+    
+    pid = os.fork()
+    if pid == 0:
+        try:
+            server.accept(s, True)
+        finally:
+            os._exit(0)
+    
+    s.close()
+    return pid, port
+
+
+def list_serially(c, path = u""):
+
+    """Lists the tree one directory at a time using Client.ls, returning the
+    number of entries found."""
+    
+    count = 0
+    
+    for s in c.ls(path, details=True):
+        count += 1
+        if s.mode & styx.Stat.DMDIR:
+            count += list_serially(c, (path + u"/" + s.name).lstrip(u"/"))
+    
+    return count
+
+
+def measure(port, method, outstanding, connections):
+
+    clients = []
+    for i in range(connections):
+        c = client.Client()
+        c.msize = 65536
+        c.connect("127.0.0.1", port, u"", u"")
+        clients.append(c)
+    
+    started = time.perf_counter()
+    
+    if method == "serial":
+        count = list_serially(clients[0])
+    else:
+        count = 0
+        for path, s in clients[0].walk_tree(u"", outstanding=outstanding,
+                                            clients=clients[1:]):
+            count += 1
+    
+    elapsed = time.perf_counter() - started
+    
+    for c in clients:
+        c.disconnect()
+    
+    return count, elapsed
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Compare the time taken to list a large tree of directories serially with Client.ls and concurrently with Client.walk_tree.")
+    parser.add_argument("--fanout", type=int, default=10,
+                        help="The number of directories in each directory above the lowest level (default 10).")
+    parser.add_argument("--depth", type=int, default=4,
+                        help="The number of levels of directories (default 4).")
+    parser.add_argument("--files", type=int, default=9,
+                        help="The number of files in each directory at the lowest level (default 9).")
+    parser.add_argument("--outstanding", default="1,4,16,64",
+                        help="The numbers of directories listed at once by walk_tree (default 1,4,16,64).")
+    parser.add_argument("--connections", default="1,2",
+                        help="The numbers of connections used by walk_tree (default 1,2).")
+    parser.add_argument("--output", help="Write the results to this JSON file.")
+    args = parser.parse_args()
+    
+    tree = make_tree(args.fanout, args.depth, args.files)
+    pid, port = start_server(tree)
+    
+    runs = [("serial", 1, 1)]
+    for connections in [int(n) for n in args.connections.split(",")]:
+        for outstanding in [int(n) for n in args.outstanding.split(",")]:
+            runs.append(("walk_tree", outstanding, connections))
+    
+    results = []
+    
+    try:
+        time.sleep(0.1)
+        sys.stdout.write("%-10s %11s %11s %9s %10s %12s\n" % (
+            "method", "outstanding", "connections", "entries", "seconds",
+            "entries/s"))
+        
+        for method, outstanding, connections in runs:
+            count, elapsed = measure(port, method, outstanding, connections)
+            results.append({"method": method, "outstanding": outstanding,
+                            "connections": connections, "entries": count,
+                            "seconds": elapsed})
+            sys.stdout.write("%-10s %11i %11i %9i %10.3f %12.0f\n" % (
+                method, outstanding, connections, count, elapsed,
+                count / elapsed))
+    finally:
+        os.kill(pid, signal.SIGKILL)
+        os.waitpid(pid, 0)
+    
+    if args.output:
+        f = open(args.output, "w")
+        json.dump(results, f, indent=2, sort_keys=True)
+        f.write("\n")
+        f.close()